@@ -0,0 +1,97 @@
+"""Time segmentation with and without batching against the stub standalone.
+
+Each call to the stub ``cat_standalone.sh`` waits ``STUB_STARTUP_SECONDS``
+like the MATLAB runtime does when it starts,
+so batching images should amortize that cost.
+
+Usage::
+
+    python benchmarks/bench_batching.py --n_subjects 8 --batch_size 4
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from synthetic import make_dataset
+
+STUB = Path(__file__).parent / "stub_standalone"
+
+
+def run_segment(
+    bids_dir: Path, output_dir: Path, batch_size: int, startup: float
+) -> float:
+    """Run the segment command and return its wall time in seconds."""
+    env = {
+        **os.environ,
+        "STANDALONE": str(STUB),
+        "STUB_STARTUP_SECONDS": str(startup),
+        "STUB_IMAGE_SECONDS": "0",
+    }
+    cmd = [
+        sys.executable,
+        "-m",
+        "cat12.main",
+        str(bids_dir),
+        str(output_dir),
+        "participant",
+        "segment",
+        "--skip_validation",
+        "--verbose",
+        "0",
+        "--batch_size",
+        str(batch_size),
+    ]
+    start = time.perf_counter()
+    subprocess.run(cmd, env=env, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    """Compare the wall time of unbatched and batched runs."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--n_subjects", type=int, default=8)
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--startup", type=float, default=1.0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        bids_dir = make_dataset(
+            tmp / "bids",
+            n_subjects=args.n_subjects,
+            shape=(8, 8, 8),
+            gz=False,
+        )
+
+        unbatched = run_segment(
+            bids_dir, tmp / "unbatched", batch_size=1, startup=args.startup
+        )
+        batched = run_segment(
+            bids_dir,
+            tmp / "batched",
+            batch_size=args.batch_size,
+            startup=args.startup,
+        )
+
+    print(f"batch_size=1: {unbatched:.2f} s")
+    print(f"batch_size={args.batch_size}: {batched:.2f} s")
+
+    # the runtime starts once per batch instead of once per image
+    n_saved = args.n_subjects - -(-args.n_subjects // args.batch_size)
+    expected = n_saved * args.startup
+    if unbatched - batched < 0.5 * expected:
+        sys.exit(
+            f"Batching saved {unbatched - batched:.2f} s, "
+            f"expected about {expected:.2f} s."
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Compare finding T1w images with the scanner and with pybids.
+
+Usage::
+
+    python benchmarks/bench_discovery.py --n_subjects 200 --n_other_files 60
+"""
+
+from __future__ import annotations
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+from synthetic import make_dataset
+
+from cat12.scanner import find_t1w
+
+
+def time_scanner(bids_dir: Path, n_jobs: int) -> tuple[float, int]:
+    """Return the time to find all T1w and the number of images found."""
+    start = time.perf_counter()
+    images = find_t1w(bids_dir, n_jobs=n_jobs)
+    elapsed = time.perf_counter() - start
+    return elapsed, sum(len(x) for x in images.values())
+
+
+def time_pybids(bids_dir: Path) -> tuple[float, int]:
+    """Return the time to index the dataset and query all T1w."""
+    from bids import BIDSLayout
+
+    start = time.perf_counter()
+    layout = BIDSLayout(bids_dir, validate=True, derivatives=False)
+    images = layout.get(
+        datatype="anat", suffix="T1w", extension=[".nii", ".nii.gz"]
+    )
+    elapsed = time.perf_counter() - start
+    return elapsed, len(images)
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--n_subjects", type=int, default=200)
+    parser.add_argument("--n_sessions", type=int, default=2)
+    parser.add_argument("--n_other_files", type=int, default=30)
+    parser.add_argument("--n_jobs", type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        bids_dir = make_dataset(
+            Path(tmp) / "bids",
+            n_subjects=args.n_subjects,
+            n_sessions=args.n_sessions,
+            shape=(4, 4, 4),
+            n_other_files=args.n_other_files,
+        )
+        n_files = sum(1 for x in bids_dir.rglob("*") if x.is_file())
+        print(f"dataset with {n_files} files")
+
+        for n_jobs in sorted({1, args.n_jobs}):
+            elapsed, n_images = time_scanner(bids_dir, n_jobs=n_jobs)
+            print(
+                f"scanner (n_jobs={n_jobs}): "
+                f"{elapsed:.3f} s for {n_images} images"
+            )
+
+        elapsed, n_images = time_pybids(bids_dir)
+        print(f"pybids: {elapsed:.3f} s for {n_images} images")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""Time the aggregation of CAT12 reports at the group level.
+
+Writes the ``report`` and ``label`` XML files of many participants
+like the stub standalone does, then aggregates them twice:
+the second run should only read the cache.
+
+Usage::
+
+    python benchmarks/bench_group.py --n_subjects 10000 --n_jobs 8
+"""
+
+from __future__ import annotations
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+from cat12.group import aggregate
+
+N_ROIS = 136
+
+REPORT = """<?xml version="1.0" encoding="utf-8"?>
+<S>
+  <subjectmeasures>
+    <vol_TIV>{tiv}</vol_TIV>
+    <vol_abs_CGW>[300.1 700.2 500.3 0 0]</vol_abs_CGW>
+    <vol_rel_CGW>[0.2 0.46667 0.33333 0 0]</vol_rel_CGW>
+  </subjectmeasures>
+  <qualityratings>
+    <IQR>2.5</IQR>
+  </qualityratings>
+</S>
+"""
+
+
+def roi_file(n_rois: int) -> str:
+    """Return a ROI file with one atlas of ``n_rois`` regions."""
+    ids = ";".join(str(i) for i in range(n_rois))
+    names = "".join(f"<item>region {i}</item>" for i in range(n_rois))
+    values = ";".join(f"{i / n_rois:.5f}" for i in range(n_rois))
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        f"<S><neuromorphometrics><ids>[{ids}]</ids><names>{names}</names>"
+        f"<data><Vgm>[{values}]</Vgm><Vwm>[{values}]</Vwm>"
+        f"<Vcsf>[{values}]</Vcsf></data></neuromorphometrics></S>\n"
+    )
+
+
+def make_outputs(output_dir: Path, n_subjects: int) -> None:
+    """Write the XML reports of ``n_subjects`` participants."""
+    roi = roi_file(N_ROIS)
+    for sub in range(1, n_subjects + 1):
+        stem = f"sub-{sub:05d}_T1w"
+        anat = output_dir / f"sub-{sub:05d}" / "anat"
+        (anat / "report").mkdir(parents=True)
+        (anat / "label").mkdir()
+        (anat / "report" / f"cat_{stem}.xml").write_text(
+            REPORT.format(tiv=1400 + sub % 200)
+        )
+        (anat / "label" / f"catROI_{stem}.xml").write_text(roi)
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--n_subjects", type=int, default=10000)
+    parser.add_argument("--n_jobs", type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        output_dir = Path(tmp)
+        make_outputs(output_dir, args.n_subjects)
+
+        for run in ("cold", "cached"):
+            start = time.perf_counter()
+            aggregate(output_dir, n_jobs=args.n_jobs)
+            print(
+                f"{run}: {time.perf_counter() - start:.2f} s "
+                f"for {args.n_subjects} participants"
+            )
+
+
+if __name__ == "__main__":
+    main()
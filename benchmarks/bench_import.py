@@ -0,0 +1,95 @@
+"""Check that the command line of the app starts fast.
+
+Imports ``cat12.main`` in a fresh interpreter with ``python -X importtime``
+and fails (exit code 1) when:
+
+- the import takes longer than the budget,
+- or a heavy dependency (nibabel, numpy, pybids, jinja2, rich...)
+  is imported although only the code paths that use it should import it.
+
+The slowest modules are printed to find what regressed.
+
+Usage::
+
+    python benchmarks/bench_import.py --budget 300
+"""
+
+from __future__ import annotations
+
+import argparse
+import subprocess
+import sys
+
+# only imported by the code paths that use them
+HEAVY_MODULES = (
+    "bids",
+    "jinja2",
+    "nibabel",
+    "numpy",
+    "rich.console",
+    "rich.traceback",
+    "scipy",
+    "sqlalchemy",
+)
+
+
+def import_times(module: str) -> dict[str, tuple[int, int]]:
+    """Return the self and cumulative import time in us of each module."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_time, cumulative, name = line[len("import time:") :].split("|")
+        times[name.strip()] = (int(self_time), int(cumulative))
+    return times
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=300,
+        help="Maximum import time of cat12.main in ms.",
+    )
+    parser.add_argument("--n_runs", type=int, default=5)
+    parser.add_argument("--n_slowest", type=int, default=10)
+    args = parser.parse_args()
+
+    # the best of several runs: the first one may read a cold disk
+    runs = [import_times("cat12.main") for _ in range(args.n_runs)]
+    times = min(runs, key=lambda x: x["cat12.main"][1])
+    total = times["cat12.main"][1] / 1000
+
+    print(f"import cat12.main: {total:.0f} ms (budget {args.budget:.0f} ms)")
+    print("slowest modules (cumulative ms):")
+    top_level = sorted(times.items(), key=lambda x: x[1][1], reverse=True)[
+        1 : args.n_slowest + 1
+    ]
+    for name, (_, cumulative) in top_level:
+        print(f"  {cumulative / 1000:8.1f}  {name}")
+
+    heavy = [
+        name
+        for name in times
+        if name.split(".")[0] in HEAVY_MODULES or name in HEAVY_MODULES
+    ]
+    failed = False
+    if heavy:
+        print(f"heavy modules imported at start up: {sorted(heavy)[:10]}")
+        failed = True
+    if total > args.budget:
+        print(f"over budget by {total - args.budget:.0f} ms")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+"""Time the native engine of get_TIV and get_ROI_values.
+
+Writes the modulated gray and white matter maps of many participants
+on the grid of the CAT12 templates (1.5 mm) and an atlas,
+then computes the volume of each region:
+
+- with the native engine (``cat12.roi``),
+- with one mask per region, like a loop over the regions would,
+
+and checks that both agree.
+
+With ``--output_dir`` the native engine is run on a real CAT12 output
+dataset instead and its volumes are compared to the values of the
+``label/catROI_*.xml`` and ``report/cat_*.xml`` files written by CAT12.
+CAT12 computes them in native space and the engine in template space,
+so they are not identical: the benchmark fails (exit code 1)
+when the median relative difference of a table exceeds ``--tolerance``.
+The means of the regions (``mean_mwp1``, ``mean_mwp2``) are not compared
+as CAT12 has no equivalent.
+
+Usage::
+
+    python benchmarks/bench_roi.py --n_subjects 50 --n_jobs 4
+    python benchmarks/bench_roi.py --output_dir out/CAT12_x --atlas_dir atlases
+"""
+
+from __future__ import annotations
+
+import argparse
+import csv
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+
+from cat12.group import aggregate
+from cat12.postprocessing import find_derivatives
+from cat12.roi import GM_MAPS, find_atlases, write_rois, write_tiv
+
+# grid of the CAT12 templates at 1.5 mm
+SHAPE = (113, 137, 113)
+AFFINE = np.array(
+    [
+        [1.5, 0, 0, -84],
+        [0, 1.5, 0, -120],
+        [0, 0, 1.5, -72],
+        [0, 0, 0, 1],
+    ]
+)
+N_ROIS = 136
+
+
+def make_outputs(output_dir: Path, atlas_dir: Path, n_subjects: int) -> None:
+    """Write an atlas and the maps of ``n_subjects`` participants."""
+    rng = np.random.default_rng(0)
+    atlas_dir.mkdir(parents=True)
+    labels = rng.integers(0, N_ROIS + 1, SHAPE).astype(np.uint8)
+    nib.save(nib.Nifti1Image(labels, AFFINE), atlas_dir / "synthetic.nii")
+    with (atlas_dir / "synthetic.csv").open("w") as f:
+        f.write("ROIid;ROIabbr;ROIname\n")
+        f.writelines(f"{i};r{i};region {i}\n" for i in range(1, N_ROIS + 1))
+
+    for sub in range(1, n_subjects + 1):
+        mri = output_dir / f"sub-{sub:04d}" / "anat" / "mri"
+        mri.mkdir(parents=True)
+        for prefix in ("mwp1", "mwp2"):
+            data = rng.random(SHAPE, dtype=np.float32)
+            nib.save(
+                nib.Nifti1Image(data, AFFINE),
+                mri / f"{prefix}sub-{sub:04d}_T1w.nii",
+            )
+
+
+def masked_volumes(gm_map: str, atlas: Path) -> np.ndarray:
+    """Compute the gray matter volume of each region with one mask each."""
+    img = nib.load(gm_map)
+    data = img.get_fdata()
+    labels = np.asanyarray(nib.load(atlas).dataobj)
+    voxel_volume = np.prod(img.header.get_zooms()[:3])
+    return np.array(
+        [
+            data[labels == i].sum() * voxel_volume / 1000
+            for i in range(1, N_ROIS + 1)
+        ]
+    )
+
+
+def read_table(path: Path) -> dict[str, dict[str, float]]:
+    """Read a group table as a map of sources to a map of columns to values."""
+    with path.open(newline="") as f:
+        rows = csv.DictReader(f, delimiter="\t")
+        return {
+            row["source"]: {
+                key: float(value)
+                for key, value in row.items()
+                if key not in ("participant_id", "session_id", "source")
+                and value != "n/a"
+            }
+            for row in rows
+        }
+
+
+def compare(native: Path, reference: Path, tolerance: float) -> bool:
+    """Print the relative differences between two group tables.
+
+    :return: False if the median relative difference exceeds ``tolerance``.
+    """
+    if not native.exists() or not reference.exists():
+        print(f"{native.name}: no table to compare")
+        return True
+    left = read_table(native)
+    right = read_table(reference)
+    diffs = [
+        abs(value - right[source][key]) / max(abs(right[source][key]), 1e-6)
+        for source, row in left.items()
+        if source in right
+        for key, value in row.items()
+        if key in right[source]
+    ]
+    if not diffs:
+        print(f"{native.name}: no common image and column")
+        return True
+    median = np.median(diffs)
+    passed = median <= tolerance
+    print(
+        f"{native.name}: {len(diffs)} values, "
+        f"max relative difference {max(diffs):.2e}, "
+        f"median {median:.2e} "
+        f"({'ok' if passed else 'FAILED'}, tolerance {tolerance:.2e})"
+    )
+    return passed
+
+
+def check_outputs(
+    output_dir: Path, atlas_dir: Path, n_jobs: int, tolerance: float
+) -> bool:
+    """Compare the volumes of the native engine to those of CAT12.
+
+    :return: False if a table differs by more than ``tolerance``.
+    """
+    gm_maps = find_derivatives(output_dir, GM_MAPS)
+    atlases = find_atlases(atlas_dir)
+    group_dir = output_dir / "group"
+
+    start = time.perf_counter()
+    write_tiv(gm_maps, group_dir / "native", n_jobs=n_jobs)
+    write_rois(gm_maps, atlases, group_dir / "native", n_jobs=n_jobs)
+    print(
+        f"native: {time.perf_counter() - start:.2f} s "
+        f"for {len(gm_maps)} images and {len(atlases)} atlases"
+    )
+
+    aggregate(output_dir, n_jobs=n_jobs)
+    names = ["volumes.tsv"] + [
+        f"roi_atlas-{atlas.name}_{measure}.tsv"
+        for atlas in atlases
+        # mean_mwp1 and mean_mwp2 have no equivalent in CAT12
+        for measure in ("Vgm", "Vwm")
+    ]
+    results = [
+        compare(group_dir / "native" / name, group_dir / name, tolerance)
+        for name in names
+    ]
+    return all(results)
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--n_subjects", type=int, default=20)
+    parser.add_argument("--n_jobs", type=int, default=4)
+    parser.add_argument(
+        "--output_dir",
+        type=Path,
+        help="CAT12 output dataset to compare the native engine to.",
+    )
+    parser.add_argument(
+        "--atlas_dir",
+        type=Path,
+        help="Atlases used with --output_dir.",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.05,
+        help="""
+        Median relative difference accepted between the volumes
+        of the native engine and those of CAT12 with --output_dir.
+        """,
+    )
+    args = parser.parse_args()
+
+    if args.output_dir is not None:
+        if not check_outputs(
+            args.output_dir, args.atlas_dir, args.n_jobs, args.tolerance
+        ):
+            sys.exit(1)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        output_dir = Path(tmp) / "outputs"
+        atlas_dir = Path(tmp) / "atlases"
+        make_outputs(output_dir, atlas_dir, args.n_subjects)
+        gm_maps = find_derivatives(output_dir, GM_MAPS)
+        atlases = find_atlases(atlas_dir)
+
+        start = time.perf_counter()
+        write_rois(gm_maps, atlases, output_dir / "group", n_jobs=args.n_jobs)
+        native = time.perf_counter() - start
+        print(f"native: {native:.2f} s for {len(gm_maps)} images")
+
+        start = time.perf_counter()
+        expected = [
+            masked_volumes(x, atlas_dir / "synthetic.nii") for x in gm_maps
+        ]
+        masked = time.perf_counter() - start
+        print(
+            f"one mask per region: {masked:.2f} s "
+            f"({masked / native:.1f} times slower)"
+        )
+
+        table = read_table(
+            output_dir / "group" / "roi_atlas-synthetic_Vgm.tsv"
+        )
+        values = np.array([list(row.values()) for row in table.values()])
+        difference = np.abs(values - np.array(expected)).max()
+        print(f"max difference: {difference:.2e} cm3 (rounding of the TSV)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+"""Measure the throughput and memory of each stage of a run.
+
+Stages measured in process on a synthetic dataset:
+
+- ``index_scanner``: finding T1w images with :func:`cat12.scanner.find_t1w`,
+- ``index_pybids``: indexing the dataset with a pybids database
+  (only with ``--pybids``),
+- ``stage``: staging the images with :func:`cat12.staging.stage_files`,
+- ``compress``: compressing the staged images
+  with :func:`cat12.compression.compress_niftis`.
+
+The whole ``segment`` command is then run against the stub standalone
+and the steps recorded in its ``logs/resources.tsv`` are reported
+(``run_copy``, ``run_segment``, ``run_compress``),
+so the overhead of supervising the CAT12 processes shows up
+in the ``run_segment`` wall time minus the time the stub sleeps.
+
+Memory is the peak of the Python heap for the stages run in process
+and the peak RSS for the stages of the ``segment`` command.
+
+Save the results with ``--json`` to compare them across commits.
+
+Usage::
+
+    python benchmarks/bench_stages.py --n_subjects 20 --shape 128 128 128
+    python benchmarks/bench_stages.py --no-gz --n_jobs 4 --json results.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import csv
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from synthetic import make_dataset
+
+from cat12.compression import compress_niftis
+from cat12.scanner import find_t1w
+from cat12.staging import stage_files, staged_path
+
+STUB = Path(__file__).parent / "stub_standalone"
+
+
+def measure(name: str, n_images: int, n_bytes: int, func, *args, **kwargs):
+    """Run a stage in process and return its measures and result."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    wall_time = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return stage_row(
+        name, n_images, n_bytes, wall_time, peak / 1024**2
+    ), result
+
+
+def stage_row(
+    name: str,
+    n_images: int,
+    n_bytes: float,
+    wall_time: float,
+    memory: float | None,
+) -> dict:
+    """Return the measures of a stage."""
+    return {
+        "stage": name,
+        "n_images": n_images,
+        "wall_time": round(wall_time, 3),
+        "images_per_s": round(n_images / wall_time, 1) if wall_time else None,
+        "mb_per_s": (
+            round(n_bytes / 1024**2 / wall_time, 1) if wall_time else None
+        ),
+        "memory_mb": None if memory is None else round(memory, 1),
+    }
+
+
+def run_segment(bids_dir: Path, output_dir: Path, n_jobs: int) -> list[dict]:
+    """Run the segment command and return the stages of its resources log."""
+    env = {
+        **os.environ,
+        "STANDALONE": str(STUB),
+        "STUB_STARTUP_SECONDS": "0",
+        "STUB_IMAGE_SECONDS": "0",
+    }
+    cmd = [
+        sys.executable,
+        "-m",
+        "cat12.main",
+        str(bids_dir),
+        str(output_dir),
+        "participant",
+        "segment",
+        "--skip_validation",
+        "--verbose",
+        "0",
+        "--n_jobs",
+        str(n_jobs),
+    ]
+    start = time.perf_counter()
+    subprocess.run(cmd, env=env, check=True, stdout=subprocess.DEVNULL)
+    wall_time = time.perf_counter() - start
+    max_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+    (tsv,) = output_dir.glob("CAT12_*/logs/resources.tsv")
+    with tsv.open() as f:
+        rows = list(csv.DictReader(f, delimiter="\t"))
+
+    stages = []
+    for step in ("copy", "segment", "compress"):
+        step_rows = [row for row in rows if row["step"] == step]
+        n_images = sum(int(row["n_images"]) for row in step_rows)
+        # rows of participants processed by the same call are identical
+        calls = {
+            (row["start"], row["wall_time"], row["n_participants"]): row
+            for row in step_rows
+        }.values()
+        step_time = sum(float(row["wall_time"]) for row in calls)
+        n_bytes = sum(
+            float(row[key]) * 1024**2
+            for row in calls
+            for key in ("read", "written")
+            if row[key] != "n/a"
+        )
+        peak = max(
+            (
+                float(row["peak_rss"])
+                for row in calls
+                if row["peak_rss"] != "n/a"
+            ),
+            default=None,
+        )
+        stages.append(
+            stage_row(f"run_{step}", n_images, n_bytes, step_time, peak)
+        )
+    stages.append(stage_row("run_total", 0, 0, wall_time, max_rss))
+    return stages
+
+
+def print_table(rows: list[dict]) -> None:
+    """Print the measures of each stage."""
+    widths = {
+        col: max(len(col), *(len(str(row[col])) for row in rows))
+        for col in rows[0]
+    }
+    print("  ".join(col.ljust(w) for col, w in widths.items()))
+    for row in rows:
+        print("  ".join(str(row[col]).ljust(w) for col, w in widths.items()))
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--n_subjects", type=int, default=20)
+    parser.add_argument("--n_sessions", type=int, default=1)
+    parser.add_argument(
+        "--shape", type=int, nargs=3, default=[64, 64, 64], metavar="N"
+    )
+    parser.add_argument(
+        "--gz", action=argparse.BooleanOptionalAction, default=True
+    )
+    parser.add_argument("--n_jobs", type=int, default=1)
+    parser.add_argument(
+        "--pybids", action="store_true", help="Also time pybids indexing."
+    )
+    parser.add_argument("--json", type=Path, help="Save the results.")
+    args = parser.parse_args()
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        bids_dir = make_dataset(
+            tmp / "bids",
+            n_subjects=args.n_subjects,
+            n_sessions=args.n_sessions,
+            shape=tuple(args.shape),
+            gz=args.gz,
+        )
+
+        row, inputs = measure(
+            "index_scanner", 0, 0, find_t1w, bids_dir, n_jobs=args.n_jobs
+        )
+        images = [image for bf in inputs.values() for image in bf]
+        row = stage_row(
+            "index_scanner", len(images), 0, row["wall_time"], row["memory_mb"]
+        )
+        rows.append(row)
+
+        if args.pybids:
+            from cat12.bids_utils import get_dataset_layout
+
+            row, _ = measure(
+                "index_pybids",
+                len(images),
+                0,
+                get_dataset_layout,
+                bids_dir,
+                use_database=True,
+                database_dir=tmp / ".pybids",
+            )
+            rows.append(row)
+
+        staged = tmp / "staged"
+        files = [
+            (Path(image.path), staged_path(staged, image.relpath))
+            for image in images
+        ]
+        input_bytes = sum(src.stat().st_size for src, _ in files)
+        row, _ = measure(
+            "stage",
+            len(files),
+            input_bytes,
+            stage_files,
+            files,
+            n_jobs=args.n_jobs,
+        )
+        rows.append(row)
+
+        staged_bytes = sum(dst.stat().st_size for _, dst in files)
+        row, _ = measure(
+            "compress",
+            len(files),
+            staged_bytes,
+            compress_niftis,
+            staged,
+            n_jobs=args.n_jobs,
+        )
+        rows.append(row)
+        shutil.rmtree(staged)
+
+        rows.extend(run_segment(bids_dir, tmp / "output", n_jobs=args.n_jobs))
+
+    print(
+        f"{args.n_subjects} subjects x {args.n_sessions} sessions, "
+        f"shape {tuple(args.shape)}, gz={args.gz}, n_jobs={args.n_jobs}"
+    )
+    print_table(rows)
+
+    if args.json:
+        with args.json.open("w") as f:
+            json.dump(
+                {"options": vars(args) | {"json": None}, "stages": rows},
+                f,
+                indent=4,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env bash
+# Stub of the CAT12 standalone script for benchmarks.
+#
+# Mimics the command line of cat_standalone.sh:
+#
+#   cat_standalone.sh file1.nii [file2.nii ...] -b batch.m [-a1 arg ...]
+#
+# It waits STUB_STARTUP_SECONDS to simulate the start up of the MATLAB runtime
+# (plus STUB_EXTRACT_SECONDS when its cache MCR_CACHE_ROOT is empty)
+# and STUB_IMAGE_SECONDS per image to simulate the processing,
+# prints STUB_LOG_LINES lines of progress per image like CAT12 does,
+# and writes outputs named like the ones CAT12 writes next to each input.
+# Post-processing batches (get_TIV, get_IQR, get_quality, get_ROI_values)
+# write one line per input to the table passed as -a1
+# and resample writes a smoothed surface next to each input.
+# Images whose path contains STUB_FAIL_PATTERN fail like CAT12 does:
+# an error is printed, the next images are processed
+# and the call exits with an error.
+
+set -e
+
+STUB_STARTUP_SECONDS=${STUB_STARTUP_SECONDS:-2}
+STUB_IMAGE_SECONDS=${STUB_IMAGE_SECONDS:-0.1}
+STUB_LOG_LINES=${STUB_LOG_LINES:-50}
+STUB_EXTRACT_SECONDS=${STUB_EXTRACT_SECONDS:-3}
+STUB_FAIL_PATTERN=${STUB_FAIL_PATTERN:-}
+
+# the runtime extracts its archive in MCR_CACHE_ROOT on its first run
+extract_ctf() {
+    cache=${MCR_CACHE_ROOT:-${HOME}/.mcrCache9.3}
+    if [ ! -f "${cache}/spm12_mcr/extracted" ]; then
+        echo "Extracting CTF archive in ${cache} (stub)"
+        sleep "${STUB_EXTRACT_SECONDS}"
+        mkdir -p "${cache}/spm12_mcr"
+        touch "${cache}/spm12_mcr/extracted"
+    fi
+}
+
+if [ $# -eq 0 ]; then
+    echo "Usage: cat_standalone.sh filenames -b batch_file [-a1 arg1 ...]"
+    exit 0
+fi
+
+files=()
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -b)
+            batch="$2"
+            shift 2
+            ;;
+        -a1)
+            arg1="$2"
+            shift 2
+            ;;
+        -a*)
+            shift 2
+            ;;
+        *)
+            files+=("$1")
+            shift
+            ;;
+    esac
+done
+
+echo "Starting MATLAB runtime (stub) for batch ${batch}"
+sleep "${STUB_STARTUP_SECONDS}"
+extract_ctf
+
+n=${#files[@]}
+i=0
+
+case "$(basename "${batch}")" in
+    cat_standalone_get_*.m | cat_standalone_resample.m)
+        table=${arg1}
+        case "$(basename "${batch}")" in
+            *get_ROI_values.m)
+                table="${arg1}_neuromorphometrics_Vgm.csv"
+                echo "names,3rd Ventricle,4th Ventricle" > "${table}"
+                ;;
+            *get_quality.m)
+                echo "names,mean_correlation,mahalanobis_distance" > "${table}"
+                ;;
+        esac
+        for file in "${files[@]}"; do
+            i=$((i + 1))
+            if [ ! -f "${file}" ]; then
+                echo "ERROR: ${file} not found"
+                exit 1
+            fi
+            echo "CAT12 (stub): ${i}/${n}: ${file}"
+            sleep "${STUB_IMAGE_SECONDS}"
+            case "$(basename "${batch}")" in
+                *resample.m)
+                    name=$(basename "${file}")
+                    cp "${file}" "$(dirname "${file}")/s${arg1}.mesh.${name#lh.}.resampled_32k.gii"
+                    ;;
+                *)
+                    echo "${file},0.${i},1.${i}" >> "${table}"
+                    ;;
+            esac
+        done
+        exit 0
+        ;;
+esac
+
+for file in "${files[@]}"; do
+    i=$((i + 1))
+    if [ ! -f "${file}" ]; then
+        echo "ERROR: ${file} not found"
+        exit 1
+    fi
+    dir=$(dirname "${file}")
+    name=$(basename "${file}")
+    stem=${name%.nii}
+
+    echo "CAT12 (stub): ${i}/${n}: ${file}"
+    for ((line = 1; line <= STUB_LOG_LINES; line++)); do
+        printf "%-60s %6ds\n" "  step ${line}/${STUB_LOG_LINES}: processing" "${line}"
+    done
+    sleep "${STUB_IMAGE_SECONDS}"
+
+    if [ -n "${STUB_FAIL_PATTERN}" ] && [[ "${file}" == *"${STUB_FAIL_PATTERN}"* ]]; then
+        echo "CAT12 (stub): error processing ${file}"
+        failed=1
+        continue
+    fi
+
+    mkdir -p "${dir}/mri" "${dir}/report" "${dir}/label"
+    for prefix in p1 p2 p3 mwp1 mwp2 wm; do
+        cp "${file}" "${dir}/mri/${prefix}${name}"
+        echo "  writing mri/${prefix}${name}"
+    done
+    cat > "${dir}/report/cat_${stem}.xml" <<XML
+<?xml version="1.0" encoding="utf-8"?>
+<S>
+  <subjectmeasures>
+    <vol_TIV>1500.${i}</vol_TIV>
+    <vol_abs_CGW>[300.1 700.2 500.3 0 0]</vol_abs_CGW>
+    <vol_rel_CGW>[0.2 0.46667 0.33333 0 0]</vol_rel_CGW>
+  </subjectmeasures>
+  <qualityratings>
+    <IQR>2.${i}</IQR>
+  </qualityratings>
+</S>
+XML
+    cat > "${dir}/label/catROI_${stem}.xml" <<XML
+<?xml version="1.0" encoding="utf-8"?>
+<S>
+  <neuromorphometrics>
+    <ids>[4;11;23]</ids>
+    <names>
+      <item>3rd Ventricle</item>
+      <item>4th Ventricle</item>
+      <item>Right Accumbens Area</item>
+    </names>
+    <data>
+      <Vgm>[0.1;0.2;0.3]</Vgm>
+      <Vwm>[0.4;0.5;0.6]</Vwm>
+    </data>
+  </neuromorphometrics>
+</S>
+XML
+    echo "CAT12 (stub): done ${i}/${n}"
+done
+
+if [ -n "${failed:-}" ]; then
+    exit 1
+fi
@@ -0,0 +1 @@
+% Stub of cat_standalone_get_IQR.m used for benchmarks.
@@ -0,0 +1 @@
+% Stub of cat_standalone_get_ROI_values.m used for benchmarks.
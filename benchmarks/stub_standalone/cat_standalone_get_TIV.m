@@ -0,0 +1 @@
+% Stub of cat_standalone_get_TIV.m used for benchmarks.
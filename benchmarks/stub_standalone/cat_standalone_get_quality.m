@@ -0,0 +1 @@
+% Stub of cat_standalone_get_quality.m used for benchmarks.
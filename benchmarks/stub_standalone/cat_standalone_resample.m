@@ -0,0 +1 @@
+% Stub of cat_standalone_resample.m used for benchmarks.
@@ -0,0 +1 @@
+% Stub of cat_standalone_segment.m used for benchmarks.
@@ -0,0 +1 @@
+% Stub of cat_standalone_segment_enigma.m used for benchmarks.
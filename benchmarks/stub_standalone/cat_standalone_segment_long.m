@@ -0,0 +1 @@
+% Stub of cat_standalone_segment_long.m used for benchmarks.
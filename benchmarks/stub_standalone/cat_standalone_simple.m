@@ -0,0 +1 @@
+% Stub of cat_standalone_simple.m used for benchmarks.
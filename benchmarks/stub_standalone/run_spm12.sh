@@ -0,0 +1,21 @@
+#!/usr/bin/env bash
+# Stub of the SPM12 standalone launcher for benchmarks.
+#
+#   run_spm12.sh mcr_root --version
+#
+# Extracts its archive in MCR_CACHE_ROOT like the MATLAB runtime does
+# (waiting STUB_EXTRACT_SECONDS) and prints a version.
+
+set -e
+
+STUB_EXTRACT_SECONDS=${STUB_EXTRACT_SECONDS:-3}
+
+cache=${MCR_CACHE_ROOT:-${HOME}/.mcrCache9.3}
+if [ ! -f "${cache}/spm12_mcr/extracted" ]; then
+    echo "Extracting CTF archive in ${cache} (stub)"
+    sleep "${STUB_EXTRACT_SECONDS}"
+    mkdir -p "${cache}/spm12_mcr"
+    touch "${cache}/spm12_mcr/extracted"
+fi
+
+echo "SPM12 (stub)"
@@ -0,0 +1,75 @@
+"""Generate synthetic BIDS datasets for benchmarks."""
+
+from __future__ import annotations
+
+import json
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+
+
+def make_dataset(
+    root: str | Path,
+    n_subjects: int = 10,
+    n_sessions: int = 1,
+    shape: tuple[int, int, int] = (32, 32, 32),
+    gz: bool = True,
+    n_other_files: int = 0,
+) -> Path:
+    """Write a BIDS dataset with one T1w image per session.
+
+    :param root: Where to write the dataset.
+    :type root: Union[str, Path]
+
+    :param n_subjects: Number of subjects.
+    :type n_subjects: int
+
+    :param n_sessions: Number of sessions per subject.
+        No session level is used when equal to 1.
+    :type n_sessions: int
+
+    :param shape: Dimensions of each T1w volume.
+    :type shape: tuple[int, int, int]
+
+    :param gz: Compress the images.
+    :type gz: bool
+
+    :param n_other_files: Number of empty func files (and their sidecars)
+        to add to each session to mimic datasets with many other modalities.
+    :type n_other_files: int
+
+    :return: Path to the dataset.
+    :rtype: Path
+    """
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+
+    with (root / "dataset_description.json").open("w") as f:
+        json.dump({"Name": "synthetic", "BIDSVersion": "1.9.0"}, f)
+
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 1000, size=shape, dtype=np.int16)
+    img = nib.Nifti1Image(data, np.diag([1.0, 1.0, 1.0, 1.0]))
+    img.header.set_xyzt_units("mm")
+    extension = ".nii.gz" if gz else ".nii"
+
+    for sub in range(1, n_subjects + 1):
+        for ses in range(1, n_sessions + 1):
+            entities = [f"sub-{sub:04d}"]
+            anat = root / f"sub-{sub:04d}"
+            if n_sessions > 1:
+                entities.append(f"ses-{ses:02d}")
+                anat = anat / f"ses-{ses:02d}"
+            anat = anat / "anat"
+            anat.mkdir(parents=True, exist_ok=True)
+            nib.save(img, anat / f"{'_'.join(entities)}_T1w{extension}")
+
+            func = anat.parent / "func"
+            func.mkdir(exist_ok=True)
+            for run in range(1, n_other_files // 2 + 1):
+                stem = f"{'_'.join(entities)}_task-rest_run-{run:03d}_bold"
+                (func / f"{stem}.nii.gz").touch()
+                (func / f"{stem}.json").write_text('{"RepetitionTime": 2}')
+
+    return root
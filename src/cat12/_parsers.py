@@ -1,10 +1,16 @@
 from __future__ import annotations
 
-from argparse import ArgumentParser, HelpFormatter
+from argparse import ArgumentParser, ArgumentTypeError, HelpFormatter
 
 from cat12._version import __version__
 
-from cat12.defaults import CAT_VERSION, MCR_VERSION, supported_batches
+from cat12.defaults import (
+    ATLAS_DIR,
+    CAT_VERSION,
+    MCR_VERSION,
+    supported_batches,
+)
+from cat12.postprocessing import BATCHES
 
 
 def _base_parser(
@@ -55,7 +61,7 @@ Fullpath to the directory where the output files will be stored.
     return parser
 
 
-def _add_common_arguments(parser: ArgumentParser) -> ArgumentParser:
+def _add_participant_label(parser: ArgumentParser) -> ArgumentParser:
     parser.add_argument(
         "--participant_label",
         help="""
@@ -69,12 +75,22 @@ Multiple participants can be specified with a space separated list.
         nargs="+",
         required=False,
     )
+    return parser
+
+
+def _add_common_arguments(parser: ArgumentParser) -> ArgumentParser:
+    parser = _add_participant_label(parser)
     parser = _add_verbose(parser)
     parser.add_argument(
         "--bids_filter_file",
         help="""
-A JSON file describing custom BIDS input filters using PyBIDS.
-For further details, please check out TBD.
+A JSON file with the BIDS entities of the T1w images to process,
+for example ``{"t1w": {"session": "1", "acquisition": "mprage"}}``.
+A value can be a list of accepted values,
+``null`` for images without this entity
+or ``"*"`` for images with any value.
+Filters using ``regex_search`` or other entities than those of the file names
+are resolved with PyBIDS.
         """,
         required=False,
     )
@@ -84,6 +100,18 @@ For further details, please check out TBD.
         action="store_true",
         required=False,
     )
+    parser.add_argument(
+        "--validation_scope",
+        help="""
+Validate only the top level files and the participants to process,
+or the whole dataset.
+Participants already validated by a previous run are not validated again.
+        """,
+        choices=["participants", "dataset"],
+        default="participants",
+        type=str,
+        nargs=1,
+    )
     return parser
 
 
@@ -115,6 +143,373 @@ def _add_verbose(parser):
     return parser
 
 
+def _add_n_jobs(parser, help_text: str | None = None):
+    parser.add_argument(
+        "--n_jobs",
+        "--n_cpus",
+        help=help_text
+        or """
+        Number of participants to process in parallel.
+        Each participant gets its own log file
+        and the output of CAT12 is not printed to the terminal
+        when more than 1 job is used.
+        """,
+        dest="n_jobs",
+        default=1,
+        type=int,
+        nargs=1,
+    )
+    return parser
+
+
+def _threads(value: str) -> int | str:
+    if value == "auto":
+        return value
+    try:
+        threads = int(value)
+    except ValueError:
+        threads = 0
+    if threads < 1:
+        raise ArgumentTypeError(
+            f"must be a positive integer or 'auto', got {value!r}"
+        )
+    return threads
+
+
+def _add_threads(parser):
+    parser.add_argument(
+        "--threads_per_job",
+        help="""
+        Number of CPUs of each CAT12 process.
+        Each process is pinned to its own CPUs
+        and the thread count variables (``OMP_NUM_THREADS``...) are set.
+        Defaults to an equal share of the CPUs available
+        (limited by the CPU affinity, the cgroup quota
+        and ``SLURM_CPUS_PER_TASK``).
+        With ``auto``, the number of CPUs
+        that processed most images per hour in the previous runs is used
+        and as many jobs as fit on the available CPUs are run.
+        """,
+        type=_threads,
+        nargs=1,
+    )
+    return parser
+
+
+def _add_compression(parser):
+    parser.add_argument(
+        "--no_compress",
+        help="Do not gzip the images written by CAT12.",
+        action="store_true",
+        required=False,
+    )
+    parser.add_argument(
+        "--compression_level",
+        help="gzip compression level of the images written by CAT12.",
+        choices=range(10),
+        default=1,
+        type=int,
+        nargs=1,
+    )
+    parser.add_argument(
+        "--gzip_block_size",
+        help="""
+        Size in MB of the blocks used to compress big images in parallel
+        (like ``pigz``).
+        Set to 0 to compress each image as a single stream.
+        """,
+        default=0,
+        type=int,
+        nargs=1,
+    )
+    return parser
+
+
+def _add_mcr_cache(parser):
+    parser.add_argument(
+        "--mcr_cache_dir",
+        help="""
+        Folder of the caches of the MATLAB runtime.
+        Each parallel job gets its own cache in this folder,
+        extracted once and reused across runs.
+        Defaults to ``CAT12_MCR_CACHE_DIR`` if set
+        or to a folder in ``TMPDIR``: use node-local storage.
+        """,
+        type=str,
+        nargs=1,
+    )
+    return parser
+
+
+def _add_engine(parser):
+    parser.add_argument(
+        "--engine",
+        help="""
+        Compute the values with CAT12,
+        or (experimental) with NumPy from the modulated gray and white
+        matter maps without starting the MATLAB runtime
+        (tables in ``group/native``).
+        The native values are computed in template space:
+        they approximate the volumes of CAT12 but are not identical.
+        """,
+        choices=["cat12", "native"],
+        default="cat12",
+        type=str,
+        nargs=1,
+    )
+    return parser
+
+
+def _add_atlas(parser):
+    parser.add_argument(
+        "--atlas",
+        help="""
+        Atlases to compute the values of with ``--engine native``.
+        Defaults to all the atlases of ``--atlas_dir`` with region names.
+        """,
+        type=str,
+        nargs="+",
+    )
+    parser.add_argument(
+        "--atlas_dir",
+        help="""
+        Folder of the atlases (``<atlas>.nii`` and ``<atlas>.csv``)
+        used by ``--engine native``.
+        Defaults to ``CAT12_ATLAS_DIR`` if set
+        or to the templates of the CAT12 toolbox.
+        """,
+        default=[ATLAS_DIR],
+        type=str,
+        nargs=1,
+    )
+    return parser
+
+
+def _add_sharding(parser):
+    parser.add_argument(
+        "--shard_index",
+        help="""
+        Index (from 0) of the shard of participants to process.
+        Read from ``SLURM_ARRAY_TASK_ID`` in SLURM array jobs.
+        """,
+        type=int,
+        nargs=1,
+    )
+    parser.add_argument(
+        "--shard_count",
+        help="""
+        Split the participants in this many shards
+        balanced by the estimated cost of their images
+        and only process the shard ``--shard_index``.
+        Read from ``SLURM_ARRAY_TASK_COUNT`` in SLURM array jobs.
+        """,
+        type=int,
+        nargs=1,
+    )
+    return parser
+
+
+def _add_plan_arguments(parser):
+    parser.add_argument(
+        "--scheduler",
+        help="Scheduler of the cluster.",
+        choices=["slurm", "pbs"],
+        default="slurm",
+        type=str,
+        nargs=1,
+    )
+    parser.add_argument(
+        "--time",
+        help="Wall time requested for each task (for example ``24:00:00``).",
+        type=str,
+        nargs=1,
+    )
+    parser.add_argument(
+        "--cpus",
+        help="Number of CPUs requested for each task.",
+        type=int,
+        nargs=1,
+    )
+    parser.add_argument(
+        "--mem",
+        help="Memory requested for each task (for example ``16G``).",
+        type=str,
+        nargs=1,
+    )
+    parser.add_argument(
+        "--executable",
+        help="""
+        Command to run the app in each task,
+        for example ``"apptainer run cat12.sif"``.
+        """,
+        default="cat12",
+        type=str,
+        nargs=1,
+    )
+    return parser
+
+
+def _add_preflight(parser):
+    parser.add_argument(
+        "--invalid_inputs",
+        help="""
+        What to do with input images that CAT12 cannot process
+        (unreadable or truncated files, not a single 3D volume,
+        invalid voxel sizes or orientation),
+        found by reading their header before any segmentation starts.
+        reject: only skip those images;
+        skip_participant: skip the participants with such an image.
+        The problems found are written to ``logs/preflight_<date>.json``.
+        """,
+        choices=["reject", "skip_participant"],
+        default="reject",
+        type=str,
+        nargs=1,
+    )
+    parser.add_argument(
+        "--check_gzip",
+        help="""
+        Also decompress the compressed input images
+        to check their gzip stream before any segmentation starts.
+        """,
+        action="store_true",
+        required=False,
+    )
+    parser.add_argument(
+        "--skip_preflight",
+        help="Do not check the headers of the input images.",
+        action="store_true",
+        required=False,
+    )
+    return parser
+
+
+def _add_result_cache(parser):
+    parser.add_argument(
+        "--result_cache_dir",
+        help="""
+        Folder where the outputs of each image are stored
+        and from which they are restored when the same image
+        is segmented again with the same batch and versions,
+        even in another dataset.
+        Can be shared between datasets.
+        Only used for cross-sectional segmentations.
+        """,
+        type=str,
+        nargs=1,
+    )
+    parser.add_argument(
+        "--result_cache_size",
+        help="""
+        Size of the result cache (for example ``500G``)
+        over which the least recently used outputs are removed.
+        """,
+        default="100G",
+        type=str,
+        nargs=1,
+    )
+    return parser
+
+
+def _add_segment_arguments(parser):
+    parser = _add_common_arguments(parser)
+    parser = _add_n_jobs(parser)
+    parser = _add_threads(parser)
+    parser.add_argument(
+        "--batch_size",
+        help="""
+        Maximum number of images to pass to a single call to CAT12
+        to only pay the start up cost of the MATLAB runtime once per batch.
+        Participants are never split across batches.
+        Ignored for longitudinal segmentation.
+        """,
+        default=1,
+        type=int,
+        nargs=1,
+    )
+    parser.add_argument(
+        "--schedule",
+        help="""
+        Order in which participants are processed.
+        input: the order of the input dataset;
+        largest_first: the participants estimated to take longest first
+        (from the size of their images and the previous runs),
+        so that parallel jobs finish at about the same time.
+        Ignored with a single job.
+        """,
+        choices=["input", "largest_first"],
+        default="input",
+        type=str,
+        nargs=1,
+    )
+    parser.add_argument(
+        "--mem_budget",
+        help="""
+        Memory shared by the parallel jobs (for example ``100G``).
+        A job only starts while the memory estimated for the running jobs
+        fits in this budget.
+        The memory of a job is estimated from the size of its images
+        and the memory used by the previous runs.
+        Defaults to 90%% of the memory available
+        (limited by the cgroup and SLURM).
+        """,
+        type=str,
+        nargs=1,
+    )
+    parser.add_argument(
+        "--hardlink_inputs",
+        help="""
+        Hardlink the uncompressed input images in the output dataset
+        when they cannot be reflinked, instead of copying them.
+        The staged image then shares its data with the input:
+        only use it if nothing writes to the images in place.
+        """,
+        action="store_true",
+        required=False,
+    )
+    parser = _add_preflight(parser)
+    parser = _add_compression(parser)
+    parser = _add_mcr_cache(parser)
+    parser = _add_result_cache(parser)
+    parser.add_argument(
+        "--reset_database",
+        help="""
+        Resets the database of the input dataset.
+        The database is stored in ``output_dir/.pybids``
+        and is otherwise only re-created
+        when the files of the indexed subjects change.
+        """,
+        action="store_true",
+        required=False,
+    )
+    parser.add_argument(
+        "--type",
+        help="""Type of segmentation.
+ default: default CAT12 preprocessing batch;
+ simple: simple processing batch;
+ long_0 - longitudinal developmental;
+ long_1 - longitudinal plasticity/learning;
+ long_2 - longitudinal aging;
+ long_3 - longitudinal save models 1 and 2;
+ enigma - enigma segmentation
+""",
+        choices=[
+            "default",
+            "simple",
+            "long_0",
+            "long_1",
+            "long_2",
+            "long_3",
+            "enigma",
+        ],
+        default="default",
+        required=False,
+        type=str,
+        nargs=1,
+    )
+    return parser
+
+
 def common_parser(
     formatter_class: type[HelpFormatter] = HelpFormatter,
 ) -> ArgumentParser:
@@ -148,42 +543,112 @@ def common_parser(
     copy_parser = _add_target(copy_parser, with_all=True)
     copy_parser = _add_verbose(copy_parser)
 
+    warmup_parser = subparsers.add_parser(
+        "warmup",
+        help="""
+        Extract the MATLAB runtime in the cache of each parallel job
+        to save its start up time in later runs.
+        """,
+        formatter_class=parser.formatter_class,
+    )
+    warmup_parser = _add_n_jobs(
+        warmup_parser,
+        help_text="""
+        Number of parallel jobs of the later runs:
+        the MATLAB runtime is extracted in the cache of each of them.
+        """,
+    )
+    warmup_parser = _add_mcr_cache(warmup_parser)
+    warmup_parser = _add_verbose(warmup_parser)
+
+    for name, batch in BATCHES.items():
+        batch_parser = subparsers.add_parser(
+            name,
+            help=f"""
+            {batch.description}
+            Runs on the outputs of the segmentation of all participants,
+            split in up to --n_jobs parallel calls to CAT12.
+            """,
+            formatter_class=parser.formatter_class,
+        )
+        batch_parser = _add_participant_label(batch_parser)
+        n_jobs_help = """
+            Number of shards the input files are split in:
+            each shard is passed to its own call to CAT12
+            and the calls run in parallel.
+            """
+        if name in ("get_TIV", "get_ROI_values"):
+            n_jobs_help += """
+            With ``--engine native``,
+            number of processes computing the tables.
+            """
+        batch_parser = _add_n_jobs(batch_parser, help_text=n_jobs_help)
+        batch_parser = _add_mcr_cache(batch_parser)
+        batch_parser = _add_verbose(batch_parser)
+        if name in ("get_TIV", "get_ROI_values"):
+            batch_parser = _add_engine(batch_parser)
+        if name == "get_ROI_values":
+            batch_parser = _add_atlas(batch_parser)
+        if name == "resample":
+            batch_parser.add_argument(
+                "--fwhm",
+                help="FWHM in mm of the smoothing of the surfaces.",
+                default=12,
+                type=float,
+                nargs=1,
+            )
+
     segment_parser = subparsers.add_parser(
         "segment",
         help="segment",
         formatter_class=parser.formatter_class,
     )
-    segment_parser = _add_common_arguments(segment_parser)
-    segment_parser.add_argument(
-        "--reset_database",
-        help="Resets the database of the input dataset.",
-        action="store_true",
-        required=False,
+    segment_parser = _add_segment_arguments(segment_parser)
+    segment_parser = _add_sharding(segment_parser)
+
+    plan_parser = subparsers.add_parser(
+        "plan",
+        help="""
+        Write an array job script for a cluster:
+        each task segments a shard of the participants.
+        Takes the same options as segment, passed to each task.
+        """,
+        formatter_class=parser.formatter_class,
     )
-    segment_parser.add_argument(
-        "--type",
-        help="""Type of segmentation.
- default: default CAT12 preprocessing batch;
- simple: simple processing batch;
- long_0 - longitudinal developmental;
- long_1 - longitudinal plasticity/learning;
- long_2 - longitudinal aging;
- long_3 - longitudinal save models 1 and 2;
- enigma - enigma segmentation
-""",
-        choices=[
-            "default",
-            "simple",
-            "long_0",
-            "long_1",
-            "long_2",
-            "long_3",
-            "enigma",
-        ],
-        default="default",
-        required=False,
-        type=str,
+    plan_parser = _add_segment_arguments(plan_parser)
+    plan_parser.add_argument(
+        "--shard_count",
+        help="""
+        Number of tasks of the array job.
+        Participants are split in shards
+        balanced by the estimated cost of their images.
+        """,
+        required=True,
+        type=int,
         nargs=1,
     )
+    plan_parser = _add_plan_arguments(plan_parser)
 
     return parser
+
+
+def segment_options(args) -> list[str]:
+    """Return the options of ``segment`` set in parsed arguments.
+
+    Used to pass the options given to ``plan`` to each of its tasks.
+    Options left to their default value are not returned.
+    """
+    parser = _add_segment_arguments(ArgumentParser(add_help=False))
+    options: list[str] = []
+    for action in parser._actions:
+        value = getattr(args, action.dest, None)
+        if value is None or value == action.default or value is False:
+            continue
+        option = action.option_strings[-1]
+        if value is True:
+            options.append(option)
+        elif isinstance(value, list):
+            options.extend([option, *map(str, value)])
+        else:
+            options.extend([option, str(value)])
+    return options
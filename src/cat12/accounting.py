@@ -0,0 +1,281 @@
+"""Measure what each step of a run costs.
+
+While a CAT12 process runs, its process tree
+(``cat_standalone.sh`` and the MATLAB runtime processes it starts)
+is sampled from ``/proc`` to get the peak memory and the bytes read
+and written by all the processes of the tree.
+
+Measures are written to ``logs/resources.tsv`` in the output dataset
+(one row per participant and step, described in ``logs/resources.json``)
+and each run writes a summary to ``logs/resources_<date>.json``.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import csv
+import fcntl
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+
+from cat12.cat_logging import cat12_log
+
+logger = cat12_log(name="cat12")
+
+PROC = Path("/proc")
+
+try:
+    PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+except (AttributeError, ValueError, OSError):
+    PAGE_SIZE = 4096
+
+COLUMNS = {
+    "participant_id": "Participant label or n/a for steps run for all.",
+    "step": (
+        "preflight (checking the inputs), copy (staging the inputs), "
+        "segment (CAT12), compress, or a post-processing command "
+        "(get_TIV...; get_TIV_native... with --engine native)."
+    ),
+    "start": "Time the step started.",
+    "n_images": "Number of images processed by the step.",
+    "n_participants": (
+        "Number of participants processed together: "
+        "they all get the measures of the whole step."
+    ),
+    "wall_time": "Wall time in seconds.",
+    "user_time": "User CPU time in seconds.",
+    "system_time": "System CPU time in seconds.",
+    "peak_rss": "Peak resident memory of the process tree in MB.",
+    "read": "Data read from disk in MB.",
+    "written": "Data written to disk in MB.",
+    "threads": "Number of CPUs the step could use.",
+    "n_voxels": "Number of voxels of the largest image processed by the step.",
+}
+
+# columns read as integers by read_resources, the others are floats
+_INTEGERS = ("n_images", "n_participants", "threads", "n_voxels")
+_STRINGS = ("participant_id", "step", "start")
+
+
+class ProcessTreeSampler:
+    """Sample the memory and I/O of a process and all its descendants.
+
+    :param pid: Process ID of the root of the tree.
+    :type pid: int
+
+    :param interval: Time between samples in seconds.
+    :type interval: float
+    """
+
+    def __init__(self, pid: int, interval: float = 1.0):
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss = 0
+        # last I/O counters seen for each process of the tree
+        self._io: dict[int, tuple[int, int]] = {}
+
+    @property
+    def read_bytes(self) -> int:
+        """Return the bytes read by all the processes seen so far."""
+        return sum(x[0] for x in self._io.values())
+
+    @property
+    def write_bytes(self) -> int:
+        """Return the bytes written by all the processes seen so far."""
+        return sum(x[1] for x in self._io.values())
+
+    async def run(self) -> None:
+        """Sample until cancelled."""
+        if not PROC.is_dir():
+            return
+        while True:
+            self.sample()
+            await asyncio.sleep(self.interval)
+
+    def sample(self) -> None:
+        """Take a single sample of the process tree."""
+        rss = 0
+        for pid in process_tree(self.pid):
+            rss += _rss(pid)
+            io = _io(pid)
+            if io is not None:
+                self._io[pid] = io
+        self.peak_rss = max(self.peak_rss, rss)
+
+
+def process_tree(pid: int) -> list[int]:
+    """List a process and all its descendants."""
+    children: dict[int, list[int]] = {}
+    for entry in os.scandir(PROC):
+        if not entry.name.isdigit():
+            continue
+        try:
+            with (PROC / entry.name / "stat").open("rb") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # the command name can contain spaces: skip it
+        ppid = int(stat[stat.rfind(b")") + 2 :].split()[1])
+        children.setdefault(ppid, []).append(int(entry.name))
+
+    tree = [pid]
+    i = 0
+    while i < len(tree):
+        tree.extend(children.get(tree[i], []))
+        i += 1
+    return tree
+
+
+def _rss(pid: int) -> int:
+    try:
+        with (PROC / str(pid) / "statm").open("rb") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def _io(pid: int) -> tuple[int, int] | None:
+    try:
+        with (PROC / str(pid) / "io").open("rb") as f:
+            fields = dict(line.split(b": ") for line in f.read().splitlines())
+        return int(fields[b"read_bytes"]), int(fields[b"write_bytes"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+class ResourceLog:
+    """Collect the measures of a run and write them to the output dataset.
+
+    :param output_dir: Output dataset.
+    :type output_dir: Path
+
+    :param run_info: Information about the run to add to the summary
+        (options used...).
+    :type run_info: dict, optional
+    """
+
+    def __init__(self, output_dir: Path, run_info: dict | None = None):
+        self.log_dir = output_dir / "logs"
+        self.tsv = self.log_dir / "resources.tsv"
+        self.run_info = run_info or {}
+        self.start = datetime.now()
+        self.rows: list[dict] = []
+
+    def add(self, **measures) -> None:
+        """Record the measures of a step and append them to the TSV.
+
+        Missing measures are written as ``n/a``.
+        The TSV is locked with ``flock`` while the row is appended
+        so that only one of the processes sharing it writes the header.
+        """
+        row = {key: measures.get(key, "n/a") for key in COLUMNS}
+        for key in ("wall_time", "user_time", "system_time"):
+            if isinstance(row[key], float):
+                row[key] = round(row[key], 3)
+        self.rows.append(row)
+
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+        with self.tsv.open("a", newline="") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            writer = csv.DictWriter(
+                f, fieldnames=list(COLUMNS), delimiter="\t"
+            )
+            if os.fstat(f.fileno()).st_size == 0:
+                writer.writeheader()
+            writer.writerow(row)
+            f.flush()
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+        sidecar = self.tsv.with_suffix(".json")
+        if not sidecar.exists():
+            with sidecar.open("w") as f:
+                json.dump(
+                    {
+                        key: {"Description": value}
+                        for key, value in COLUMNS.items()
+                    },
+                    f,
+                    indent=4,
+                )
+
+    def write_summary(self) -> Path:
+        """Write the totals of each step for this run."""
+        steps: dict[str, dict] = {}
+        for row in self.rows:
+            step = steps.setdefault(
+                row["step"],
+                {"n_images": 0, "wall_time": 0.0},
+            )
+            if isinstance(row["n_images"], int):
+                step["n_images"] += row["n_images"]
+            # participants processed together share the same measures
+            share = row["n_participants"]
+            share = share if isinstance(share, int) and share > 0 else 1
+            for key in ("wall_time", "user_time", "system_time"):
+                if isinstance(row[key], (int, float)):
+                    step[key] = step.get(key, 0.0) + row[key] / share
+            for key in ("read", "written"):
+                if isinstance(row[key], (int, float)):
+                    step[key] = step.get(key, 0.0) + row[key] / share
+            if isinstance(row["peak_rss"], (int, float)):
+                step["peak_rss"] = max(
+                    step.get("peak_rss", 0.0), row["peak_rss"]
+                )
+
+        end = datetime.now()
+        summary = {
+            **self.run_info,
+            "start": self.start.isoformat(timespec="seconds"),
+            "end": end.isoformat(timespec="seconds"),
+            "wall_time": round((end - self.start).total_seconds(), 3),
+            "steps": {
+                name: {k: _round(v) for k, v in step.items()}
+                for name, step in steps.items()
+            },
+        }
+
+        date = self.start.isoformat(timespec="seconds").replace(":", "_")
+        output_file = self.log_dir / f"resources_{date}.json"
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+        with output_file.open("w") as f:
+            json.dump(summary, f, indent=4)
+        logger.info(f"resources used written to {output_file}")
+        return output_file
+
+
+def read_resources(output_dir: Path) -> list[dict]:
+    """Read the measures recorded by the previous runs.
+
+    Numbers are converted and ``n/a`` are read as None.
+
+    :param output_dir: Output dataset.
+    :type output_dir: Path
+
+    :rtype: list[dict]
+    """
+    tsv = output_dir / "logs" / "resources.tsv"
+    if not tsv.exists():
+        return []
+    rows = []
+    with tsv.open(newline="") as f:
+        for row in csv.DictReader(f, delimiter="\t"):
+            for key, value in row.items():
+                if key in _STRINGS:
+                    continue
+                try:
+                    row[key] = int(value) if key in _INTEGERS else float(value)
+                except (TypeError, ValueError):
+                    row[key] = None
+            rows.append(row)
+    return rows
+
+
+def to_mb(n_bytes: float) -> float:
+    """Convert bytes to MB."""
+    return round(n_bytes / 1024**2, 3)
+
+
+def _round(value):
+    return round(value, 3) if isinstance(value, float) else value
@@ -0,0 +1,199 @@
+"""Average the T1w runs of each session before longitudinal segmentation.
+
+Longitudinal segmentation expects one image per time point:
+when a session has several T1w runs, they are averaged into a single image.
+Runs are only averaged with the runs that share all their other entities
+(acquisition, reconstruction...), so different sequences are kept apart.
+
+Images are memory mapped and averaged chunk by chunk along the last axis,
+so memory is bounded by ``CHUNK_SIZE``, not by the number of runs.
+Runs are assumed to be aligned: those that do not share the grid
+of the first run are only resampled to it (using their affines,
+this requires scipy), they are not registered.
+"""
+
+from __future__ import annotations
+
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+
+from cat12.cat_logging import cat12_log
+
+logger = cat12_log(name="cat12")
+
+# bytes of float64 accumulator per chunk
+CHUNK_SIZE = 64 * 1024**2
+
+
+def average_timepoints(
+    files: list[str], chunk_size: int = CHUNK_SIZE
+) -> dict[str, list[str]]:
+    """Average the runs of each session of a participant.
+
+    Images without other runs are left as is.
+
+    :param files: Uncompressed T1w images of a participant.
+    :type files: list[str]
+
+    :param chunk_size: Memory used to average each chunk in bytes.
+    :type chunk_size: int
+
+    :return: Map of the image of each time point, in the order of the time
+        points, to the runs it was computed from.
+    :rtype: dict[str, list[str]]
+    """
+    timepoints = {}
+    for output, runs in group_runs(files).items():
+        if len(runs) == 1:
+            timepoints[runs[0]] = runs
+            continue
+        logger.info(f"averaging {len(runs)} runs into {output}")
+        try:
+            average_runs(runs, output, chunk_size=chunk_size)
+        except ImportError as exc:
+            logger.warning(
+                f"Cannot resample the runs of {output} "
+                f"to a common grid ({exc}): they are not averaged."
+            )
+            timepoints.update({run: [run] for run in runs})
+            continue
+        timepoints[str(output)] = runs
+    return timepoints
+
+
+def group_runs(files: list[str]) -> dict[Path, list[str]]:
+    """Group the runs that only differ by their ``run`` entity.
+
+    :return: Map of the name of the mean of each group
+        (see :func:`mean_filename`) to its images.
+    :rtype: dict[Path, list[str]]
+    """
+    groups: dict[Path, list[str]] = {}
+    for file in files:
+        groups.setdefault(mean_filename(file), []).append(file)
+    return {key: sorted(value) for key, value in groups.items()}
+
+
+def mean_filename(run: str | Path) -> Path:
+    """Return the name of the mean of the runs of a session.
+
+    The ``run`` entity is dropped and ``desc-mean`` is added.
+    """
+    run = Path(run)
+    entities = [
+        x for x in run.name.split("_")[:-1] if not x.startswith("run-")
+    ]
+    return run.with_name(f"{'_'.join([*entities, 'desc-mean'])}_T1w.nii")
+
+
+def average_runs(
+    runs: list[str | Path], output: str | Path, chunk_size: int = CHUNK_SIZE
+) -> Path:
+    """Write the voxel-wise mean of several images as float32.
+
+    The mean is written to a temporary file renamed once complete.
+
+    :param runs: Uncompressed images to average.
+        All must be 3D or have singleton trailing dimensions.
+    :type runs: list[Union[str, Path]]
+
+    :param output: Where to write the mean, must end with ``.nii``.
+    :type output: Union[str, Path]
+
+    :param chunk_size: Memory used to average each chunk in bytes.
+    :type chunk_size: int
+
+    :raises ValueError: If an image is not 3D.
+    :raises ImportError: If images must be resampled and scipy is missing.
+    """
+    output = Path(output)
+    tmp = output.with_name(f".tmp_{output.name}")
+    resampled: list[Path] = []
+
+    reference = nib.load(runs[0], mmap=True)
+    shape = _shape_3d(reference)
+
+    try:
+        proxies = []
+        for run in runs:
+            img = nib.load(run, mmap=True)
+            _shape_3d(img)
+            if not same_grid(img, reference):
+                logger.info(f"resampling {run} to the grid of {runs[0]}")
+                path = Path(run).with_name(f".tmp_resampled_{Path(run).name}")
+                _resample(img, reference, path)
+                resampled.append(path)
+                img = nib.load(path, mmap=True)
+            proxies.append(img.dataobj)
+
+        header = reference.header.copy()
+        header.set_data_shape(shape)
+        header.set_data_dtype(np.float32)
+        header.set_slope_inter(1, 0)
+        header["vox_offset"] = 0
+        with tmp.open("wb") as f:
+            header.write_to(f)
+        offset = int(header.get_data_offset())
+
+        mean = np.memmap(
+            tmp,
+            dtype=header.get_data_dtype(),
+            mode="r+",
+            offset=offset,
+            shape=shape,
+            order="F",
+        )
+        # images are stored in Fortran order: slabs along the last axis
+        # are contiguous on disk
+        slab = max(chunk_size // (shape[0] * shape[1] * 8), 1)
+        for start in range(0, shape[2], slab):
+            stop = min(start + slab, shape[2])
+            total = np.zeros((*shape[:2], stop - start), dtype=np.float64)
+            for proxy in proxies:
+                total += np.asarray(
+                    proxy[:, :, start:stop], dtype=np.float64
+                ).reshape(total.shape)
+            mean[:, :, start:stop] = total / len(proxies)
+        mean.flush()
+        del mean
+
+        tmp.replace(output)
+    finally:
+        tmp.unlink(missing_ok=True)
+        for path in resampled:
+            path.unlink(missing_ok=True)
+
+    return output
+
+
+def same_grid(img, reference, atol: float = 1e-3) -> bool:
+    """Check that two images have the same voxel grid."""
+    return _shape_3d(img) == _shape_3d(reference) and np.allclose(
+        img.affine, reference.affine, atol=atol
+    )
+
+
+def _shape_3d(img) -> tuple[int, int, int]:
+    shape = img.shape
+    if len(shape) < 3 or any(dim != 1 for dim in shape[3:]):
+        raise ValueError(f"Only 3D images can be averaged, got shape {shape}.")
+    return tuple(shape[:3])
+
+
+def _resample(img, reference, output: Path) -> None:
+    """Resample an image to the grid of a reference (trilinear).
+
+    The resampled image is loaded in memory.
+    """
+    # nibabel.processing only fails when scipy is used
+    import scipy.ndimage  # noqa: F401
+    from nibabel.processing import resample_from_to
+
+    data = np.asarray(img.dataobj).reshape(_shape_3d(img))
+    img = nib.Nifti1Image(data, img.affine)
+    resampled = resample_from_to(
+        img, (_shape_3d(reference), reference.affine), order=1
+    )
+    nib.save(resampled, output)
@@ -0,0 +1,173 @@
+"""Select the input images with a BIDS filter file.
+
+The filter file is a JSON file with the BIDS entities the T1w images
+must have, like the ``t1w`` query of the filter files of sMRIPrep::
+
+    {"t1w": {"session": ["1", "2"], "acquisition": "mprage", "run": null}}
+
+A value can be a list of accepted values,
+``null`` for images without this entity
+or ``"*"`` for images with any value of this entity.
+
+Most filters only use entities present in the file names,
+so they are compiled once into a function
+that selects among the images found by :mod:`cat12.scanner`.
+Other filters (``regex_search``, other suffixes or datatypes)
+are resolved with a single query against the pybids index of the dataset.
+"""
+
+from __future__ import annotations
+
+import json
+from collections.abc import Callable
+from pathlib import Path
+from typing import Any
+
+from cat12.cat_logging import cat12_log
+from cat12.scanner import ENTITY_NAMES
+
+logger = cat12_log(name="cat12")
+
+DEFAULT_QUERY = {
+    "datatype": "anat",
+    "suffix": "T1w",
+    "extension": [".nii", ".nii.gz"],
+}
+
+# entities the scanner can check
+_SCANNED = {
+    "subject",
+    "datatype",
+    "suffix",
+    "extension",
+    *ENTITY_NAMES.values(),
+}
+
+# compared as numbers: run-01 is run 1
+_INTEGERS = {"run", "chunk"}
+
+
+def load_filter(path: str | Path) -> dict[str, Any]:
+    """Read the query for T1w images of a BIDS filter file.
+
+    The query is the ``t1w`` (or ``T1w``) entry of the file
+    or the whole file if it has no such entry,
+    completed with :data:`DEFAULT_QUERY`.
+
+    :raises ValueError: If the file is not a JSON object of entities.
+    """
+    with Path(path).open() as f:
+        try:
+            content = json.load(f)
+        except json.JSONDecodeError as exc:
+            raise ValueError(f"{path} is not valid JSON: {exc}") from exc
+    if not isinstance(content, dict):
+        raise ValueError(f"{path} must contain a JSON object.")
+
+    query = content
+    for key in ("t1w", "T1w"):
+        if key in content:
+            query = content[key]
+            break
+    if not isinstance(query, dict):
+        raise ValueError(f"The filters of {path} must be a JSON object.")
+
+    query = {**DEFAULT_QUERY, **query}
+    if "extension" in query:
+        query["extension"] = [
+            x if x is None or x.startswith(".") else f".{x}"
+            for x in _as_list(query["extension"])
+        ]
+    return query
+
+
+def compile_filter(query: dict[str, Any]) -> Callable[[dict], bool] | None:
+    """Compile a query into a function that checks the entities of an image.
+
+    :return: A function returning True for the entities
+        of the images to keep,
+        or None if the query needs the pybids index.
+    :rtype: Callable[[dict], bool], optional
+    """
+    if query.get("regex_search") or not set(query) <= _SCANNED:
+        return None
+    if "T1w" not in _as_list(query["suffix"]):
+        return None
+    if "anat" not in _as_list(query["datatype"]):
+        return None
+
+    checks = {
+        entity: _accepted(entity, value)
+        for entity, value in query.items()
+        if entity not in ("datatype", "suffix")
+    }
+
+    def match(entities: dict) -> bool:
+        return all(
+            check(entities.get(entity)) for entity, check in checks.items()
+        )
+
+    return match
+
+
+def _accepted(entity: str, value) -> Callable[[str | None], bool]:
+    values = _as_list(value)
+    if "*" in values:
+        return lambda x: x is not None
+    if entity in _INTEGERS:
+        accepted = {_integer(x) for x in values}
+        return lambda x: _integer(x) in accepted
+    accepted = {None if x is None else str(x) for x in values}
+    return lambda x: x in accepted
+
+
+def _integer(value):
+    try:
+        return None if value is None else int(value)
+    except ValueError:
+        return value
+
+
+def _as_list(value) -> list:
+    return value if isinstance(value, list) else [value]
+
+
+def query_layout(
+    layout, query: dict[str, Any], subjects: list[str] | None = None
+) -> dict[str, list]:
+    """Resolve a query with a single call to a pybids layout.
+
+    :param layout: Index of the input dataset.
+    :type layout: BIDSLayout
+
+    :param subjects: Only keep the images of those subjects.
+    :type subjects: list[str], optional
+
+    :return: Map of subject labels to their images sorted by path.
+    :rtype: dict[str, list[BIDSFile]]
+    """
+    from bids.layout import Query  # type: ignore
+
+    query = {
+        entity: value
+        if entity == "regex_search"
+        else [
+            Query.ANY if x == "*" else Query.NONE if x is None else x
+            for x in _as_list(value)
+        ]
+        for entity, value in query.items()
+    }
+    if subjects:
+        query["subject"] = [
+            x for x in subjects if x in query.get("subject", subjects)
+        ]
+        if not query["subject"]:
+            return {}
+
+    inputs: dict[str, list] = {}
+    for file in layout.get(return_type="object", **query):
+        inputs.setdefault(file.entities["subject"], []).append(file)
+    return {
+        subject: sorted(files, key=lambda x: x.path)
+        for subject, files in sorted(inputs.items())
+    }
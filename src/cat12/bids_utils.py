@@ -2,16 +2,20 @@
 
 from __future__ import annotations
 
+import hashlib
 import json
+import os
 from pathlib import Path
-from typing import Any
+from typing import TYPE_CHECKING, Any
 
-from bids import BIDSLayout  # type: ignore
 from cat12._version import __version__
 
 from cat12.cat_logging import cat12_log
 from cat12.utils import create_dir_if_absent
 
+if TYPE_CHECKING:
+    from bids import BIDSLayout  # type: ignore
+
 logger = cat12_log(name="cat12")
 
 
@@ -19,21 +23,50 @@ def get_dataset_layout(
     dataset_path: str | Path,
     use_database: bool = False,
     reset_database: bool = False,
+    database_dir: str | Path | None = None,
+    subjects: list[str] | None = None,
 ) -> BIDSLayout:
     """Return a BIDSLayout object for the dataset at the given path.
 
+    When using a database, it is stored in ``database_dir``
+    (so the dataset itself can be read-only)
+    along with a fingerprint of the indexed subjects folders.
+    The index is reused as long as the fingerprint does not change.
+
+    There is one database per set of subjects,
+    and it is rebuilt entirely as soon as the top level files
+    or any of its subjects changed:
+    pybids cannot re-index only the subjects that changed.
+    The changed entries are only logged.
+
     :param dataset_path: Path to the dataset.
     :type dataset_path: Union[str, Path]
 
     :param use_database: Defaults to False
     :type use_database: bool, optional
 
+    :param reset_database: Force re-indexing the dataset. Defaults to False
+    :type reset_database: bool, optional
+
+    :param database_dir: Where to store the databases.
+        Defaults to a ``.pybids`` folder in the dataset.
+    :type database_dir: Union[str, Path], optional
+
+    :param subjects: Only index those subjects. Defaults to all subjects.
+    :type subjects: list[str], optional
+
     :return: _description_
     :rtype: BIDSLayout
     """
     if isinstance(dataset_path, str):
         dataset_path = Path(dataset_path)
 
+    # pybids and SQLAlchemy take long to import
+    from bids import BIDSLayout, BIDSLayoutIndexer  # type: ignore
+    from bids.layout.validation import (  # type: ignore
+        DEFAULT_LOCATIONS_TO_IGNORE,
+    )
+
     dataset_path = dataset_path.absolute()
 
     logger.info(f"indexing {dataset_path}")
@@ -45,16 +78,121 @@ def get_dataset_layout(
             derivatives=False,
         )
 
-    database_path = dataset_path / "pybids_db"
-    return BIDSLayout(
+    if database_dir is None:
+        database_dir = dataset_path / ".pybids"
+    database_dir = Path(database_dir).absolute()
+
+    all_subjects = sorted(
+        x.name[4:] for x in dataset_path.glob("sub-*") if x.is_dir()
+    )
+    if subjects:
+        subjects = sorted(set(subjects) & set(all_subjects))
+    else:
+        subjects = all_subjects
+
+    # one database per set of subjects
+    # so that parallel runs on different participants do not collide
+    scope = _hash(str(dataset_path), *subjects)
+    database_path = database_dir / f"scope-{scope}"
+
+    fingerprint = dataset_fingerprint(dataset_path, subjects)
+    fingerprint_file = database_path / "fingerprint.json"
+    if not reset_database:
+        changed = _changed_fingerprint(fingerprint_file, fingerprint)
+        if changed:
+            # pybids can only rebuild the whole database
+            logger.info(f"re-indexing as the following changed: {changed}")
+            reset_database = True
+    if reset_database:
+        logger.info(f"resetting database {database_path}")
+
+    ignore = [
+        *DEFAULT_LOCATIONS_TO_IGNORE,
+        *(f"sub-{x}" for x in all_subjects if x not in subjects),
+    ]
+
+    layout = BIDSLayout(
         dataset_path,
         validate=False,
         derivatives=False,
         database_path=database_path,
         reset_database=reset_database,
+        indexer=BIDSLayoutIndexer(validate=False, ignore=ignore),
+    )
+
+    if reset_database or not fingerprint_file.exists():
+        with fingerprint_file.open("w") as f:
+            json.dump(fingerprint, f, indent=4)
+
+    return layout
+
+
+def dataset_fingerprint(
+    dataset_path: Path, subjects: list[str]
+) -> dict[str, str]:
+    """Compute a fingerprint of the top level files and of each subject.
+
+    Relies on the path, size and modification time of each file and folder
+    so no file content is read.
+
+    :param dataset_path: Path to the dataset.
+    :type dataset_path: Path
+
+    :param subjects: Subjects to fingerprint.
+    :type subjects: list[str]
+
+    :return: Map of ``top_level`` and of each ``sub-<label>`` to a hash.
+    :rtype: dict[str, str]
+    """
+    top_level = [
+        _stat_key(entry)
+        for entry in os.scandir(dataset_path)
+        if entry.is_file() and not entry.name.startswith(".")
+    ]
+    fingerprint = {"top_level": _hash(*sorted(top_level))}
+    for subject in subjects:
+        subject_dir = dataset_path / f"sub-{subject}"
+        fingerprint[f"sub-{subject}"] = _hash(
+            *sorted(_walk_stat_keys(subject_dir, subject_dir))
+        )
+    return fingerprint
+
+
+def _changed_fingerprint(
+    fingerprint_file: Path, fingerprint: dict[str, str]
+) -> list[str]:
+    """List the entries of a fingerprint that differ from the stored one."""
+    if not fingerprint_file.exists():
+        return []
+    with fingerprint_file.open() as f:
+        previous = json.load(f)
+    return sorted(
+        key
+        for key in set(previous) | set(fingerprint)
+        if previous.get(key) != fingerprint.get(key)
     )
 
 
+def _walk_stat_keys(path: Path, root: Path):
+    for entry in os.scandir(path):
+        if entry.name.startswith("."):
+            continue
+        yield f"{os.path.relpath(entry.path, root)}:{_stat_key(entry)}"
+        if entry.is_dir(follow_symlinks=False):
+            yield from _walk_stat_keys(Path(entry.path), root)
+
+
+def _stat_key(entry: os.DirEntry) -> str:
+    stat = entry.stat()
+    return f"{entry.name}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def _hash(*values: str) -> str:
+    return hashlib.blake2b(
+        "\n".join(values).encode(), digest_size=8
+    ).hexdigest()
+
+
 def init_derivatives_layout(output_dir: Path) -> BIDSLayout:
     """Initialize a derivatives dataset and returns its layout.
 
@@ -125,5 +263,9 @@ def write_dataset_description(output_dir) -> None:
     }
     output_file = output_dir / "dataset_description.json"
 
-    with Path.open(output_file, "w") as ff:
+    # written to a temporary file that is renamed
+    # so workers sharing the output dataset never read a partial file
+    tmp = output_file.with_name(f".tmp_{os.getpid()}_{output_file.name}")
+    with Path.open(tmp, "w") as ff:
         json.dump(data, ff, indent=4)
+    tmp.replace(output_file)
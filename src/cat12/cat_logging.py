@@ -1,19 +1,39 @@
-"""For logging."""
+"""For logging.
+
+rich is only imported once the first message is logged
+or the first uncaught exception is printed,
+so that commands that log nothing start fast.
+"""
 
 from __future__ import annotations
 
 import logging
-
-from rich.logging import RichHandler
-from rich.traceback import install
+import sys
 
 FORMAT = "cat12 - %(asctime)s - %(message)s"
 
 
+class _RichHandler(logging.Handler):
+    """Create a rich handler the first time a message is logged."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._handler: logging.Handler | None = None
+
+    def emit(self, record: logging.LogRecord) -> None:
+        """Pass the record to the rich handler."""
+        if self._handler is None:
+            from rich.logging import RichHandler
+
+            self._handler = RichHandler()
+            self._handler.setFormatter(self.formatter)
+        self._handler.emit(record)
+
+
 def cat12_log(name: str | None = None) -> logging.Logger:
     """Create log."""
     # let rich print the traceback
-    install(show_locals=True)
+    install_tracebacks()
 
     if not name:
         name = "rich"
@@ -23,8 +43,26 @@ def cat12_log(name: str | None = None) -> logging.Logger:
         format=FORMAT,
         datefmt="[%X]",
         handlers=[
-            RichHandler(),
+            _RichHandler(),
         ],
     )
 
     return logging.getLogger(name)
+
+
+def install_tracebacks() -> None:
+    """Let rich print the tracebacks with the local variables.
+
+    rich is only imported when the first uncaught exception is printed.
+    """
+    if getattr(sys.excepthook, "_cat12", False):
+        return
+
+    def excepthook(exc_type, exc_value, traceback):
+        from rich.traceback import install
+
+        install(show_locals=True)
+        sys.excepthook(exc_type, exc_value, traceback)
+
+    excepthook._cat12 = True  # type: ignore[attr-defined]
+    sys.excepthook = excepthook
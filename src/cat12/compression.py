@@ -0,0 +1,157 @@
+"""Compress the nifti images written by CAT12.
+
+Images are streamed through zlib in fixed size chunks,
+so they are never loaded in memory,
+and several images are compressed at once by a pool of threads
+(zlib releases the GIL).
+
+Big images can also be split in blocks compressed in parallel
+and written as consecutive gzip members, like ``pigz`` does.
+The result is a valid gzip file that any gzip reader can decompress.
+"""
+
+from __future__ import annotations
+
+import gzip
+import shutil
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from cat12.cat_logging import cat12_log
+
+logger = cat12_log(name="cat12")
+
+CHUNK_SIZE = 1024 * 1024
+
+DEFAULT_LEVEL = 1
+
+
+def compress_niftis(
+    directory: Path,
+    level: int = DEFAULT_LEVEL,
+    n_jobs: int = 1,
+    block_size: int | None = None,
+) -> list[Path]:
+    """Compress all the ``.nii`` images in a directory and its subfolders.
+
+    :param directory: Directory to search for images.
+    :type directory: Path
+
+    :param level: gzip compression level from 0 to 9.
+    :type level: int
+
+    :param n_jobs: Number of threads to use.
+    :type n_jobs: int
+
+    :param block_size: Size in bytes of the blocks
+        to compress big images in parallel.
+        Images are compressed as a single stream if None.
+    :type block_size: int, optional
+
+    :return: The compressed images.
+    :rtype: list[Path]
+    """
+    files = sorted(
+        f for f in directory.glob("**/*.nii") if not f.name.startswith(".")
+    )
+    if not files:
+        return []
+
+    logger.debug(f"compressing {len(files)} images in {directory}")
+
+    n_jobs = max(n_jobs, 1)
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        futures = [
+            executor.submit(
+                compress_file,
+                f,
+                level=level,
+                block_size=block_size,
+                # share the threads between the images being compressed
+                n_threads=max(n_jobs // len(files), 1),
+            )
+            for f in files
+        ]
+        return [future.result() for future in futures]
+
+
+def compress_file(
+    path: str | Path,
+    level: int = DEFAULT_LEVEL,
+    block_size: int | None = None,
+    n_threads: int = 1,
+) -> Path:
+    """Gzip a file and remove the original.
+
+    The compressed file is written to a hidden temporary file
+    and renamed once complete,
+    so an interrupted run never leaves a truncated ``.gz`` behind.
+
+    :param path: File to compress.
+    :type path: Union[str, Path]
+
+    :param level: gzip compression level from 0 to 9.
+    :type level: int
+
+    :param block_size: Size in bytes of the blocks
+        to compress in parallel when the file has more than 1 block.
+    :type block_size: int, optional
+
+    :param n_threads: Number of blocks to compress in parallel.
+    :type n_threads: int
+
+    :return: Path to the compressed file.
+    :rtype: Path
+    """
+    path = Path(path)
+    output = path.with_name(f"{path.name}.gz")
+    tmp = path.with_name(f".tmp_{output.name}")
+
+    try:
+        if block_size and path.stat().st_size > block_size:
+            _compress_blocks(path, tmp, level, block_size, n_threads)
+        else:
+            _compress_stream(path, tmp, level)
+        tmp.replace(output)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+    path.unlink()
+    return output
+
+
+def _compress_stream(src: Path, dst: Path, level: int) -> None:
+    with src.open("rb") as f_in, dst.open("wb") as raw:
+        with gzip.GzipFile(
+            filename=src.name,
+            mode="wb",
+            compresslevel=level,
+            fileobj=raw,
+            mtime=0,
+        ) as f_out:
+            shutil.copyfileobj(f_in, f_out, length=CHUNK_SIZE)
+
+
+def _compress_blocks(
+    src: Path, dst: Path, level: int, block_size: int, n_threads: int
+) -> None:
+    """Compress blocks in parallel and write them as gzip members.
+
+    At most ``2 * n_threads`` blocks are in memory at once.
+    """
+    n_threads = max(n_threads, 1)
+    with src.open("rb") as f_in, dst.open("wb") as f_out:
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            pending = []
+            while block := f_in.read(block_size):
+                pending.append(executor.submit(_compress_block, block, level))
+                if len(pending) >= 2 * n_threads:
+                    f_out.write(pending.pop(0).result())
+            for future in pending:
+                f_out.write(future.result())
+
+
+def _compress_block(block: bytes, level: int) -> bytes:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush()
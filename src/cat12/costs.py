@@ -0,0 +1,120 @@
+"""Estimate the cost of processing images from their header.
+
+The time CAT12 takes for an image grows with its number of voxels,
+on top of a fixed cost (loading templates, registration...).
+Costs are expressed in units of a typical T1w image
+(``REFERENCE_VOXELS`` voxels), so a typical image costs about 2.
+They can be converted to seconds with the segmentations
+recorded by previous runs (see :func:`historical_costs`).
+"""
+
+from __future__ import annotations
+
+import statistics
+from pathlib import Path
+
+from cat12.cat_logging import cat12_log
+
+logger = cat12_log(name="cat12")
+
+# 1 mm isotropic whole head T1w
+REFERENCE_VOXELS = 256 * 256 * 176
+
+# cost of an image that does not depend on its size
+FIXED_COST = 1.0
+
+
+def image_voxels(path: str | Path) -> int | None:
+    """Return the number of voxels of an image by only reading its header.
+
+    :return: The number of voxels or None if the header cannot be read.
+    :rtype: int, optional
+    """
+    import nibabel as nib
+
+    try:
+        shape = nib.load(path).header.get_data_shape()
+    except Exception as exc:
+        logger.debug(f"Cannot read the header of {path}: {exc}")
+        return None
+    n_voxels = 1
+    for dim in shape:
+        n_voxels *= int(dim)
+    return n_voxels
+
+
+def image_cost(path: str | Path) -> float:
+    """Estimate the cost of processing an image.
+
+    Images whose header cannot be read get the cost of a typical image.
+    """
+    n_voxels = image_voxels(path)
+    if n_voxels is None:
+        n_voxels = REFERENCE_VOXELS
+    return voxels_cost(n_voxels)
+
+
+def voxels_cost(n_voxels: int) -> float:
+    """Estimate the cost of processing an image of ``n_voxels`` voxels."""
+    return FIXED_COST + n_voxels / REFERENCE_VOXELS
+
+
+def participant_costs(inputs: dict[str, list]) -> dict[str, float]:
+    """Estimate the cost of processing the images of each participant.
+
+    :param inputs: Map of participant labels to their images
+        (with a ``path``).
+    :type inputs: dict[str, list]
+
+    :rtype: dict[str, float]
+    """
+    return {
+        label: sum(image_cost(file.path) for file in files)
+        for label, files in inputs.items()
+    }
+
+
+def historical_costs(
+    costs: dict[str, float], history: list[dict]
+) -> dict[str, float]:
+    """Convert costs to seconds with the segmentations of previous runs.
+
+    Participants that were already segmented get the wall time
+    of their last segmentation.
+    The cost of the others is converted with the median time per unit
+    of cost of all the recorded segmentations.
+    Costs are returned unchanged if no segmentation was recorded.
+
+    :param costs: Map of participant labels to their estimated cost
+        (see :func:`participant_costs`).
+    :type costs: dict[str, float]
+
+    :param history: Rows of ``resources.tsv``
+        (see :func:`cat12.accounting.read_resources`).
+    :type history: list[dict]
+
+    :rtype: dict[str, float]
+    """
+    measured: dict[str, float] = {}
+    rates = []
+    for row in history:
+        if row.get("step") != "segment" or not row.get("wall_time"):
+            continue
+        # participants processed together share the wall time of the call
+        wall_time = row["wall_time"] / (row.get("n_participants") or 1)
+        label = row["participant_id"].removeprefix("sub-")
+        measured[label] = wall_time
+        if row.get("n_images") and row.get("n_voxels"):
+            rates.append(
+                wall_time / (row["n_images"] * voxels_cost(row["n_voxels"]))
+            )
+
+    if not rates:
+        # seconds and units of cost cannot be compared
+        return dict(costs)
+
+    rate = statistics.median(rates)
+    return {
+        label: measured.get(label, cost * rate)
+        for label, cost in costs.items()
+    }
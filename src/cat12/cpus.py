@@ -0,0 +1,200 @@
+"""Share the CPUs of a node between concurrent CAT12 processes.
+
+Each CAT12 process otherwise uses as many threads as the node has cores,
+so several of them oversubscribe the node.
+The CPUs available to the app (limited by its affinity,
+its cgroup quota and ``SLURM_CPUS_PER_TASK``) are split between the jobs:
+each CAT12 process is pinned to its own CPUs
+and the usual thread count variables are set to their number.
+
+The number of threads per job can also be chosen from the throughput
+of the previous runs recorded in ``logs/resources.tsv``
+(see :func:`choose_threads`).
+"""
+
+from __future__ import annotations
+
+import math
+import os
+import shutil
+from pathlib import Path
+
+from cat12.cat_logging import cat12_log
+
+logger = cat12_log(name="cat12")
+
+# read by OpenMP, BLAS libraries, ITK...
+# the MATLAB runtime sizes its pool of threads from the CPU affinity
+THREAD_VARIABLES = (
+    "OMP_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+    "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS",
+)
+
+# numbers of threads per job tried by choose_threads
+THREAD_CANDIDATES = (1, 2, 4, 8)
+
+CGROUP = Path("/sys/fs/cgroup")
+
+
+def available_cpus() -> list[int]:
+    """Return the CPUs this process can use.
+
+    Starts from the CPU affinity of the process
+    and only keeps as many as the cgroup quota
+    and ``SLURM_CPUS_PER_TASK`` allow.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(os.cpu_count() or 1))
+
+    limits = [
+        limit for limit in (cgroup_limit(), slurm_limit()) if limit is not None
+    ]
+    if limits and min(limits) < len(cpus):
+        cpus = cpus[: max(min(limits), 1)]
+    return cpus
+
+
+def cgroup_limit() -> int | None:
+    """Return the number of CPUs allowed by the cgroup quota, if any.
+
+    Reads ``cpu.max`` (cgroup v2)
+    or ``cpu.cfs_quota_us`` and ``cpu.cfs_period_us`` (cgroup v1).
+    """
+    try:
+        quota, period = (CGROUP / "cpu.max").read_text().split()[:2]
+    except (OSError, ValueError):
+        try:
+            quota = (CGROUP / "cpu" / "cpu.cfs_quota_us").read_text().strip()
+            period = (CGROUP / "cpu" / "cpu.cfs_period_us").read_text().strip()
+        except OSError:
+            return None
+    if quota in ("max", "-1"):
+        return None
+    try:
+        return math.ceil(int(quota) / int(period))
+    except (ValueError, ZeroDivisionError):
+        return None
+
+
+def slurm_limit() -> int | None:
+    """Return the number of CPUs allocated to the SLURM task, if any."""
+    try:
+        return int(os.environ["SLURM_CPUS_PER_TASK"])
+    except (KeyError, ValueError):
+        return None
+
+
+def split_cpus(
+    cpus: list[int], n_workers: int, threads: int
+) -> list[list[int]]:
+    """Give ``threads`` CPUs to each worker.
+
+    Workers get consecutive CPUs
+    and share them when there are not enough for all.
+
+    :rtype: list[list[int]]
+    """
+    return [
+        [cpus[(worker * threads + i) % len(cpus)] for i in range(threads)]
+        for worker in range(n_workers)
+    ]
+
+
+def thread_env(env, cpus: list[int] | None) -> dict[str, str]:
+    """Return a copy of ``env`` limiting the threads of a process."""
+    env = dict(env)
+    if cpus:
+        for name in THREAD_VARIABLES:
+            env[name] = str(len(cpus))
+    return env
+
+
+def pinned(cmd: list[str], cpus: list[int] | None) -> list[str]:
+    """Prefix a command with ``taskset`` to run it on some CPUs.
+
+    The affinity is then set before the command starts,
+    so every thread and child it starts inherits it.
+    The command is returned unchanged without CPUs
+    or when ``taskset`` is not installed.
+    """
+    if not cpus:
+        return cmd
+    taskset = shutil.which("taskset")
+    if taskset is None:
+        return cmd
+    return [taskset, "-c", ",".join(map(str, cpus)), *cmd]
+
+
+def pin(pid: int, cpus: list[int] | None) -> None:
+    """Restrict a process (and the children it starts) to some CPUs.
+
+    Only applies to the threads and children started afterwards:
+    prefer :func:`pinned` for commands that are not started yet.
+    """
+    if not cpus or not hasattr(os, "sched_setaffinity"):
+        return
+    try:
+        os.sched_setaffinity(pid, cpus)
+    except OSError as exc:
+        logger.debug(f"Cannot pin process {pid} to CPUs {cpus}: {exc}")
+
+
+def choose_threads(history: list[dict], n_cpus: int) -> int:
+    """Choose the number of threads per job that processes most images.
+
+    The throughput of a number of threads is estimated
+    from the segmentations recorded in ``history``
+    (see :func:`cat12.accounting.read_resources`)
+    as the number of jobs that fit on ``n_cpus``
+    divided by the mean time per image.
+    Numbers of threads that were never measured are tried in turn
+    as long as adding threads improved the throughput.
+
+    :param history: Rows of ``resources.tsv``.
+    :type history: list[dict]
+
+    :param n_cpus: Number of CPUs available.
+    :type n_cpus: int
+
+    :rtype: int
+    """
+    candidates = [x for x in THREAD_CANDIDATES if x <= n_cpus] or [1]
+
+    times: dict[int, list[float]] = {}
+    for row in history:
+        if row.get("step") != "segment" or row.get("threads") is None:
+            continue
+        if not row.get("wall_time") or not row.get("n_images"):
+            continue
+        n_images = row["n_images"] * (row.get("n_participants") or 1)
+        times.setdefault(row["threads"], []).append(
+            row["wall_time"] / n_images
+        )
+
+    def throughput(threads):
+        mean_time = sum(times[threads]) / len(times[threads])
+        return (n_cpus // threads) / mean_time
+
+    measured = [x for x in candidates if x in times]
+    untried = [x for x in candidates if x not in times]
+    # more threads are only tried while they improved the throughput
+    if untried and (
+        not measured or max(measured, key=throughput) == max(measured)
+    ):
+        logger.info(
+            f"no segmentation measured with {untried[0]} threads per job: "
+            "trying it"
+        )
+        return untried[0]
+
+    best = max(measured, key=throughput)
+    logger.info(
+        f"{best} threads per job: "
+        f"{throughput(best) * 3600:.1f} images per hour expected"
+    )
+    return best
@@ -13,6 +13,14 @@ if tmp is None:
     tmp = f".8.1_r2042_R${MCR_VERSION}"
 CAT_VERSION = " ".join(tmp[1:10].split("_"))
 
+# atlases in the template space of CAT12 used by ``--engine native``
+ATLAS_DIR = os.getenv("CAT12_ATLAS_DIR")
+if ATLAS_DIR is None:
+    ATLAS_DIR = (
+        f"{os.getenv('SPMROOT', '/opt/CAT12')}/spm12_mcr/home/gaser/gaser"
+        "/spm/spm12/toolbox/cat12/templates_MNI152NLin2009cAsym"
+    )
+
 
 def log_levels() -> list[str]:
     """Return a list of log levels."""
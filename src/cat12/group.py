@@ -0,0 +1,421 @@
+"""Aggregate the CAT12 reports of all participants into group tables.
+
+The ``report/cat_*.xml`` files give the global measures
+(TIV, tissue volumes, quality ratings)
+and the ``label/catROI_*.xml`` files the volumes of each region of each atlas.
+
+XML files are parsed in parallel by a pool of processes
+and the parsed values are cached by file size and modification time,
+so a new run only parses the reports that are new or changed.
+
+Tables are written as TSV and as Parquet when ``pyarrow`` is installed
+(``pip install cat12[group]``).
+"""
+
+from __future__ import annotations
+
+import json
+import math
+import os
+import re
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from cat12.cat_logging import cat12_log
+
+logger = cat12_log(name="cat12")
+
+# order of the tissues in vol_abs_CGW and vol_rel_CGW
+TISSUES = ("CSF", "GM", "WM", "WMH", "SL")
+
+QUALITY_RATINGS = ("IQR", "NCR", "ICR", "res_RMS", "res_ECR", "contrastR")
+
+SUBJECT_PATTERN = re.compile(r"sub-(?P<subject>[a-zA-Z0-9]+)")
+SESSION_PATTERN = re.compile(r"_ses-(?P<session>[a-zA-Z0-9]+)")
+
+CACHE_VERSION = 1
+
+
+def aggregate(
+    output_dir: Path,
+    subjects: list[str] | None = None,
+    n_jobs: int = 1,
+) -> list[Path]:
+    """Write the group tables of a CAT12 output dataset.
+
+    Tables are written in ``output_dir/group``:
+
+    - ``volumes.tsv``: TIV, absolute and relative tissue volumes
+      and quality ratings of each image,
+    - ``roi_atlas-<atlas>_<measure>.tsv``: a measure
+      (like ``Vgm``, the gray matter volume) of each region of an atlas
+      for each image.
+
+    :param output_dir: CAT12 output dataset.
+    :type output_dir: Path
+
+    :param subjects: Only include those participants. Defaults to all.
+    :type subjects: list[str], optional
+
+    :param n_jobs: Number of processes to parse the reports.
+    :type n_jobs: int
+
+    :return: The tables written.
+    :rtype: list[Path]
+    """
+    group_dir = output_dir / "group"
+    group_dir.mkdir(parents=True, exist_ok=True)
+    cache_file = group_dir / ".cache.json"
+
+    reports, rois = find_reports(output_dir, subjects)
+    logger.info(
+        f"aggregating {len(reports)} reports and {len(rois)} ROI files "
+        f"from {output_dir}"
+    )
+
+    cache = _load_cache(cache_file)
+    parsed = parse_all(
+        {
+            **dict.fromkeys(reports, parse_report),
+            **dict.fromkeys(rois, parse_roi),
+        },
+        cache,
+        n_jobs=n_jobs,
+    )
+    if parsed.keys() != cache.keys() or any(
+        parsed[key] is not cache[key] for key in parsed
+    ):
+        # keep the other participants in the cache
+        _save_cache(cache_file, {**cache, **parsed} if subjects else parsed)
+
+    outputs = []
+    if reports:
+        outputs.extend(
+            write_table(group_dir / "volumes", *volumes_table(reports, parsed))
+        )
+    for (atlas, measure), (columns, rows) in roi_tables(rois, parsed).items():
+        outputs.extend(
+            write_table(
+                group_dir / f"roi_atlas-{atlas}_{measure}", columns, rows
+            )
+        )
+
+    for output in outputs:
+        logger.info(f"wrote {output}")
+    return outputs
+
+
+def find_reports(
+    output_dir: Path, subjects: list[str] | None = None
+) -> tuple[list[str], list[str]]:
+    """List the XML reports and ROI files of some participants.
+
+    :return: Paths to the ``report/cat_*.xml``
+        and to the ``label/catROI_*.xml`` files.
+    :rtype: tuple[list[str], list[str]]
+    """
+    if subjects:
+        subject_dirs = [str(output_dir / f"sub-{label}") for label in subjects]
+    else:
+        subject_dirs = sorted(
+            entry.path
+            for entry in os.scandir(output_dir)
+            if entry.name.startswith("sub-") and entry.is_dir()
+        )
+    found: dict[str, list[str]] = {"report": [], "label": []}
+    for subject_dir in subject_dirs:
+        _find_xml(subject_dir, found)
+    return found["report"], found["label"]
+
+
+def _find_xml(directory: str, found: dict[str, list[str]]) -> None:
+    try:
+        entries = sorted(os.scandir(directory), key=lambda x: x.name)
+    except (FileNotFoundError, NotADirectoryError):
+        return
+    for entry in entries:
+        if not entry.is_dir():
+            continue
+        if entry.name in found:
+            prefix = "cat_" if entry.name == "report" else "catROI_"
+            found[entry.name].extend(
+                x.path
+                for x in sorted(os.scandir(entry.path), key=lambda x: x.name)
+                if x.name.startswith(prefix) and x.name.endswith(".xml")
+            )
+        else:
+            _find_xml(entry.path, found)
+
+
+def parse_all(files: dict[str, object], cache: dict, n_jobs: int = 1) -> dict:
+    """Parse the files that are not in the cache.
+
+    :param files: Map of the files to parse to the function parsing them.
+    :param cache: Map of file paths to their size, modification time
+        and parsed content.
+
+    :return: The updated cache for the files passed.
+    """
+    parsed = {}
+    todo = []
+    for path in files:
+        stat = Path(path).stat()
+        cached = cache.get(path)
+        if cached and tuple(cached[:2]) == (stat.st_size, stat.st_mtime_ns):
+            parsed[path] = cached
+        else:
+            todo.append((path, stat))
+
+    logger.info(f"parsing {len(todo)} new or modified files")
+    if not todo:
+        return parsed
+
+    paths = [path for path, _ in todo]
+    funcs = [files[path] for path in paths]
+    if n_jobs > 1 and len(todo) > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(
+                executor.map(
+                    _parse,
+                    funcs,
+                    paths,
+                    chunksize=max(len(todo) // (4 * n_jobs), 1),
+                )
+            )
+    else:
+        results = [_parse(func, path) for func, path in zip(funcs, paths)]
+
+    for (path, stat), result in zip(todo, results):
+        parsed[path] = (stat.st_size, stat.st_mtime_ns, result)
+    return parsed
+
+
+def _parse(func, path: str):
+    try:
+        return func(path)
+    except ET.ParseError as exc:
+        logger.warning(f"Could not parse {path}: {exc}")
+        return {}
+
+
+def parse_report(path: str | Path) -> dict[str, float]:
+    """Return the TIV, tissue volumes and quality ratings of a CAT12 report.
+
+    Only the ``subjectmeasures`` and ``qualityratings`` sections are read:
+    parsing stops once both have been found.
+    """
+    values: dict[str, float] = {}
+    found = set()
+    with Path(path).open("rb") as f:
+        for _, element in ET.iterparse(f, events=("end",)):
+            if element.tag == "subjectmeasures":
+                found.add(element.tag)
+                values["TIV"] = _scalar(element.findtext("vol_TIV"))
+                for name, prefix in (
+                    ("vol_abs_CGW", ""),
+                    ("vol_rel_CGW", "rel_"),
+                ):
+                    volumes = parse_array(element.findtext(name))
+                    for tissue, volume in zip(TISSUES, volumes):
+                        values[f"{prefix}{tissue}"] = volume
+            elif element.tag == "qualityratings":
+                found.add(element.tag)
+                for name in QUALITY_RATINGS:
+                    if element.find(name) is not None:
+                        values[name] = _scalar(element.findtext(name))
+            if len(found) == 2:
+                break
+    return values
+
+
+def parse_roi(path: str | Path) -> dict[str, tuple]:
+    """Return the region names and measures of each atlas of a ROI file.
+
+    The values of each measure are kept as a single tab separated string,
+    ready to be written to a TSV, which is much cheaper to cache
+    than a number per region.
+
+    :return: Map of atlas names to the names of their regions
+        and a map of measure names (like ``Vgm``)
+        to the tab separated values of each region.
+    :rtype: dict[str, tuple[tuple[str, ...], dict[str, str]]]
+    """
+    root = ET.parse(path).getroot()
+    atlases = {}
+    for atlas in root:
+        names = tuple(item.text or "" for item in atlas.iterfind("names/item"))
+        data = atlas.find("data")
+        if not names or data is None:
+            continue
+        atlases[atlas.tag] = (
+            names,
+            {
+                measure.tag: "\t".join(_tokens(measure.text))
+                for measure in data
+            },
+        )
+    return atlases
+
+
+def parse_array(text: str | None) -> list[float]:
+    """Parse a MATLAB array like ``[1 2 3]`` or ``[1;2;3]``."""
+    return [_scalar(x) for x in _tokens(text)]
+
+
+def _tokens(text: str | None) -> list[str]:
+    if not text:
+        return []
+    return [
+        "n/a" if x == "NaN" else x
+        for x in re.split(r"[\s;,]+", text.strip("[] \n"))
+        if x
+    ]
+
+
+def _scalar(text: str | None) -> float:
+    try:
+        return float(text)  # type: ignore[arg-type]
+    except (TypeError, ValueError):
+        return float("nan")
+
+
+ENTITY_COLUMNS = ["participant_id", "session_id", "source"]
+
+
+def entities(path: str, prefix: str) -> list[str]:
+    """Return the participant, session and source image of a report."""
+    source = path[path.rfind(os.sep) + 1 + len(prefix) : -len(".xml")]
+    subject = SUBJECT_PATTERN.search(source)
+    session = SESSION_PATTERN.search(source)
+    return [
+        f"sub-{subject['subject']}" if subject else "n/a",
+        f"ses-{session['session']}" if session else "n/a",
+        source,
+    ]
+
+
+def volumes_table(
+    reports: list[str], parsed: dict
+) -> tuple[list[str], list[list]]:
+    """Build the table of global measures with one row per image."""
+    values = [parsed[path][2] for path in reports]
+    columns = list(dict.fromkeys(key for row in values for key in row))
+    rows = [
+        [*entities(path, "cat_"), *(row.get(col, "n/a") for col in columns)]
+        for path, row in zip(reports, values)
+    ]
+    return ENTITY_COLUMNS + columns, rows
+
+
+def roi_tables(
+    rois: list[str], parsed: dict
+) -> dict[tuple[str, str], tuple[list[str], list[list]]]:
+    """Build a table per atlas and measure with one row per image.
+
+    The columns are the regions of the first image:
+    regions missing for an image are ``n/a``.
+    """
+    tables: dict[tuple[str, str], tuple[list[str], list[list]]] = {}
+    regions: dict[str, tuple[str, ...]] = {}
+    for path in rois:
+        row = entities(path, "catROI_")
+        for atlas, (names, measures) in parsed[path][2].items():
+            # lists when read from the cache
+            names = tuple(names)
+            regions.setdefault(atlas, names)
+            for measure, values in measures.items():
+                if (atlas, measure) not in tables:
+                    tables[atlas, measure] = (
+                        ENTITY_COLUMNS + list(regions[atlas]),
+                        [],
+                    )
+                rows = tables[atlas, measure][1]
+                if names == regions[atlas]:
+                    rows.append([*row, values])
+                else:
+                    by_name = dict(zip(names, values.split("\t")))
+                    rows.append(
+                        row
+                        + [by_name.get(name, "n/a") for name in regions[atlas]]
+                    )
+    return tables
+
+
+def write_table(
+    stem: Path, columns: list[str], rows: list[list]
+) -> list[Path]:
+    """Write a table as a TSV and as Parquet if pyarrow is installed.
+
+    A cell can hold several tab separated values.
+
+    Missing values are written as ``n/a`` in the TSV
+    and as nulls in Parquet.
+    A table without rows keeps its columns in both formats.
+    """
+    tsv = stem.with_suffix(".tsv")
+    tmp = tsv.with_name(f".tmp_{tsv.name}")
+    with tmp.open("w") as f:
+        f.write("\t".join(columns) + "\n")
+        f.writelines("\t".join(map(_cell, row)) + "\n" for row in rows)
+    tmp.replace(tsv)
+    outputs = [tsv]
+
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        logger.debug("pyarrow is not installed: not writing Parquet files")
+        return outputs
+
+    cells = ("\t".join(map(_cell, row)).split("\t") for row in rows)
+    table = pa.table(
+        {
+            col: (
+                pa.array(values, type=pa.string())
+                if col in ENTITY_COLUMNS
+                else pa.array(_numbers(values), type=pa.float64())
+            )
+            for col, values in zip(
+                columns, list(zip(*cells)) or [()] * len(columns)
+            )
+        }
+    )
+    parquet = stem.with_suffix(".parquet")
+    pq.write_table(table, parquet)
+    outputs.append(parquet)
+    return outputs
+
+
+def _cell(value) -> str:
+    if isinstance(value, float) and math.isnan(value):
+        return "n/a"
+    return str(value)
+
+
+def _numbers(values) -> list[float | None]:
+    return [None if x == "n/a" else float(x) for x in values]
+
+
+def _load_cache(cache_file: Path) -> dict:
+    if not cache_file.exists():
+        return {}
+    try:
+        with cache_file.open() as f:
+            content = json.load(f)
+        if content.get("version") != CACHE_VERSION:
+            return {}
+        return {
+            path: (size, mtime_ns, values)
+            for path, (size, mtime_ns, values) in content["files"].items()
+        }
+    except (OSError, ValueError, TypeError, KeyError, AttributeError):
+        logger.warning(f"Ignoring invalid cache {cache_file}")
+        return {}
+
+
+def _save_cache(cache_file: Path, cache: dict) -> None:
+    tmp = cache_file.with_name(f".tmp_{cache_file.name}")
+    with tmp.open("w") as f:
+        json.dump({"version": CACHE_VERSION, "files": cache}, f)
+    tmp.replace(cache_file)
@@ -0,0 +1,270 @@
+"""Share the participants of a dataset between several workers.
+
+Several ``cat12 ... segment`` processes, on one or many nodes,
+can use the same output dataset: each participant is processed
+by the worker that holds its lease.
+
+A lease is a file in ``logs/leases`` of the output dataset
+created with ``O_CREAT | O_EXCL``, which is atomic on local file systems
+and on NFS (v3 and later), so only one worker can create it.
+The worker holding leases refreshes their modification time
+every ``HEARTBEAT_INTERVAL`` from a background thread.
+A lease that has not been refreshed for ``LEASE_TIMEOUT``
+belongs to a dead worker and can be reclaimed by any other worker.
+A worker that finds one of its leases held by another worker
+stops processing the participant and leaves its records to the new holder.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+from cat12.cat_logging import cat12_log
+
+logger = cat12_log(name="cat12")
+
+# seconds between two refreshes of the leases held by a worker
+HEARTBEAT_INTERVAL = 30.0
+
+# seconds after which a lease that was not refreshed can be reclaimed
+LEASE_TIMEOUT = 300.0
+
+
+def is_dead(owner: str | None) -> bool:
+    """Tell if the worker owning a lease is known to have stopped.
+
+    Only workers on this host can be checked:
+    the others are assumed to be running.
+
+    :param owner: Owner of a lease, as ``host:pid:id``.
+    :type owner: str | None
+    """
+    try:
+        host, pid, _ = owner.split(":")
+        pid = int(pid)
+    except (AttributeError, ValueError):
+        return False
+    if host != socket.gethostname():
+        return False
+    if pid == os.getpid():
+        # an earlier run that had the same process id (e.g. in a container)
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+class LeaseQueue:
+    """Claim participants with lease files.
+
+    Use as a context manager to refresh the leases in the background
+    and release those still held on exit.
+
+    :param directory: Where the lease files are.
+    :type directory: Path
+
+    :param timeout: Seconds after which a lease can be reclaimed.
+    :type timeout: float
+
+    :param heartbeat: Seconds between two refreshes of the leases.
+    :type heartbeat: float
+
+    :param on_lost: Called from the background thread
+        with the label of each participant whose lease was lost.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        timeout: float = LEASE_TIMEOUT,
+        heartbeat: float = HEARTBEAT_INTERVAL,
+        on_lost=None,
+    ):
+        self.directory = directory
+        self.timeout = timeout
+        self.heartbeat = heartbeat
+        self.on_lost = on_lost
+        self.owner = (
+            f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        )
+        self.held: set[str] = set()
+        # participants whose lease another worker held, with its owner
+        self.skipped: dict[str, str | None] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def __enter__(self) -> LeaseQueue:
+        """Start refreshing the leases in the background."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._beat, name="cat12-leases", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        """Stop refreshing the leases and release those still held."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        for label in list(self.held):
+            self.release(label)
+
+    def path(self, label: str) -> Path:
+        """Return the lease file of a participant."""
+        return self.directory / f"sub-{label}.lease"
+
+    def claim(self, label: str) -> bool:
+        """Try to take the lease of a participant.
+
+        :return: True if this worker now holds the lease.
+        :rtype: bool
+        """
+        path = self.path(label)
+        if self._create(path):
+            with self._lock:
+                self.held.add(label)
+            return True
+        if self._reclaim(path) and self._create(path):
+            with self._lock:
+                self.held.add(label)
+            return True
+        self.skipped[label] = self._owner(path)
+        return False
+
+    def holds(self, label: str) -> bool:
+        """Check that this worker still holds the lease of a participant."""
+        with self._lock:
+            if label not in self.held:
+                return False
+        return self._check(label)
+
+    def release(self, label: str) -> None:
+        """Give back the lease of a participant."""
+        path = self.path(label)
+        # under the lock so that the heartbeat cannot create it again
+        with self._lock:
+            self.held.discard(label)
+            if self._owner(path) == self.owner:
+                path.unlink(missing_ok=True)
+
+    def _create(self, path: Path) -> bool:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            json.dump(
+                {
+                    "owner": self.owner,
+                    "acquired": datetime.now().isoformat(timespec="seconds"),
+                },
+                f,
+            )
+        return True
+
+    def _reclaim(self, path: Path) -> bool:
+        """Remove a lease that was not refreshed for ``timeout``.
+
+        The stale lease is first renamed to a name unique to this worker,
+        which only one worker can do.
+        If the lease was refreshed or replaced in the meantime
+        it is put back, unless its holder already created it again
+        when it found it missing (see :meth:`_check`).
+        """
+        try:
+            age = time.time() - path.stat().st_mtime
+        except FileNotFoundError:
+            return True
+        if age < self.timeout:
+            return False
+
+        stale_owner = self._owner(path)
+        moved = path.with_name(f".{path.name}.{uuid.uuid4().hex[:8]}")
+        try:
+            path.rename(moved)
+        except FileNotFoundError:
+            # reclaimed by another worker
+            return False
+        try:
+            if (
+                self._owner(moved) != stale_owner
+                or time.time() - moved.stat().st_mtime < self.timeout
+            ):
+                # this was a new lease: give it back
+                try:
+                    os.link(moved, path)
+                except FileExistsError:
+                    pass
+                return False
+            logger.warning(
+                f"Reclaiming {path.name} from {stale_owner} "
+                f"(not refreshed for {age:.0f} s)."
+            )
+            return True
+        finally:
+            moved.unlink(missing_ok=True)
+
+    def _owner(self, path: Path) -> str | None:
+        try:
+            with path.open() as f:
+                return json.load(f).get("owner")
+        except (OSError, ValueError):
+            return None
+
+    def _check(self, label: str) -> bool:
+        """Check the owner of a lease and forget it if it was lost."""
+        path = self.path(label)
+        owner = self._owner(path)
+        if owner is None:
+            with self._lock:
+                if label not in self.held:
+                    # released in the meantime
+                    return False
+                if not path.exists() and self._create(path):
+                    # a worker reclaiming it renamed it for a moment
+                    # (see _reclaim) or it was removed: take it back
+                    owner = self.owner
+            if owner is None:
+                owner = self._owner(path)
+        if owner == self.owner:
+            return True
+        with self._lock:
+            if label not in self.held:
+                return False
+            self.held.discard(label)
+        logger.warning(
+            f"Lost the lease of sub-{label}: "
+            "it was reclaimed by another worker."
+        )
+        if self.on_lost is not None:
+            self.on_lost(label)
+        return False
+
+    def _beat(self) -> None:
+        while not self._stop.wait(self.heartbeat):
+            with self._lock:
+                held = list(self.held)
+            for label in held:
+                if not self._check(label):
+                    continue
+                with self._lock:
+                    if label not in self.held:
+                        continue
+                    try:
+                        os.utime(self.path(label))
+                    except FileNotFoundError:
+                        pass
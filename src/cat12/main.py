@@ -1,29 +1,69 @@
 """Run CAT12 BIDS app."""
 
+from __future__ import annotations
+
+import asyncio
 import json
 import os
+import resource
 import shutil
 import subprocess
 import sys
+import tempfile
+import time
+from contextlib import ExitStack
 from datetime import datetime
 from pathlib import Path
-from subprocess import PIPE, STDOUT, Popen
+from typing import NamedTuple
 
-import nibabel as nib
 from cat12._version import __version__
 from rich import print
 from rich_argparse import RichHelpFormatter
 
-from cat12._parsers import common_parser
+from cat12._parsers import common_parser, segment_options
+from cat12.accounting import ResourceLog, read_resources, to_mb
+from cat12.bids_filter import compile_filter, load_filter, query_layout
 from cat12.bids_utils import (
     get_dataset_layout,
-    init_derivatives_layout,
     list_subjects,
+    write_dataset_description,
 )
 from cat12.cat_logging import cat12_log
+from cat12.compression import compress_niftis
+from cat12.costs import historical_costs, image_voxels, participant_costs
+from cat12.cpus import available_cpus, choose_threads, split_cpus, thread_env
 from cat12.defaults import CAT_VERSION, log_levels
+from cat12.group import aggregate
+from cat12.leases import LeaseQueue, is_dead
+from cat12.manifest import Manifest, skip_done
+from cat12.mcr_cache import (
+    McrCaches,
+    cache_env,
+    default_cache_dir,
+    mark_warm,
+)
+from cat12.memory import (
+    BUDGET_FRACTION,
+    MemoryBudget,
+    MemoryModel,
+    available_memory,
+    parse_memory,
+)
 from cat12.methods import generate_method_section
-from cat12.utils import progress_bar
+from cat12.postprocessing import (
+    BATCHES,
+    batch_command,
+    find_derivatives,
+    merge_shards,
+    split_files,
+)
+from cat12.result_cache import ResultCache
+from cat12.scanner import find_t1w
+from cat12.sharding import balance, select_shard, shard_from_env, write_plan
+from cat12.staging import stage_files, staged_path
+from cat12.supervisor import CommandResult, supervise
+from cat12.utils import create_dir_if_absent, progress_bar
+from cat12.validation import validate
 
 env = os.environ
 env["PYTHONUNBUFFERED"] = "True"
@@ -87,6 +127,10 @@ def main():
 
         sys.exit(EXIT_CODES["SUCCESS"]["Value"])
 
+    elif command == "warmup":
+        warmup(args)
+        sys.exit(EXIT_CODES["SUCCESS"]["Value"])
+
     bids_dir = Path(args.bids_dir[0])
     if not bids_dir.exists():
         logger.error(
@@ -94,93 +138,1457 @@ def main():
         )
         sys.exit(EXIT_CODES["DATAERR"]["Value"])
 
-    if not args.skip_validation:
-        run_validation(bids_dir)
-
-    layout_in = get_dataset_layout(bids_dir)
+    n_jobs = args.n_jobs
+    if isinstance(n_jobs, list):
+        n_jobs = n_jobs[0]
 
-    subjects = args.participant_label or layout_in.get_subjects()
-    subjects = list_subjects(layout_in, subjects)
+    if command in BATCHES:
+        engine = getattr(args, "engine", "cat12")
+        if isinstance(engine, list):
+            engine = engine[0]
+        if engine == "native":
+            native_postprocess(command, output_dir, args, n_jobs=n_jobs)
+        else:
+            postprocess(command, output_dir, args, n_jobs=n_jobs)
+        sys.exit(EXIT_CODES["SUCCESS"]["Value"])
 
     analysis_level = args.analysis_level[0]
     if analysis_level == "group":
-        logger.error("'group' level analysis not implemented yet.")
-        sys.exit(EXIT_CODES["FAILURE"]["Value"])
+        cat12_dir = output_dir / f"CAT12_{__version__}"
+        if not cat12_dir.is_dir():
+            logger.error(
+                f"No participant level outputs found in:\n{cat12_dir}"
+            )
+            sys.exit(EXIT_CODES["DATAERR"]["Value"])
+        run_validation(bids_dir, output_dir, args, args.participant_label)
+        aggregate(cat12_dir, subjects=args.participant_label, n_jobs=n_jobs)
+        sys.exit(EXIT_CODES["SUCCESS"]["Value"])
+
+    inputs = find_inputs(bids_dir, output_dir, args, n_jobs=n_jobs)
+
+    if command == "plan":
+        run_validation(bids_dir, output_dir, args, list(inputs))
+        plan(inputs, bids_dir, output_dir, args)
+        sys.exit(EXIT_CODES["SUCCESS"]["Value"])
+
+    shard = shard_options(args)
+    if shard is not None:
+        try:
+            inputs = select_shard(inputs, participant_costs(inputs), *shard)
+        except ValueError as exc:
+            logger.error(exc)
+            sys.exit(EXIT_CODES["USAGE"]["Value"])
 
     if command == "segment":
-        segment_type = args.type
-        if isinstance(segment_type, list):
-            segment_type = segment_type[0]
+        run_validation(bids_dir, output_dir, args, list(inputs))
+        segment(inputs, bids_dir, output_dir, args, n_jobs=n_jobs)
+
+    sys.exit(EXIT_CODES["SUCCESS"]["Value"])
+
+
+def segment(
+    inputs: dict[str, list],
+    bids_dir: Path,
+    output_dir: Path,
+    args,
+    n_jobs: int = 1,
+) -> None:
+    """Segment the T1w images of each participant with CAT12.
+
+    Exits with an error if any participant failed.
+    """
+    segment_type = args.type
+    if isinstance(segment_type, list):
+        segment_type = segment_type[0]
+
+    output_dir = output_dir / f"CAT12_{__version__}"
+
+    batch = define_batch(segment_type=segment_type)
+
+    batch_size = args.batch_size
+    if isinstance(batch_size, list):
+        batch_size = batch_size[0]
+
+    n_jobs, cpu_sets = cpu_budget(args, output_dir, n_jobs=n_jobs)
+    memory = memory_budget(args, output_dir)
+
+    resources = ResourceLog(
+        output_dir,
+        run_info={
+            "version": __version__,
+            "cat_version": CAT_VERSION,
+            "segment_type": segment_type,
+            "batch": batch,
+            "n_jobs": n_jobs,
+            "threads_per_job": len(cpu_sets[0]),
+            "batch_size": batch_size,
+        },
+    )
+
+    manifest = None
+    if segment_type != "enigma":
+        manifest = Manifest(output_dir, batch)
+        inputs, identities = skip_done(inputs, manifest, n_jobs=n_jobs)
+
+    inputs, invalid = preflight(
+        inputs, output_dir, args, n_jobs=n_jobs, resources=resources
+    )
+
+    if segment_type != "enigma":
+        create_dir_if_absent(output_dir)
+        write_dataset_description(output_dir)
+        to_process = {
+            subject_label: [
+                str(staged_path(output_dir, file.relpath)) for file in bf
+            ]
+            for subject_label, bf in inputs.items()
+        }
+        for bf in inputs.values():
+            for file in bf:
+                manifest.register(
+                    staged_path(output_dir, file.relpath),
+                    identities[file.relpath],
+                )
+
+        def stage(participants):
+            # only once the participants are claimed by this worker
+            copy_files(
+                {label: inputs[label] for label, _ in participants},
+                output_dir,
+                n_jobs=n_jobs,
+                resources=resources,
+                hardlink=args.hardlink_inputs,
+            )
 
-        output_dir = output_dir / f"CAT12_{__version__}"
+    else:
+        stage = None
+        os.environ["OUTPUT_DIR"] = os.path.relpath(output_dir, bids_dir)
+        to_process = {
+            subject_label: [file.path for file in bf]
+            for subject_label, bf in inputs.items()
+        }
 
-        if segment_type != "enigma":
-            copy_files(layout_in, output_dir, subjects)
-            layout_out = init_derivatives_layout(output_dir)
+    logger.info(f"{segment_type=} - using batch {batch}.")
+
+    (output_dir / "logs").mkdir(exist_ok=True, parents=True)
+    shutil.copy2(src=STANDALONE / batch, dst=output_dir / "logs")
+
+    generate_method_section(output_dir=output_dir, batch=batch)
+
+    jobs = []
+    for subject_label in to_process:
+        # SPM cannot read compressed images
+        bf = [
+            file for file in to_process[subject_label] if file.endswith(".nii")
+        ]
+
+        if not check_input(subject_label, bf, segment_type):
+            continue
+
+        jobs.append((subject_label, bf))
+
+    jobs = schedule_jobs(jobs, inputs, output_dir, args, n_jobs=n_jobs)
+
+    with ExitStack() as stack:
+        leases = stack.enter_context(
+            LeaseQueue(output_dir / "logs" / "leases")
+        )
+        caches = stack.enter_context(
+            McrCaches(mcr_cache_dir(args), n_workers=n_jobs)
+        )
+        failures = run_participants(
+            jobs=jobs,
+            output_dir=output_dir,
+            segment_type=segment_type,
+            batch=batch,
+            n_jobs=n_jobs,
+            batch_size=batch_size,
+            compression=compression_options(args, n_jobs),
+            manifest=manifest,
+            resources=resources,
+            leases=leases,
+            stage=stage,
+            caches=caches,
+            cpu_sets=cpu_sets,
+            memory=memory,
+            results=result_cache(args, batch, segment_type),
+        )
+
+    failures.update(report_skipped(leases))
+
+    resources.run_info.update(
+        {
+            "n_participants": len(jobs),
+            "n_failures": len(failures),
+            "n_invalid": len(invalid),
+            "n_skipped": len(leases.skipped),
+        }
+    )
+    resources.write_summary()
+
+    failures = {**invalid, **failures}
+    if failures:
+        logger.error(
+            f"{len(failures)} / {len(jobs) + len(invalid)} "
+            "participant(s) failed:\n"
+            + "\n".join(
+                f"\tsub-{label}: {error}" for label, error in failures.items()
+            )
+        )
+        sys.exit(EXIT_CODES["FAILURE"]["Value"])
+
+
+def warmup(args) -> None:
+    """Extract the MATLAB runtime in the cache of each parallel job."""
+    n_jobs = args.n_jobs
+    if isinstance(n_jobs, list):
+        n_jobs = n_jobs[0]
+
+    with McrCaches(mcr_cache_dir(args), n_workers=n_jobs) as caches:
+        for slot in caches.slots:
+            try:
+                caches.warm(slot, STANDALONE, env)
+            except (OSError, RuntimeError) as exc:
+                logger.error(exc)
+                sys.exit(EXIT_CODES["FAILURE"]["Value"])
+            logger.info(f"MCR cache ready in {slot}")
+
+
+def postprocess(command: str, output_dir: Path, args, n_jobs: int = 1):
+    """Run a post-processing batch on the outputs of the participants.
+
+    The inputs are split in up to ``n_jobs`` shards
+    processed by parallel calls to CAT12
+    and the tables of the shards are merged in ``group``
+    (see :mod:`cat12.postprocessing`).
+    Compressed images are staged uncompressed as SPM cannot read them.
+
+    Exits with an error if no input is found or if a call fails.
+    """
+    batch = BATCHES[command]
+    output_dir = output_dir / f"CAT12_{__version__}"
+    files = []
+    if output_dir.is_dir():
+        files = find_derivatives(output_dir, batch, args.participant_label)
+    if not files:
+        logger.error(
+            f"No {batch.folder}/{batch.prefix}* file found in:\n{output_dir}"
+        )
+        sys.exit(EXIT_CODES["DATAERR"]["Value"])
+
+    arguments = batch.arguments
+    if command == "resample":
+        fwhm = args.fwhm[0] if isinstance(args.fwhm, list) else args.fwhm
+        # smoothing and resampling to the 32k mesh
+        arguments = (f"{fwhm:g}", "1")
+
+    group_dir = output_dir / "group"
+    group_dir.mkdir(parents=True, exist_ok=True)
+    (output_dir / "logs").mkdir(parents=True, exist_ok=True)
+    resources = ResourceLog(output_dir)
+
+    with ExitStack() as stack:
+        tmp = Path(
+            stack.enter_context(
+                tempfile.TemporaryDirectory(dir=group_dir, prefix=".shards_")
+            )
+        )
+        staged = stage_compressed(files, output_dir, tmp / "staged", n_jobs)
+        shards = split_files(staged, n_jobs)
+        n_jobs, cpu_sets = cpu_budget(args, output_dir, n_jobs=len(shards))
+        caches = stack.enter_context(
+            McrCaches(mcr_cache_dir(args), n_workers=len(shards))
+        )
+        shard_dirs = [tmp / f"shard-{i}" for i in range(len(shards))]
+        cmds = []
+        for shard, shard_dir in zip(shards, shard_dirs):
+            shard_dir.mkdir()
+            output = shard_dir / batch.output if batch.output else None
+            cmds.append(
+                batch_command(STANDALONE, command, shard, output, arguments)
+            )
+
+        logger.info(
+            f"running {command} on {len(files)} files "
+            f"with {len(shards)} calls to CAT12"
+        )
+        results = asyncio.run(
+            _run_shards(cmds, output_dir, command, caches, cpu_sets)
+        )
+
+        for shard, result in zip(shards, results):
+            resources.add(
+                participant_id="n/a",
+                step=command,
+                start=result.start,
+                n_images=len(shard),
+                threads=len(cpu_sets[0]),
+                **result_measures(result.result),
+            )
+        failed = [x for x in results if x.result.returncode != 0]
+        if failed:
+            logger.error(
+                f"{len(failed)} / {len(results)} call(s) to CAT12 failed:\n"
+                + "\n".join(f"\t{x.log}" for x in failed)
+            )
+            sys.exit(EXIT_CODES["FAILURE"]["Value"])
+
+        if batch.output:
+            tables = merge_shards(
+                shard_dirs,
+                group_dir,
+                replace={str(tmp / "staged"): str(output_dir)},
+            )
+            for table in tables:
+                logger.info(f"wrote {table}")
+            inputs = group_dir / f"{Path(batch.output).stem}_inputs.txt"
+            inputs.write_text("".join(f"{x}\n" for x in files))
+
+
+def native_postprocess(command: str, output_dir: Path, args, n_jobs: int = 1):
+    """Compute the TIV or the ROI values with NumPy instead of CAT12.
+
+    The modulated tissue maps of the participants are read
+    by ``n_jobs`` processes and the tables are written in ``group/native``
+    (see :mod:`cat12.roi`).
+
+    Exits with an error if no map or no atlas is found.
+    """
+    # imports numpy and nibabel
+    from cat12.roi import GM_MAPS, find_atlases, write_rois, write_tiv
+
+    logger.warning(
+        "--engine native is experimental: its values are computed "
+        "in template space and only approximate those of CAT12."
+    )
+
+    output_dir = output_dir / f"CAT12_{__version__}"
+    gm_maps = []
+    if output_dir.is_dir():
+        gm_maps = find_derivatives(output_dir, GM_MAPS, args.participant_label)
+    if not gm_maps:
+        logger.error(
+            f"No {GM_MAPS.folder}/{GM_MAPS.prefix}* file found in:\n"
+            f"{output_dir}"
+        )
+        sys.exit(EXIT_CODES["DATAERR"]["Value"])
+
+    group_dir = output_dir / "group" / "native"
+    start = datetime.now()
+    tic = time.perf_counter()
+    usage = _rusage()
+
+    if command == "get_TIV":
+        tables = write_tiv(gm_maps, group_dir, n_jobs=n_jobs)
+    else:
+        atlas_dir = Path(args.atlas_dir[0])
+        try:
+            atlases = find_atlases(atlas_dir, args.atlas)
+        except FileNotFoundError as exc:
+            logger.error(exc)
+            sys.exit(EXIT_CODES["DATAERR"]["Value"])
+        if not atlases:
+            logger.error(f"No atlas found in:\n{atlas_dir}")
+            sys.exit(EXIT_CODES["DATAERR"]["Value"])
+        logger.info(f"atlases: {', '.join(atlas.name for atlas in atlases)}")
+        tables = write_rois(gm_maps, atlases, group_dir, n_jobs=n_jobs)
+
+    end_usage = _rusage()
+    ResourceLog(output_dir).add(
+        participant_id="n/a",
+        step=f"{command}_native",
+        start=start.isoformat(timespec="seconds"),
+        n_images=len(gm_maps),
+        threads=n_jobs,
+        wall_time=time.perf_counter() - tic,
+        user_time=end_usage[0] - usage[0],
+        system_time=end_usage[1] - usage[1],
+    )
+    logger.info(
+        f"{command}: {len(gm_maps)} images "
+        f"in {time.perf_counter() - tic:.1f} s"
+    )
+    for table in tables:
+        logger.info(f"wrote {table}")
+
+
+def _rusage() -> tuple[float, float]:
+    """Return the user and system time of the app and of its children."""
+    usage = [
+        resource.getrusage(who)
+        for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)
+    ]
+    return (
+        sum(x.ru_utime for x in usage),
+        sum(x.ru_stime for x in usage),
+    )
+
+
+class _ShardResult(NamedTuple):
+    start: str
+    log: Path
+    result: CommandResult
+
+
+async def _run_shards(
+    cmds: list[list[str]],
+    output_dir: Path,
+    command: str,
+    caches: McrCaches,
+    cpu_sets: list[list[int]],
+) -> list[_ShardResult]:
+    """Run the calls of a post-processing batch concurrently."""
+    now = datetime.now().replace(microsecond=0).isoformat()
+
+    async def run(index, cmd):
+        slot = caches.slots[index]
+        caches.copy_warm(slot)
+        cpus = cpu_sets[index]
+        log_file = (
+            output_dir
+            / "logs"
+            / (f"{now}_{command}_shard-{index}.log".replace(":", "_"))
+        )
+        logger.info(cmd if len(cmds) == 1 else f"{cmd[0]} ... > {log_file}")
+        with log_file.open("w") as log:
+            result = await supervise(
+                cmd,
+                log,
+                env=thread_env(cache_env(env, slot), cpus),
+                echo=len(cmds) == 1,
+                cpus=cpus,
+            )
+            log.write(f"{result.summary()}\n")
+        if result.returncode == 0:
+            mark_warm(slot)
+        return _ShardResult(now, log_file, result)
+
+    return await asyncio.gather(
+        *(run(index, cmd) for index, cmd in enumerate(cmds))
+    )
+
+
+def stage_compressed(
+    files: list[str], output_dir: Path, staging_dir: Path, n_jobs: int = 1
+) -> list[str]:
+    """Stage the compressed images uncompressed in a temporary folder.
+
+    Exits with an error if an image cannot be staged.
+
+    :return: The files with the compressed images replaced.
+    :rtype: list[str]
+    """
+    staged = [
+        str(staged_path(staging_dir, os.path.relpath(x, output_dir)))
+        if x.endswith(".nii.gz")
+        else x
+        for x in files
+    ]
+    pairs = [(Path(x), Path(y)) for x, y in zip(files, staged) if x != y]
+    failures = stage_files(pairs, n_jobs=n_jobs)
+    if failures:
+        logger.error(
+            f"{len(failures)} file(s) could not be staged:\n"
+            + "\n".join(
+                f"\t{file}: {error}" for file, error in failures.items()
+            )
+        )
+        sys.exit(EXIT_CODES["FAILURE"]["Value"])
+    return staged
+
+
+def cpu_budget(
+    args, output_dir: Path, n_jobs: int = 1
+) -> tuple[int, list[list[int]]]:
+    """Split the available CPUs between the parallel jobs.
+
+    Each job gets ``--threads_per_job`` CPUs
+    or an equal share of the available CPUs.
+    With ``--threads_per_job auto`` the number of threads
+    is chosen from the previous runs (see :func:`cat12.cpus.choose_threads`)
+    and as many jobs as fit on the available CPUs are run.
+
+    :return: The number of jobs and the CPUs of each job.
+    :rtype: tuple[int, list[list[int]]]
+    """
+    cpus = available_cpus()
+
+    threads = getattr(args, "threads_per_job", None)
+    if isinstance(threads, list):
+        threads = threads[0]
+    if threads == "auto":
+        threads = choose_threads(read_resources(output_dir), len(cpus))
+        n_jobs = max(len(cpus) // threads, 1)
+    elif threads is None:
+        threads = max(len(cpus) // max(n_jobs, 1), 1)
+
+    logger.info(
+        f"{n_jobs} jobs with {threads} CPUs each ({len(cpus)} CPUs available)"
+    )
+    return n_jobs, split_cpus(cpus, max(n_jobs, 1), threads)
+
+
+def memory_budget(args, output_dir: Path) -> MemoryBudget:
+    """Return the memory budget shared by the parallel jobs.
+
+    ``--mem_budget`` or a share of the memory available.
+    The memory of each job is estimated by a model
+    fitted on the previous runs (see :meth:`cat12.memory.MemoryModel.fit`).
+
+    Exits with an error if ``--mem_budget`` cannot be read.
+    """
+    budget = getattr(args, "mem_budget", None)
+    if isinstance(budget, list):
+        budget = budget[0]
+    if budget is None:
+        budget = BUDGET_FRACTION * available_memory()
+    else:
+        try:
+            budget = parse_memory(budget)
+        except ValueError:
+            logger.error(f"Invalid memory budget: {budget}")
+            sys.exit(EXIT_CODES["USAGE"]["Value"])
+
+    model = MemoryModel.fit(read_resources(output_dir))
+    logger.info(f"memory budget: {budget:.0f} MB - model: {model}")
+    return MemoryBudget(budget, model)
+
+
+def result_cache(args, batch: str, segment_type: str) -> ResultCache | None:
+    """Return the cache of the outputs of images or None if not used.
+
+    Exits with an error if ``--result_cache_size`` cannot be read.
+    """
+    cache_dir = getattr(args, "result_cache_dir", None)
+    if isinstance(cache_dir, list):
+        cache_dir = cache_dir[0]
+    if not cache_dir:
+        return None
+    if segment_type not in ("default", "simple"):
+        logger.warning(
+            f"The outputs of {segment_type} segmentations are not cached."
+        )
+        return None
+
+    max_size = args.result_cache_size
+    if isinstance(max_size, list):
+        max_size = max_size[0]
+    try:
+        max_size = parse_memory(max_size)
+    except ValueError:
+        logger.error(f"Invalid result cache size: {max_size}")
+        sys.exit(EXIT_CODES["USAGE"]["Value"])
+
+    logger.info(f"result cache: {cache_dir} (up to {max_size:.0f} MB)")
+    return ResultCache(
+        Path(cache_dir),
+        STANDALONE / batch,
+        max_size=max_size,
+        compressed=not args.no_compress,
+    )
+
+
+def mcr_cache_dir(args) -> Path:
+    """Return the folder of the caches of the MATLAB runtime."""
+    cache_dir = getattr(args, "mcr_cache_dir", None)
+    if isinstance(cache_dir, list):
+        cache_dir = cache_dir[0]
+    return Path(cache_dir) if cache_dir else default_cache_dir()
+
+
+def preflight(
+    inputs: dict[str, list],
+    output_dir: Path,
+    args,
+    n_jobs: int = 1,
+    resources: ResourceLog | None = None,
+) -> tuple[dict[str, list], dict[str, str]]:
+    """Check the headers of the input images before segmenting them.
+
+    Images CAT12 cannot process are skipped,
+    or their whole participant with ``--invalid_inputs skip_participant``.
+    The problems found are written to ``logs/preflight_<date>.json``
+    (see :mod:`cat12.preflight`), with the index of the shard if any,
+    so concurrent runs on the same output dataset do not overwrite it.
+
+    :return: The participants to process with their images
+        and a map of the participants skipped to the reason.
+    :rtype: tuple[dict[str, list], dict[str, str]]
+    """
+    if args.skip_preflight or not inputs:
+        return inputs, {}
+    # imports numpy and nibabel
+    from cat12.preflight import check_images, write_report
+
+    mode = args.invalid_inputs
+    if isinstance(mode, list):
+        mode = mode[0]
+
+    start = datetime.now()
+    tic = time.perf_counter()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    reports = check_images(inputs, n_jobs=n_jobs, verify_gzip=args.check_gzip)
+
+    if resources is not None:
+        end_usage = resource.getrusage(resource.RUSAGE_SELF)
+        resources.add(
+            participant_id="n/a",
+            step="preflight",
+            start=start.isoformat(timespec="seconds"),
+            n_images=len(reports),
+            n_participants=len(inputs),
+            wall_time=time.perf_counter() - tic,
+            user_time=end_usage.ru_utime - usage.ru_utime,
+            system_time=end_usage.ru_stime - usage.ru_stime,
+        )
+
+    # one report per run and per shard, like the summary of the resources
+    name = (resources.start if resources is not None else start).isoformat(
+        timespec="seconds"
+    )
+    shard = shard_options(args)
+    if shard is not None:
+        name += f"_shard-{shard[0]}"
+    report_file = (
+        output_dir / "logs" / f"preflight_{name.replace(':', '_')}.json"
+    )
+    write_report(
+        report_file, reports, invalid_inputs=mode, check_gzip=args.check_gzip
+    )
+
+    rejected: dict[str, set[str]] = {}
+    n_warnings = 0
+    for report in reports:
+        if report.errors:
+            logger.error(f"{report.path}: {'; '.join(report.errors)}")
+            rejected.setdefault(report.subject, set()).add(report.path)
+        elif report.warnings:
+            n_warnings += 1
+            logger.debug(f"{report.path}: {'; '.join(report.warnings)}")
+    logger.info(
+        f"{len(reports)} images checked in {time.perf_counter() - tic:.1f} s: "
+        f"{sum(len(x) for x in rejected.values())} invalid, "
+        f"{n_warnings} with warnings (see {report_file})"
+    )
+
+    kept = {}
+    invalid = {}
+    for subject_label, bf in inputs.items():
+        bad = rejected.get(subject_label, set())
+        if bad and mode == "skip_participant":
+            invalid[subject_label] = f"skipped: {len(bad)} invalid image(s)"
+            continue
+        bf = [file for file in bf if str(Path(file.path)) not in bad]
+        if not bf and bad:
+            invalid[subject_label] = "all images are invalid"
+            continue
+        kept[subject_label] = bf
+    return kept, invalid
+
+
+def shard_options(args) -> tuple[int, int] | None:
+    """Return the index and count of the shard to process, if any.
+
+    Options passed on the command line take precedence
+    over the variables of a SLURM array job.
+    """
+    shard_index = getattr(args, "shard_index", None)
+    shard_count = getattr(args, "shard_count", None)
+    if isinstance(shard_index, list):
+        shard_index = shard_index[0]
+    if isinstance(shard_count, list):
+        shard_count = shard_count[0]
+
+    from_env = shard_from_env()
+    if from_env is not None:
+        if shard_index is None:
+            shard_index = from_env[0]
+        if shard_count is None:
+            shard_count = from_env[1]
+
+    if shard_count is None:
+        return None
+    return shard_index or 0, shard_count
+
+
+def plan(inputs: dict[str, list], bids_dir: Path, output_dir: Path, args):
+    """Write an array job script where each task segments a shard.
+
+    Each task runs ``segment`` with the options passed to ``plan``.
+    The script and the participants of each shard
+    are written in ``output_dir/plan``.
+    """
+    shard_count = args.shard_count[0]
+    scheduler = args.scheduler
+    if isinstance(scheduler, list):
+        scheduler = scheduler[0]
+    executable = args.executable
+    if isinstance(executable, list):
+        executable = executable[0]
+
+    costs = participant_costs(inputs)
+    shards = balance(costs, shard_count)
+    for index, shard in enumerate(shards):
+        logger.info(
+            f"shard {index}: {len(shard)} participants "
+            f"(estimated cost {sum(costs[x] for x in shard):.1f})"
+        )
+
+    script = write_plan(
+        output_dir / "plan",
+        shards,
+        costs,
+        scheduler=scheduler,
+        command=[
+            *executable.split(),
+            bids_dir.absolute(),
+            output_dir.absolute(),
+            "participant",
+            "segment",
+            *segment_options(args),
+        ],
+        resources={
+            key: getattr(args, key)[0] if getattr(args, key) else None
+            for key in ("time", "cpus", "mem")
+        },
+    )
+    logger.info(f"array job script written to {script}")
+
+
+def run_participants(
+    jobs: list[tuple[str, list[str]]],
+    output_dir: Path,
+    segment_type: str,
+    batch: str,
+    n_jobs: int = 1,
+    batch_size: int = 1,
+    compression: dict | None = None,
+    manifest: Manifest | None = None,
+    resources: ResourceLog | None = None,
+    leases: LeaseQueue | None = None,
+    stage=None,
+    caches: McrCaches | None = None,
+    cpu_sets: list[list[int]] | None = None,
+    memory: MemoryBudget | None = None,
+    results: ResultCache | None = None,
+) -> dict[str, str]:
+    """Segment participants, possibly in parallel.
+
+    Participants are grouped by :func:`group_participants`
+    and each group is processed by :func:`segment_participants`.
+    A single event loop supervises up to ``n_jobs`` CAT12 processes at once.
+    With ``n_jobs > 1`` the output of CAT12
+    only goes to the log file of each participant.
+
+    Failures do not stop the run: they are collected and returned.
+    The start, success or failure of each group
+    is recorded in the ``manifest`` if one is passed
+    and the resources used by each step in ``resources``.
+
+    Several workers can process the same output dataset:
+    if ``leases`` are passed, each group is first claimed
+    (see :func:`claim_participants`)
+    and the inputs of the claimed participants are then staged
+    by calling ``stage`` with them.
+
+    Each concurrent CAT12 process gets its own cache
+    of the MATLAB runtime from ``caches``
+    and its own CPUs from ``cpu_sets`` if they are passed.
+    A group only starts once its estimated memory fits in ``memory``.
+
+    The outputs of the participants are restored from ``results``
+    instead of being segmented if they are all there,
+    and the outputs of the segmented participants are stored in it.
+
+    :return: Map of failed participant labels to their error message.
+    :rtype: dict[str, str]
+    """
+    groups = group_participants(jobs, segment_type, batch_size)
+
+    logger.info(
+        f"processing {len(jobs)} participants "
+        f"in {len(groups)} batches with {n_jobs} jobs"
+    )
+
+    text = "processing subjects"
+    with progress_bar(text=text) as progress:
+        subject_loop = progress.add_task(
+            description="processing subjects", total=len(jobs)
+        )
+        return asyncio.run(
+            _run_groups(
+                groups,
+                n_jobs=n_jobs,
+                on_done=lambda n: progress.update(subject_loop, advance=n),
+                manifest=manifest,
+                leases=leases,
+                stage=stage,
+                caches=caches,
+                cpu_sets=cpu_sets,
+                memory=memory,
+                results=results,
+                output_dir=output_dir,
+                segment_type=segment_type,
+                batch=batch,
+                echo=n_jobs <= 1,
+                compression=compression,
+                resources=resources,
+            )
+        )
+
+
+async def _run_groups(
+    groups: list[list[tuple[str, list[str]]]],
+    n_jobs: int,
+    on_done,
+    manifest: Manifest | None = None,
+    leases: LeaseQueue | None = None,
+    stage=None,
+    caches: McrCaches | None = None,
+    cpu_sets: list[list[int]] | None = None,
+    memory: MemoryBudget | None = None,
+    results: ResultCache | None = None,
+    **kwargs,
+) -> dict[str, str]:
+    failures: dict[str, str] = {}
+    if memory is None:
+        memory = MemoryBudget(float("inf"))
+    semaphore = asyncio.Semaphore(max(n_jobs, 1))
+    # each running group takes a worker: its MCR cache and CPUs
+    free_workers: asyncio.Queue = asyncio.Queue()
+    for worker in range(max(n_jobs, 1)):
+        free_workers.put_nowait(worker)
+
+    watch = _LeaseWatch(leases)
+
+    async def _run(participants):
+        n_participants = len(participants)
+        async with semaphore:
+            if leases is not None:
+                participants = await asyncio.to_thread(
+                    claim_participants, participants, leases, manifest
+                )
+            if participants and results is not None:
+                participants = await asyncio.to_thread(
+                    restore_results, participants, results, manifest, leases
+                )
+            if participants:
+                await _segment(participants)
+            on_done(n_participants)
+
+    async def _segment(participants):
+        files = [file for _, files in participants for file in files]
+        labels = [label for label, _ in participants]
+        worker = await free_workers.get()
+        cache = caches.slots[worker] if caches is not None else None
+        cpus = cpu_sets[worker] if cpu_sets is not None else None
+        try:
+            if stage is not None:
+                await asyncio.to_thread(stage, participants)
+            if cache is not None:
+                await asyncio.to_thread(caches.copy_warm, cache)
+            estimate = await asyncio.to_thread(memory.model.estimate, files)
+            async with memory.reserve(estimate):
+                logger.debug(
+                    f"{_labels(participants)}: {estimate:.0f} MB estimated, "
+                    f"{memory.reserved:.0f} / {memory.budget:.0f} MB reserved"
+                )
+                if manifest is not None:
+                    manifest.start(files)
+                failed = await watch.run(
+                    labels,
+                    segment_participants(
+                        participants,
+                        mcr_cache=cache,
+                        cpus=cpus,
+                        manifest=manifest,
+                        **kwargs,
+                    ),
+                )
+        except Exception as exc:
+            failures.update(
+                record_group(
+                    participants,
+                    dict.fromkeys(labels, repr(exc)),
+                    manifest,
+                    watch.lost,
+                )
+            )
+        else:
+            failed = watch.check(labels, failed)
+            failures.update(
+                record_group(participants, failed, manifest, watch.lost)
+            )
+            if results is not None:
+                await asyncio.to_thread(
+                    store_results,
+                    [
+                        file
+                        for label, files in participants
+                        if label not in failed
+                        for file in files
+                    ],
+                    results,
+                    manifest,
+                    kwargs["output_dir"],
+                )
+            if cache is not None:
+                # the runtime extracted itself in the cache
+                mark_warm(cache)
+        finally:
+            if leases is not None:
+                for label, _ in participants:
+                    leases.release(label)
+            free_workers.put_nowait(worker)
+
+    with watch:
+        await asyncio.gather(*(_run(participants) for participants in groups))
+
+    return failures
+
+
+def record_group(
+    participants: list[tuple[str, list[str]]],
+    failed: dict[str, str],
+    manifest: Manifest | None = None,
+    lost: set[str] | None = None,
+) -> dict[str, str]:
+    """Log the failures of a group and record its images in the manifest.
+
+    Participants whose lease was ``lost`` are not recorded:
+    their records belong to the worker that now holds their lease.
+
+    :return: The ``failed`` participants with the reason.
+    :rtype: dict[str, str]
+    """
+    for label, reason in failed.items():
+        logger.error(f"sub-{label} failed: {reason}")
+    if manifest is not None:
+        kept = [x for x in participants if x[0] not in (lost or ())]
+        manifest.fail(
+            [
+                file
+                for label, files in kept
+                if label in failed
+                for file in files
+            ]
+        )
+        manifest.finish(
+            [
+                file
+                for label, files in kept
+                if label not in failed
+                for file in files
+            ]
+        )
+    return failed
+
+
+def restore_results(
+    participants: list[tuple[str, list[str]]],
+    results: ResultCache,
+    manifest: Manifest,
+    leases: LeaseQueue | None = None,
+) -> list[tuple[str, list[str]]]:
+    """Restore the outputs of the participants found in the result cache.
+
+    A participant is restored only if the outputs of all its images are
+    in the cache. Restored images are recorded as done in the ``manifest``
+    and the ``leases`` of restored participants are released.
+
+    :return: The participants to segment.
+    :rtype: list[tuple[str, list[str]]]
+    """
+    todo = []
+    for label, files in participants:
+        if all(
+            results.restore(manifest.identity(file)["hash"], Path(file))
+            for file in files
+        ):
+            manifest.finish(files)
+            if leases is not None:
+                leases.release(label)
         else:
-            os.environ["OUTPUT_DIR"] = os.path.relpath(output_dir, bids_dir)
-            layout_out = layout_in
+            todo.append((label, files))
+    return todo
+
+
+def store_results(
+    files: list[str],
+    results: ResultCache,
+    manifest: Manifest,
+    output_dir: Path,
+) -> None:
+    """Store the outputs of segmented images in the result cache."""
+    for file in files:
+        results.store(manifest.identity(file)["hash"], Path(file), output_dir)
+
+
+def claim_participants(
+    participants: list[tuple[str, list[str]]],
+    leases: LeaseQueue,
+    manifest: Manifest | None = None,
+) -> list[tuple[str, list[str]]]:
+    """Only keep the participants this worker can process.
 
-        batch = define_batch(segment_type=segment_type)
+    Skips the participants whose lease is held by another worker
+    and those another worker processed since this one started.
 
-        logger.info(f"{segment_type=} - using batch {batch}.")
+    :return: The participants whose lease this worker now holds.
+    :rtype: list[tuple[str, list[str]]]
+    """
+    claimed = []
+    for subject_label, files in participants:
+        if not leases.claim(subject_label):
+            owner = leases.skipped.get(subject_label)
+            if is_dead(owner):
+                logger.warning(
+                    f"sub-{subject_label} is leased to {owner}, "
+                    "which is no longer running: skipping. "
+                    f"Its lease can be reclaimed after {leases.timeout:.0f} s."
+                )
+            else:
+                logger.info(
+                    f"sub-{subject_label} is processed by {owner}: skipping"
+                )
+            continue
+        if manifest is not None and manifest.all_done(files):
+            logger.info(
+                f"sub-{subject_label} was processed by another worker: "
+                "skipping"
+            )
+            leases.release(subject_label)
+            continue
+        claimed.append((subject_label, files))
+    return claimed
 
-        (output_dir / "logs").mkdir(exist_ok=True, parents=True)
-        shutil.copy2(
-            src=Path("/opt")
-            / f"CAT12{os.environ['CAT_VERSION']}"
-            / "standalone"
-            / batch,
-            dst=output_dir / "logs",
+
+def report_skipped(leases: LeaseQueue) -> dict[str, str]:
+    """Log the participants left to other workers.
+
+    :return: Map of the labels of the skipped participants
+        whose lease belongs to a worker that stopped
+        to their error message: nobody is processing them.
+    :rtype: dict[str, str]
+    """
+    if not leases.skipped:
+        return {}
+    logger.warning(
+        f"{len(leases.skipped)} participant(s) skipped "
+        "as their lease is held by another worker:\n"
+        + "\n".join(
+            f"\tsub-{label}: {owner}"
+            for label, owner in leases.skipped.items()
         )
+    )
+    return {
+        label: f"leased to {owner}, which is no longer running"
+        for label, owner in leases.skipped.items()
+        if is_dead(owner)
+    }
+
+
+def schedule_jobs(
+    jobs: list[tuple[str, list[str]]],
+    inputs: dict[str, list],
+    output_dir: Path,
+    args,
+    n_jobs: int = 1,
+) -> list[tuple[str, list[str]]]:
+    """Order the participants to process following ``--schedule``.
+
+    ``largest_first`` processes the most expensive participants first
+    ("longest processing time first")
+    so that parallel jobs finish at about the same time
+    instead of waiting for a big participant started last.
+    Costs are estimated from the headers of the images
+    (see :func:`cat12.costs.participant_costs`)
+    and converted to run times with the previous runs
+    (see :func:`cat12.costs.historical_costs`).
+    ``input`` keeps the order of the input dataset.
+
+    With a single job at a time the order does not change
+    when the run ends, so costs are not estimated.
+    """
+    schedule = getattr(args, "schedule", "input")
+    if isinstance(schedule, list):
+        schedule = schedule[0]
+    if schedule != "largest_first" or len(jobs) < 2 or n_jobs < 2:
+        return jobs
+
+    costs = historical_costs(
+        participant_costs({label: inputs[label] for label, _ in jobs}),
+        read_resources(output_dir),
+    )
+    jobs = sorted(jobs, key=lambda job: (-costs[job[0]], job[0]))
+    logger.info("processing the most expensive participants first")
+    logger.debug(
+        ", ".join(f"sub-{label} ({costs[label]:.1f})" for label, _ in jobs)
+    )
+    return jobs
+
 
-        generate_method_section(output_dir=output_dir, batch=batch)
+def group_participants(
+    jobs: list[tuple[str, list[str]]],
+    segment_type: str,
+    batch_size: int = 1,
+) -> list[list[tuple[str, list[str]]]]:
+    """Group participants so that one CAT12 call gets ``batch_size`` images.
+
+    Participants are never split across groups:
+    their outputs are only compressed once all their images are processed.
+    A participant with more than ``batch_size`` images gets its own group.
+
+    Longitudinal segmentation already passes all the images
+    of a participant to a single call, so participants are not grouped.
+    """
+    if batch_size <= 1 or is_longitudinal_segmentation(segment_type):
+        return [[job] for job in jobs]
+
+    groups: list[list[tuple[str, list[str]]]] = []
+    group: list[tuple[str, list[str]]] = []
+    n_images = 0
+    for subject_label, files in jobs:
+        if group and n_images + len(files) > batch_size:
+            groups.append(group)
+            group = []
+            n_images = 0
+        group.append((subject_label, files))
+        n_images += len(files)
+    if group:
+        groups.append(group)
+
+    return groups
+
+
+async def segment_participants(
+    participants: list[tuple[str, list[str]]],
+    output_dir: Path,
+    segment_type: str,
+    batch: str,
+    echo: bool = True,
+    compression: dict | None = None,
+    resources: ResourceLog | None = None,
+    mcr_cache: Path | None = None,
+    cpus: list[int] | None = None,
+    manifest: Manifest | None = None,
+) -> dict[str, str]:
+    """Run CAT12 on all the images of a group of participants.
+
+    For cross-sectional segmentation all the images of the group
+    are passed to a single call to ``cat_standalone.sh``
+    to only pay the start up cost of the MATLAB runtime once.
+    CAT12 writes its outputs next to each input image,
+    so they end up in the folder of each participant.
+    The output of the call is split between the log files
+    of the participants (see :class:`_BatchLog`)
+    and an image is segmented if CAT12 wrote its report,
+    so an image that fails does not fail the other participants.
+
+    For longitudinal segmentation,
+    the runs of each session are first averaged
+    (see :func:`cat12.averaging.average_timepoints`)
+    so CAT12 gets one image per time point.
+    The ``manifest`` records the outputs of the mean for each run.
+
+    CAT12 uses the cache of the MATLAB runtime ``mcr_cache``
+    (see :mod:`cat12.mcr_cache`) if one is passed
+    and is pinned to ``cpus`` (see :mod:`cat12.cpus`).
+
+    Outputs are then compressed with the ``compression`` options
+    (see :func:`gzip_all_niftis`) in a thread, unless those are None.
+
+    The resources used by each step are added to ``resources``:
+    participants processed by the same call share the same measures.
+
+    :return: The participants some images of which were not segmented,
+        with the reason.
+    :rtype: dict[str, str]
+
+    :raises subprocess.CalledProcessError: If CAT12 fails
+        without segmenting any image.
+    """
+    failed: dict[str, str] = {}
+    with ExitStack() as stack:
+        log = _BatchLog(
+            {
+                subject_label: stack.enter_context(
+                    log_filename(output_dir, subject_label).open("w")
+                )
+                for subject_label, _ in participants
+            },
+            participants,
+        )
 
-        text = "processing subjects"
-        with progress_bar(text=text) as progress:
-            subject_loop = progress.add_task(
-                description="processing subjects", total=len(subjects)
+        if len(participants) > 1:
+            log.shared(
+                f"Batch of {len(participants)} participants: "
+                f"{_labels(participants)}\n"
+                "The start up of CAT12 and the summary of the call "
+                "are shared by the batch.\n"
             )
 
-            for subject_label in subjects:
-                this_filter = {
-                    "datatype": "anat",
-                    "suffix": "T1w",
-                    "extension": "nii",
-                    "subject": subject_label,
-                }
+        cmd = [str(STANDALONE / "cat_standalone.sh")]
+
+        if segment_type in ["default", "simple", "enigma"]:
+            files = [file for _, files in participants for file in files]
+            cmds = [[*cmd, *files, "-b", batch]]
+
+        elif is_longitudinal_segmentation(segment_type):
+            # imports numpy and nibabel
+            from cat12.averaging import average_timepoints
 
-                bf = layout_out.get(
-                    **this_filter,
+            cmds = []
+            for _, files in participants:
+                timepoints = await asyncio.to_thread(average_timepoints, files)
+                if manifest is not None:
+                    for image, runs in timepoints.items():
+                        manifest.processed_as(runs, image)
+                cmds.append(
+                    [*cmd, *timepoints, "-b", batch, "-a1", segment_type[-1]]
+                )
+
+        for i, this_cmd in enumerate(cmds):
+            logger.info(this_cmd)
+            n_voxels = await asyncio.to_thread(
+                lambda x: max(image_voxels(f) or 0 for f in x),
+                this_cmd[1 : this_cmd.index("-b")],
+            )
+            start = datetime.now()
+            log.current = None
+            result = await supervise(
+                this_cmd,
+                log,
+                env=thread_env(cache_env(env, mcr_cache), cpus),
+                echo=echo,
+                cpus=cpus,
+            )
+            log.shared(f"{result.summary()}\n")
+            if resources is not None:
+                # longitudinal: one call per participant
+                called = participants if len(cmds) == 1 else [participants[i]]
+                for subject_label, files in called:
+                    resources.add(
+                        participant_id=f"sub-{subject_label}",
+                        step="segment",
+                        start=start.isoformat(timespec="seconds"),
+                        n_images=len(files),
+                        n_participants=len(called),
+                        **result_measures(result),
+                        n_voxels=n_voxels or "n/a",
+                        **({"threads": len(cpus)} if cpus else {}),
+                    )
+            if segment_type in ("default", "simple"):
+                failed = unsegmented(participants, result, start.timestamp())
+            else:
+                check_result(result)
+
+    if compression is not None:
+        for subject_label, _ in participants:
+            if subject_label in failed:
+                continue
+            start = datetime.now()
+            tic = time.perf_counter()
+            compressed = await asyncio.to_thread(
+                gzip_all_niftis,
+                output_dir=output_dir,
+                subject_label=subject_label,
+                compression=compression,
+            )
+            if resources is not None:
+                resources.add(
+                    participant_id=f"sub-{subject_label}",
+                    step="compress",
+                    start=start.isoformat(timespec="seconds"),
+                    n_images=len(compressed),
+                    n_participants=1,
+                    wall_time=time.perf_counter() - tic,
+                    written=to_mb(sum(f.stat().st_size for f in compressed)),
                 )
 
-                if not check_input(subject_label, bf, segment_type):
-                    continue
+    return failed
+
+
+def unsegmented(
+    participants: list[tuple[str, list[str]]],
+    result: CommandResult,
+    since: float,
+) -> dict[str, str]:
+    """Find the participants whose images CAT12 did not all segment.
+
+    CAT12 writes the report of an image (``report/cat_<image>.xml``)
+    once it is done with it, whatever the exit code of the call.
+
+    :param since: Time the call started:
+        older reports are from a previous run.
+    :type since: float
+
+    :raises subprocess.CalledProcessError: If the call failed
+        without segmenting any image.
+    """
+    failed = {}
+    for subject_label, files in participants:
+        missing = [Path(x).name for x in files if not _reported(x, since)]
+        if missing:
+            failed[subject_label] = (
+                f"CAT12 exited with {result.returncode} "
+                f"without a report for {', '.join(missing)}"
+            )
+    if result.returncode != 0 and len(failed) == len(participants):
+        check_result(result)
+    return failed
+
+
+def _reported(file: str, since: float) -> bool:
+    path = Path(file)
+    report = path.parent / "report" / f"cat_{path.name.split('.')[0]}.xml"
+    try:
+        # the resolution of the modification time can be coarse
+        return report.stat().st_mtime >= since - 1
+    except OSError:
+        return False
 
-                log_file = log_filename(output_dir, subject_label)
 
-                cmd = [str(STANDALONE / "cat_standalone.sh")]
+class _LeaseWatch:
+    """Cancel the jobs of the participants whose lease was lost.
 
-                with log_file.open("w") as log:
-                    if segment_type in ["default", "simple", "enigma"]:
-                        for file in bf:
-                            cmd.extend([file.path, "-b", batch])
-                            run_command(cmd, log)
+    Use as a context manager while the jobs run.
 
-                    elif is_longitudinal_segmentation(segment_type):
-                        # TODO do a mean for each time point first
-                        files_to_process = [file.path for file in bf]
-                        cmd.extend(files_to_process)
-                        cmd.extend(["-b", batch, "-a1", segment_type[-1]])
-                        run_command(cmd, log)
+    :param leases: Leases of this worker, if any.
+    :type leases: LeaseQueue, optional
+    """
 
-                gunzip_all_niftis(
-                    output_dir=output_dir, subject_label=subject_label
+    def __init__(self, leases: LeaseQueue | None):
+        self.leases = leases
+        # participants whose lease was taken by another worker
+        self.lost: set[str] = set()
+        self._running: dict[str, asyncio.Future] = {}
+
+    def __enter__(self) -> _LeaseWatch:
+        """Get notified by the heartbeat thread of the leases."""
+        if self.leases is not None:
+            loop = asyncio.get_running_loop()
+            self.leases.on_lost = lambda label: loop.call_soon_threadsafe(
+                self._lose, label
+            )
+        return self
+
+    def __exit__(self, *exc) -> None:
+        """Stop being notified."""
+        if self.leases is not None:
+            self.leases.on_lost = None
+
+    def _lose(self, label: str) -> None:
+        self.lost.add(label)
+        job = self._running.get(label)
+        if job is not None:
+            job.cancel()
+
+    async def run(self, labels: list[str], coro):
+        """Run the job of some participants.
+
+        :raises RuntimeError: If the job was cancelled
+            because the lease of one of the participants was lost.
+        """
+        job = asyncio.ensure_future(coro)
+        self._running.update(dict.fromkeys(labels, job))
+        try:
+            return await job
+        except asyncio.CancelledError:
+            if self.lost.isdisjoint(labels):
+                raise
+            raise RuntimeError(
+                "cancelled as another worker took the lease of "
+                + ", ".join(
+                    f"sub-{x}" for x in sorted(self.lost & set(labels))
                 )
+            ) from None
+        finally:
+            for label in labels:
+                self._running.pop(label, None)
+
+    def check(self, labels: list[str], failed: dict[str, str]) -> dict:
+        """Add the participants whose lease was lost to the ``failed`` ones.
+
+        Leases are checked again as they may have been lost
+        since the last heartbeat.
+        """
+        if self.leases is None:
+            return failed
+        for label in labels:
+            if label not in failed and not self.leases.holds(label):
+                self.lost.add(label)
+                failed[label] = "lost its lease to another worker"
+        return failed
+
+
+class _BatchLog:
+    """Split the output of a CAT12 call between the logs of participants.
+
+    CAT12 prints the name of each image when it starts processing it:
+    the lines that follow go to the log of the participant of the image.
+    The lines printed before the first image,
+    while the runtime starts, go to all the logs.
+    """
+
+    def __init__(self, logs: dict, participants: list[tuple[str, list[str]]]):
+        self.logs = logs
+        self.owners = {
+            Path(file).name: subject_label
+            for subject_label, files in participants
+            for file in files
+        }
+        self.current: str | None = None
+
+    def write(self, text: str) -> None:
+        """Write a line to the log of the image being processed."""
+        for name, subject_label in self.owners.items():
+            if name in text:
+                self.current = subject_label
+                break
+        if self.current is None:
+            self.shared(text)
+        else:
+            self.logs[self.current].write(text)
 
-                progress.update(subject_loop, advance=1)
+    def shared(self, text: str) -> None:
+        """Write to all the logs."""
+        for f in self.logs.values():
+            f.write(text)
 
-    sys.exit(EXIT_CODES["SUCCESS"]["Value"])
+    def flush(self) -> None:
+        """Flush all the logs."""
+        for f in self.logs.values():
+            f.flush()
+
+
+def _labels(participants: list[tuple[str, list[str]]]) -> str:
+    return ", ".join(f"sub-{label}" for label, _ in participants)
+
+
+def compression_options(args, n_jobs: int = 1) -> dict | None:
+    """Return the options to compress the outputs or None to skip it.
+
+    The available CPUs (see :func:`cat12.cpus.available_cpus`)
+    are shared between the parallel jobs to compress the outputs.
+    """
+    if args.no_compress:
+        return None
+
+    level = args.compression_level
+    if isinstance(level, list):
+        level = level[0]
+
+    block_size = args.gzip_block_size
+    if isinstance(block_size, list):
+        block_size = block_size[0]
+
+    return {
+        "level": level,
+        "n_jobs": max(len(available_cpus()) // max(n_jobs, 1), 1),
+        "block_size": block_size * 1024**2 if block_size else None,
+    }
 
 
 def check_input(subject_label: str, bf: list, segment_type: str):
@@ -231,78 +1639,182 @@ def is_longitudinal_segmentation(segment_type):
     ]
 
 
-def run_command(cmd, log):
-    """Run command and log to STDOUT and log."""
-    logger.info(cmd)
-    with Popen(
-        cmd,
-        stdout=PIPE,
-        stderr=STDOUT,
-        bufsize=1,
-        text=True,
-        encoding="utf-8",
-        env=env,
-    ) as proc:
-        while (_ := proc.poll()) is None:
-            line = proc.stdout.readline()
-            sys.stdout.write(str(line))
-            log.write(str(line))
-
-
-def copy_files(layout_in, output_dir, subjects):
+def result_measures(result: CommandResult) -> dict:
+    """Return the measures of a command to add to the resources log."""
+    return {
+        "wall_time": result.wall_time,
+        "user_time": result.user_time,
+        "system_time": result.system_time,
+        "peak_rss": round(result.max_rss / 1024, 3),
+        "read": to_mb(result.read_bytes),
+        "written": to_mb(result.write_bytes),
+    }
+
+
+def check_result(result: CommandResult) -> None:
+    """Raise an error if a command failed."""
+    logger.debug(result.summary())
+    if result.returncode != 0:
+        raise subprocess.CalledProcessError(result.returncode, result.cmd)
+
+
+def find_inputs(
+    bids_dir: Path, output_dir: Path, args, n_jobs: int = 1
+) -> dict[str, list]:
+    """Find the T1w images of each participant to process.
+
+    Scans the anat folders of the dataset
+    and only keeps the images selected by ``--bids_filter_file``
+    unless the filters require to index the dataset with pybids
+    (see :mod:`cat12.bids_filter`).
+
+    :return: Map of participant labels to their T1w images.
+        Images are ``T1wImage`` or ``BIDSFile``,
+        both have a ``path`` and a ``relpath``.
+    :rtype: dict[str, list]
+    """
+    match = None
+    if args.bids_filter_file:
+        try:
+            query = load_filter(args.bids_filter_file)
+        except (OSError, ValueError) as exc:
+            logger.error(f"Invalid BIDS filter file: {exc}")
+            sys.exit(EXIT_CODES["USAGE"]["Value"])
+        logger.info(f"selecting T1w images with {query}")
+        match = compile_filter(query)
+
+    if not args.bids_filter_file or match is not None:
+        inputs = find_t1w(
+            bids_dir, subjects=args.participant_label, n_jobs=n_jobs
+        )
+        if not inputs:
+            raise RuntimeError(f"No subject found in:\n\t{bids_dir}")
+        if match is not None:
+            inputs = {
+                subject_label: [x for x in bf if match(x.entities)]
+                for subject_label, bf in inputs.items()
+            }
+        logger.info(f"processing subjects: {list(inputs)}")
+        return inputs
+
+    layout_in = get_dataset_layout(
+        bids_dir,
+        use_database=True,
+        reset_database=args.reset_database,
+        database_dir=output_dir / ".pybids",
+        subjects=args.participant_label,
+    )
+
+    subjects = args.participant_label or layout_in.get_subjects()
+    subjects = list_subjects(layout_in, subjects)
+
+    inputs = query_layout(layout_in, query, subjects)
+    return {
+        subject_label: inputs.get(subject_label, [])
+        for subject_label in subjects
+    }
+
+
+def copy_files(
+    inputs: dict[str, list],
+    output_dir: Path,
+    n_jobs: int = 1,
+    resources: ResourceLog | None = None,
+    hardlink: bool = False,
+):
     """Copy input files to derivatives.
 
     SPM has the bad habit of dumping derivatives with the raw.
     Unzip files as SPM cannot deal with gz files.
+
+    Images are staged by :func:`cat12.staging.stage_files`
+    without being loaded in memory.
+    The time it takes is added to ``resources`` if one is passed.
+
+    :raises OSError: If some files could not be copied.
     """
-    text = "copying subjects"
-    with progress_bar(text=text) as progress:
-        copy_loop = progress.add_task(
-            description="copying subjects", total=len(subjects)
+    files = []
+    for subject_label, bf in inputs.items():
+        logger.info(f"Copying {subject_label}")
+        for file in bf:
+            # always staged again in case the input changed
+            # since an interrupted run
+            output_filename = staged_path(output_dir, file.relpath)
+            logger.info(f"Copying {file.path} to {output_dir!s}")
+            files.append((Path(file.path), output_filename))
+
+    start = datetime.now()
+    tic = time.perf_counter()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    failures = stage_files(files, n_jobs=n_jobs, hardlink=hardlink)
+
+    if resources is not None and files:
+        end_usage = resource.getrusage(resource.RUSAGE_SELF)
+        resources.add(
+            participant_id=(
+                f"sub-{next(iter(inputs))}" if len(inputs) == 1 else "n/a"
+            ),
+            step="copy",
+            start=start.isoformat(timespec="seconds"),
+            n_images=len(files),
+            n_participants=len(inputs),
+            wall_time=time.perf_counter() - tic,
+            user_time=end_usage.ru_utime - usage.ru_utime,
+            system_time=end_usage.ru_stime - usage.ru_stime,
+            read=to_mb(sum(src.stat().st_size for src, _ in files)),
+            written=to_mb(
+                sum(dst.stat().st_size for _, dst in files if dst.exists())
+            ),
         )
-        for subject_label in subjects:
-            logger.info(f"Copying {subject_label}")
-
-            this_filter = {
-                "datatype": "anat",
-                "suffix": "T1w",
-                "extension": "nii.*",
-                "subject": subject_label,
-            }
-            bf = layout_in.get(
-                **this_filter,
-                regex_search=True,
+
+    if failures:
+        raise OSError(
+            f"{len(failures)} file(s) could not be copied:\n"
+            + "\n".join(
+                f"\t{file}: {error}" for file, error in failures.items()
             )
-            for file in bf:
-                output_filename = output_dir / file.relpath
-                if output_filename.exists():
-                    continue
+        )
 
-                output_filename.parent.mkdir(exist_ok=True, parents=True)
 
-                logger.info(f"Copying {file.path} to {output_dir!s}")
-                img = nib.load(file.path)
-                nib.save(img, output_filename)
+def run_validation(
+    bids_dir: Path, output_dir: Path, args, subjects: list[str] | None
+) -> None:
+    """Run the bids validator on the participants to process.
 
-            progress.update(copy_loop, advance=1)
+    Exits if the dataset is not valid.
+    Results are cached in ``output_dir/.bids_validator``
+    (see :mod:`cat12.validation`).
+    """
+    if args.skip_validation:
+        return
+    scope = args.validation_scope
+    if isinstance(scope, list):
+        scope = scope[0]
+    if not validate(
+        bids_dir,
+        output_dir / ".bids_validator",
+        subjects=subjects,
+        scope=scope,
+    ):
+        logger.error(f"The dataset is not valid:\n{bids_dir}")
+        sys.exit(EXIT_CODES["DATAERR"]["Value"])
 
 
-def run_validation(bids_dir):
-    """Run bids validator."""
-    try:
-        subprocess.run(f"bids-validator {bids_dir}", shell=True, check=True)
-    except subprocess.CalledProcessError:
-        sys.exit(EXIT_CODES["DATAERR"]["Value"])
+def gzip_all_niftis(
+    output_dir: Path, subject_label: str, compression: dict | None = None
+):
+    """Gzip all niftis for a subject.
 
+    ``compression`` are passed to :func:`cat12.compression.compress_niftis`.
 
-def gunzip_all_niftis(output_dir: Path, subject_label: str):
-    """Gunzip all niftis for a subject."""
-    logger.info(f"Gunzipping files for {subject_label}")
-    files = list((output_dir / f"sub-{subject_label}").glob("**/*.nii"))
-    for f in files:
-        nii = nib.load(f)
-        nii.to_filename(f"{f!s}.gz")
-        f.unlink()
+    :return: The compressed images.
+    :rtype: list[Path]
+    """
+    logger.info(f"Gzipping files for {subject_label}")
+    return compress_niftis(
+        output_dir / f"sub-{subject_label}", **(compression or {})
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,241 @@
+"""Keep track of the images already processed to resume interrupted runs.
+
+The manifest is a JSON lines file in the ``logs`` folder
+of the output dataset: each line records the state of an input image,
+the last line for an image wins.
+
+An image is done when its last record says so
+and when its content, batch and CAT12 version have not changed
+and all the outputs it recorded are still there with the same size.
+Images whose processing started but never finished are processed again.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+from cat12.cat_logging import cat12_log
+from cat12.defaults import CAT_VERSION
+
+logger = cat12_log(name="cat12")
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class Manifest:
+    """Record the state of each input image across runs.
+
+    :param output_dir: Output dataset.
+    :type output_dir: Path
+
+    :param batch: Name of the batch used to process the images.
+    :type batch: str
+    """
+
+    def __init__(self, output_dir: Path, batch: str):
+        self.output_dir = output_dir
+        self.batch = batch
+        self.path = output_dir / "logs" / "manifest.jsonl"
+        # how much of the manifest was read
+        self._offset = 0
+        self.records: dict[str, dict] = {}
+        self.refresh()
+        # staged image -> record of its input
+        self._staged: dict[str, dict] = {}
+        # staged image -> image passed to CAT12 if it is another one
+        self._processed: dict[str, str] = {}
+
+    def refresh(self) -> None:
+        """Read the records appended since the last read.
+
+        Other workers sharing the output dataset
+        append to the same manifest.
+        """
+        if not self.path.exists():
+            return
+        with self.path.open("rb") as f:
+            f.seek(self._offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # still being written: read it next time
+                    break
+                self._offset += len(line)
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # interrupted while writing the last line
+                    continue
+                self.records[record["input"]] = record
+
+    def identify(self, path: str | Path, relpath: str) -> dict:
+        """Return what identifies the content of an input image.
+
+        The content is only hashed again
+        if the size or modification time of the file changed.
+        """
+        stat = Path(path).stat()
+        previous = self.records.get(relpath, {})
+        if (
+            previous.get("size") == stat.st_size
+            and previous.get("mtime_ns") == stat.st_mtime_ns
+        ):
+            content_hash = previous["hash"]
+        else:
+            content_hash = file_hash(path)
+        return {
+            "input": relpath,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "hash": content_hash,
+            "batch": self.batch,
+            "cat_version": CAT_VERSION,
+        }
+
+    def is_done(self, identity: dict) -> bool:
+        """Check if an input image was already processed."""
+        record = self.records.get(identity["input"])
+        if record is None or record.get("status") != "done":
+            return False
+        if any(record.get(key) != identity[key] for key in _KEYS):
+            return False
+        for output, size in record.get("outputs", {}).items():
+            output = self.output_dir / output
+            if not output.exists() or output.stat().st_size != size:
+                logger.warning(
+                    f"Output {output} is missing or incomplete: "
+                    f"{identity['input']} will be processed again."
+                )
+                return False
+        return True
+
+    def all_done(self, staged_files: list[str]) -> bool:
+        """Check if some registered images were processed by any worker."""
+        self.refresh()
+        identities = [self._staged.get(str(x)) for x in staged_files]
+        return all(
+            identity is not None and self.is_done(identity)
+            for identity in identities
+        )
+
+    def identity(self, staged: str | Path) -> dict | None:
+        """Return the identity of the input of a registered image."""
+        return self._staged.get(str(staged))
+
+    def register(self, staged: str | Path, identity: dict) -> None:
+        """Associate the path where an image is processed to its input."""
+        self._staged[str(staged)] = identity
+
+    def processed_as(self, staged_files: list[str], image: str) -> None:
+        """Record that some images were passed to CAT12 as another image.
+
+        For example the runs of a session averaged before
+        longitudinal segmentation: their outputs are those of the mean.
+        """
+        for staged in staged_files:
+            if str(staged) != str(image):
+                self._processed[str(staged)] = str(image)
+
+    def start(self, staged_files: list[str]) -> None:
+        """Record that the processing of some images started."""
+        self._write(staged_files, status="started")
+
+    def fail(self, staged_files: list[str]) -> None:
+        """Record that the processing of some images failed."""
+        self._write(staged_files, status="failed")
+
+    def finish(self, staged_files: list[str]) -> None:
+        """Record that some images were processed and list their outputs."""
+        self._write(staged_files, status="done")
+
+    def _write(self, staged_files: list[str], status: str) -> None:
+        lines = []
+        for staged in staged_files:
+            identity = self._staged.get(str(staged))
+            if identity is None:
+                continue
+            record = {
+                **identity,
+                "status": status,
+                "time": datetime.now().isoformat(timespec="seconds"),
+            }
+            if status == "done":
+                image = self._processed.get(str(staged), staged)
+                record["outputs"] = list_outputs(Path(image), self.output_dir)
+            self.records[record["input"]] = record
+            lines.append(json.dumps(record) + "\n")
+
+        if not lines:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # a single append per call so concurrent writers do not interleave
+        with self.path.open("a") as f:
+            f.write("".join(lines))
+
+
+_KEYS = ("hash", "batch", "cat_version")
+
+
+def skip_done(
+    inputs: dict[str, list], manifest: Manifest, n_jobs: int = 1
+) -> tuple[dict[str, list], dict[str, dict]]:
+    """Remove the participants whose images were all processed already.
+
+    :param inputs: Map of participant labels to their images
+        (with a ``path`` and a ``relpath``).
+    :type inputs: dict[str, list]
+
+    :return: The participants left to process
+        and the identity of each image (see :meth:`Manifest.identify`).
+    :rtype: tuple[dict[str, list], dict[str, dict]]
+    """
+    files = [file for bf in inputs.values() for file in bf]
+    with ThreadPoolExecutor(max_workers=max(n_jobs, 1)) as executor:
+        identities = dict(
+            zip(
+                (file.relpath for file in files),
+                executor.map(
+                    lambda file: manifest.identify(file.path, file.relpath),
+                    files,
+                ),
+            )
+        )
+
+    todo = {}
+    for subject_label, bf in inputs.items():
+        if bf and all(manifest.is_done(identities[x.relpath]) for x in bf):
+            logger.info(f"sub-{subject_label} already processed: skipping")
+            continue
+        todo[subject_label] = bf
+
+    return todo, identities
+
+
+def file_hash(path: str | Path) -> str:
+    """Hash the content of a file."""
+    digest = hashlib.blake2b(digest_size=16)
+    with Path(path).open("rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def list_outputs(staged: Path, output_dir: Path) -> dict[str, int]:
+    """List the files written by CAT12 for an image and their size.
+
+    CAT12 writes its outputs in the folder of the image
+    (or in subfolders) and includes the name of the image in their name.
+    """
+    stem = staged.name.split(".")[0]
+    outputs = {}
+    for root, _, filenames in os.walk(staged.parent):
+        for filename in filenames:
+            if stem not in filename or filename.startswith("."):
+                continue
+            path = Path(root) / filename
+            outputs[str(path.relative_to(output_dir))] = path.stat().st_size
+    return outputs
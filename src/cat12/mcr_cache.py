@@ -0,0 +1,189 @@
+"""Give each CAT12 worker its own pre-extracted MATLAB runtime cache.
+
+The first time the MATLAB runtime (MCR) runs a compiled application,
+it extracts the archive of the application (CTF)
+in ``MCR_CACHE_ROOT`` (``~/.mcrCache*`` by default).
+Concurrent processes sharing this cache fight over it,
+and the extraction adds to the start up time of every new container.
+
+Each worker gets its own cache in node-local storage
+(``$TMPDIR`` by default) that is extracted once and reused:
+
+- a slot ``worker-<i>`` is locked with ``flock`` while a process uses it,
+  so processes running on the same node never share a cache,
+- a slot is warmed up by copying a slot that is already warm,
+  otherwise the runtime extracts itself the first time it runs in it.
+
+``cat12 ... warmup`` starts the runtime once to warm up the caches
+before the first run.
+"""
+
+from __future__ import annotations
+
+import fcntl
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+from cat12.cat_logging import cat12_log
+from cat12.defaults import CAT_VERSION, MCR_VERSION
+from cat12.supervisor import run_supervised
+
+logger = cat12_log(name="cat12")
+
+# written in a cache once the runtime has been extracted in it
+WARM_MARKER = ".cat12_warm"
+
+
+def default_cache_dir() -> Path:
+    """Return where the caches are kept on this node.
+
+    ``CAT12_MCR_CACHE_DIR`` if it is set,
+    otherwise a folder of the temporary directory
+    (``TMPDIR``, which batch schedulers usually point to node-local storage).
+    """
+    cache_dir = os.getenv("CAT12_MCR_CACHE_DIR")
+    if cache_dir:
+        return Path(cache_dir)
+    version = CAT_VERSION.replace(" ", "_")
+    return (
+        Path(tempfile.gettempdir())
+        / f"cat12_mcr_{version}_R{MCR_VERSION}_{os.getuid()}"
+    )
+
+
+def warmup_command(standalone: Path) -> list[str]:
+    """Return a command that starts the runtime and exits right away.
+
+    :param standalone: Folder of ``cat_standalone.sh``.
+    :type standalone: Path
+    """
+    spm_root = Path(os.getenv("SPMROOT", standalone.parent))
+    mcr_root = os.getenv("MCRROOT", f"/opt/MCR-{MCR_VERSION}/v93")
+    return [str(spm_root / "run_spm12.sh"), mcr_root, "--version"]
+
+
+def cache_env(env, cache: Path | None) -> dict[str, str]:
+    """Return a copy of ``env`` pointing the runtime at ``cache``."""
+    env = dict(env)
+    if cache is not None:
+        env["MCR_CACHE_ROOT"] = str(cache)
+    return env
+
+
+class McrCaches:
+    """Lock one cache per worker of this process.
+
+    Use as a context manager: the caches are unlocked on exit.
+
+    :param cache_dir: Where the caches of this node are.
+    :type cache_dir: Path
+
+    :param n_workers: Number of caches to lock.
+    :type n_workers: int
+    """
+
+    def __init__(self, cache_dir: Path, n_workers: int = 1):
+        self.cache_dir = cache_dir
+        self.n_workers = max(n_workers, 1)
+        self.slots: list[Path] = []
+        self._locks: list = []
+
+    def __enter__(self) -> McrCaches:
+        """Lock the first free caches."""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        index = 0
+        while len(self.slots) < self.n_workers:
+            slot = self.cache_dir / f"worker-{index}"
+            index += 1
+            lock = slot.with_suffix(".lock").open("a")
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                # used by another process
+                lock.close()
+                continue
+            slot.mkdir(exist_ok=True)
+            self.slots.append(slot)
+            self._locks.append(lock)
+        return self
+
+    def __exit__(self, *exc) -> None:
+        """Unlock the caches."""
+        for lock in self._locks:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+        self.slots = []
+        self._locks = []
+
+    def warm(self, slot: Path, standalone: Path, env) -> None:
+        """Make sure the runtime is extracted in a cache.
+
+        Copies the cache of another worker if one is warm,
+        otherwise starts the runtime once (see :func:`extract`).
+        """
+        if not self.copy_warm(slot):
+            extract(slot, standalone, env)
+
+    def copy_warm(self, slot: Path) -> bool:
+        """Copy a warm cache of another worker if ``slot`` is not warm.
+
+        Copying is much faster than extracting the runtime again.
+
+        :return: True if ``slot`` is now warm.
+        :rtype: bool
+        """
+        if is_warm(slot):
+            return True
+        for other in sorted(self.cache_dir.glob("worker-*")):
+            if other == slot or not is_warm(other):
+                continue
+            logger.info(f"Copying the MCR cache {other} to {slot}")
+            # the marker is written last so that a cache being copied
+            # is never copied in turn
+            shutil.copytree(
+                other,
+                slot,
+                symlinks=True,
+                dirs_exist_ok=True,
+                ignore=shutil.ignore_patterns(WARM_MARKER, "*.log"),
+            )
+            mark_warm(slot)
+            return True
+        return False
+
+
+def is_warm(slot: Path) -> bool:
+    """Check if the runtime was extracted in a cache."""
+    return (slot / WARM_MARKER).exists()
+
+
+def extract(slot: Path, standalone: Path, env) -> None:
+    """Start the runtime once so it extracts its archive in ``slot``.
+
+    The output of the runtime is written to ``slot/warmup.log``.
+
+    :raises RuntimeError: If the runtime fails.
+    """
+    logger.info(f"Extracting the MCR cache in {slot}")
+    with (slot / "warmup.log").open("w") as log:
+        result = run_supervised(
+            warmup_command(standalone),
+            log,
+            env=cache_env(env, slot),
+            echo=False,
+        )
+        log.write(f"{result.summary()}\n")
+    if result.returncode != 0:
+        raise RuntimeError(
+            f"Could not extract the MCR cache in {slot}: "
+            f"see {slot / 'warmup.log'}"
+        )
+    logger.info(f"MCR cache extracted in {result.wall_time:.1f} s")
+    mark_warm(slot)
+
+
+def mark_warm(slot: Path) -> None:
+    """Record that the runtime was extracted in a cache."""
+    (slot / WARM_MARKER).touch()
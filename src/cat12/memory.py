@@ -0,0 +1,223 @@
+"""Only start CAT12 processes while their memory fits on the node.
+
+The memory used by CAT12 grows with the number of voxels of the image,
+on top of what the MATLAB runtime and the templates need.
+The memory of a job is estimated from the header of its images
+with a linear model fitted on the peak memory
+of the previous runs recorded in ``logs/resources.tsv``
+(see :meth:`MemoryModel.fit`).
+
+Jobs are only started while the sum of the estimates of the running jobs
+stays within a budget (see :class:`MemoryBudget`).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+from cat12.cat_logging import cat12_log
+from cat12.costs import image_voxels
+
+logger = cat12_log(name="cat12")
+
+# peak memory in MB of the MATLAB runtime and CAT12 without the image
+DEFAULT_BASE = 1500.0
+
+# MB per voxel of the largest image processed by a CAT12 call
+DEFAULT_PER_VOXEL = 1e-4
+
+# share of the available memory used when no budget is given
+BUDGET_FRACTION = 0.9
+
+CGROUP = Path("/sys/fs/cgroup")
+
+_UNITS = {"K": 1 / 1024, "M": 1, "G": 1024, "T": 1024**2}
+
+
+def parse_memory(value: str) -> float:
+    """Convert a size like ``16G`` or ``512M`` to MB.
+
+    Numbers without unit are in MB.
+
+    :raises ValueError: If the size cannot be read.
+    """
+    value = value.strip().upper().removesuffix("B")
+    unit = 1.0
+    if value and value[-1] in _UNITS:
+        unit = _UNITS[value[-1]]
+        value = value[:-1]
+    return float(value) * unit
+
+
+def available_memory() -> float:
+    """Return the memory in MB this process can use.
+
+    The lowest of the memory available on the node,
+    the cgroup limit and the memory allocated by SLURM.
+    """
+    limits = [_meminfo("MemAvailable"), _cgroup_limit()]
+    for name in ("SLURM_MEM_PER_NODE", "SLURM_MEM_PER_CPU"):
+        try:
+            limit = float(os.environ[name])
+        except (KeyError, ValueError):
+            continue
+        if name == "SLURM_MEM_PER_CPU":
+            limit *= int(os.getenv("SLURM_CPUS_ON_NODE", "1"))
+        limits.append(limit)
+    limits = [x for x in limits if x is not None]
+    # no way to know: do not limit
+    return min(limits) if limits else float("inf")
+
+
+def _meminfo(field: str) -> float | None:
+    try:
+        with Path("/proc/meminfo").open() as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _cgroup_limit() -> float | None:
+    for path in (
+        CGROUP / "memory.max",
+        CGROUP / "memory" / "memory.limit_in_bytes",
+    ):
+        try:
+            value = path.read_text().strip()
+        except OSError:
+            continue
+        if value == "max":
+            return None
+        try:
+            limit = int(value) / 1024**2
+        except ValueError:
+            return None
+        # cgroup v1 reports a huge number when there is no limit
+        return limit if limit < 2**40 else None
+    return None
+
+
+class MemoryModel:
+    """Estimate the peak memory of a CAT12 call from its images.
+
+    ``base + per_voxel * n_voxels`` where ``n_voxels``
+    is the number of voxels of the largest image of the call:
+    CAT12 processes the images of a call one after the other.
+    """
+
+    def __init__(
+        self,
+        base: float = DEFAULT_BASE,
+        per_voxel: float = DEFAULT_PER_VOXEL,
+    ):
+        self.base = base
+        self.per_voxel = per_voxel
+
+    def __repr__(self) -> str:
+        """Show the coefficients."""
+        return (
+            f"{self.base:.0f} MB + {self.per_voxel * 1e6:.1f} MB "
+            "per million voxels"
+        )
+
+    @classmethod
+    def fit(cls, history: list[dict]) -> MemoryModel:
+        """Fit the model on the segmentations recorded by previous runs.
+
+        A least squares line is fitted on the peak memory
+        and the number of voxels of each segmentation,
+        then raised by its largest error
+        so that no recorded run would have been underestimated.
+        The default model is used until a segmentation was recorded
+        and only the base is fitted
+        until images of at least 2 different sizes were segmented.
+
+        :param history: Rows of ``resources.tsv``
+            (see :func:`cat12.accounting.read_resources`).
+        :type history: list[dict]
+
+        :rtype: MemoryModel
+        """
+        points = [
+            (row["n_voxels"], row["peak_rss"])
+            for row in history
+            if row.get("step") == "segment"
+            and row.get("n_voxels")
+            and row.get("peak_rss")
+        ]
+        if not points:
+            return cls()
+
+        n = len(points)
+        mean_x = sum(x for x, _ in points) / n
+        mean_y = sum(y for _, y in points) / n
+        var_x = sum((x - mean_x) ** 2 for x, _ in points)
+        if var_x > 0:
+            per_voxel = (
+                sum((x - mean_x) * (y - mean_y) for x, y in points) / var_x
+            )
+            per_voxel = max(per_voxel, 0.0)
+        else:
+            per_voxel = DEFAULT_PER_VOXEL
+        base = mean_y - per_voxel * mean_x
+        base += max(y - (base + per_voxel * x) for x, y in points)
+        return cls(base=max(base, 0.0), per_voxel=per_voxel)
+
+    def estimate(self, files: list[str]) -> float:
+        """Estimate the peak memory in MB of a call processing ``files``.
+
+        Only the headers of the images are read.
+        Images whose header cannot be read are ignored.
+        """
+        n_voxels = max((image_voxels(file) or 0 for file in files), default=0)
+        return self.base + self.per_voxel * n_voxels
+
+
+class MemoryBudget:
+    """Admit jobs while their estimated memory fits in a budget.
+
+    A job is always admitted when no other job is running
+    so a job bigger than the budget still runs, on its own.
+
+    :param budget: Memory in MB shared by the jobs.
+    :type budget: float
+
+    :param model: Estimates the memory of each job.
+    :type model: MemoryModel
+    """
+
+    def __init__(self, budget: float, model: MemoryModel | None = None):
+        self.budget = budget
+        self.model = model or MemoryModel()
+        self.reserved = 0.0
+        self.running = 0
+        self._condition: asyncio.Condition | None = None
+
+    @asynccontextmanager
+    async def reserve(self, estimate: float):
+        """Wait until a job of ``estimate`` MB fits and reserve it."""
+        if self._condition is None:
+            # bound to the running event loop
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(
+                lambda: (
+                    self.running == 0
+                    or self.reserved + estimate <= self.budget
+                )
+            )
+            self.reserved += estimate
+            self.running += 1
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self.reserved -= estimate
+                self.running -= 1
+                self._condition.notify_all()
@@ -3,7 +3,6 @@
 from pathlib import Path
 
 from cat12._version import __version__
-from jinja2 import Environment, FileSystemLoader, select_autoescape
 
 from cat12.defaults import CAT_VERSION, MCR_VERSION
 
@@ -16,6 +15,8 @@ def generate_method_section(
     batch: str | None = None,
 ) -> None:
     """Add a method section to the output dataset."""
+    from jinja2 import Environment, FileSystemLoader, select_autoescape
+
     env = Environment(
         loader=FileSystemLoader(Path(__file__).parent),
         autoescape=select_autoescape(),
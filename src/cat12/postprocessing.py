@@ -0,0 +1,229 @@
+"""Run the CAT12 post-processing batches on the outputs of all participants.
+
+Each batch reads files written by the segmentation
+(``report/cat_*.xml``, ``mri/mwp1*.nii``...)
+found in the folders of the participants of the output dataset.
+All the files are passed to a single call to ``cat_standalone.sh``,
+or split in a few contiguous shards processed by parallel calls,
+so the MATLAB runtime only starts once per shard
+instead of once per participant.
+
+Each shard writes its tables in a temporary folder of ``group``
+and the tables of all shards are then concatenated in ``group``
+in the order of the input files,
+listed in ``group/<table>_inputs.txt``.
+"""
+
+from __future__ import annotations
+
+import os
+from pathlib import Path
+from typing import NamedTuple
+
+from cat12.cat_logging import cat12_log
+
+logger = cat12_log(name="cat12")
+
+
+class PostprocessingBatch(NamedTuple):
+    """Inputs and arguments of a post-processing batch."""
+
+    folder: str
+    """Folder of the inputs in each session of each participant."""
+    prefix: str
+    """Start of the names of the inputs."""
+    suffixes: tuple[str, ...]
+    """Possible ends of the names of the inputs."""
+    output: str | None
+    """Table written by the batch (``-a1``), None if written next to inputs."""
+    arguments: tuple[str, ...] = ()
+    """Other arguments of the batch (``-a2``, ``-a3``...)."""
+    description: str = ""
+
+
+BATCHES = {
+    "get_TIV": PostprocessingBatch(
+        folder="report",
+        prefix="cat_",
+        suffixes=(".xml",),
+        output="TIV.txt",
+        # TIV, GM, WM, CSF and WMH volumes, with the file names
+        arguments=("0", "1"),
+        description="TIV and tissue volumes of each image in group/TIV.txt.",
+    ),
+    "get_IQR": PostprocessingBatch(
+        folder="report",
+        prefix="cat_",
+        suffixes=(".xml",),
+        output="IQR.txt",
+        description="Image quality rating of each image in group/IQR.txt.",
+    ),
+    "get_quality": PostprocessingBatch(
+        folder="mri",
+        prefix="mwp1",
+        suffixes=(".nii", ".nii.gz"),
+        output="Quality_measures.csv",
+        # global scaling with the TIV
+        arguments=("1",),
+        description="""
+        Mean correlation and Mahalanobis distance of the modulated gray matter
+        of each image in group/Quality_measures.csv.
+        """,
+    ),
+    "get_ROI_values": PostprocessingBatch(
+        folder="label",
+        prefix="catROI_",
+        suffixes=(".xml",),
+        output="ROI",
+        description="""
+        Values of each region of each atlas of all images
+        in group/ROI_*.csv (one table per atlas and measure).
+        """,
+    ),
+    "resample": PostprocessingBatch(
+        folder="surf",
+        prefix="lh.thickness.",
+        suffixes=("",),
+        output=None,
+        description="""
+        Resample and smooth the cortical thickness of each image
+        (written next to the surfaces).
+        """,
+    ),
+}
+
+
+def find_derivatives(
+    output_dir: Path,
+    batch: PostprocessingBatch,
+    subjects: list[str] | None = None,
+) -> list[str]:
+    """List the inputs of a batch in the folders of some participants.
+
+    :param output_dir: CAT12 output dataset.
+    :type output_dir: Path
+
+    :param batch: Batch to find the inputs of.
+    :type batch: PostprocessingBatch
+
+    :param subjects: Only include those participants. Defaults to all.
+    :type subjects: list[str], optional
+
+    :return: Paths to the inputs, sorted.
+    :rtype: list[str]
+    """
+    if subjects:
+        subject_dirs = [str(output_dir / f"sub-{label}") for label in subjects]
+    else:
+        subject_dirs = sorted(
+            entry.path
+            for entry in os.scandir(output_dir)
+            if entry.name.startswith("sub-") and entry.is_dir()
+        )
+    found: list[str] = []
+    for subject_dir in subject_dirs:
+        _find(subject_dir, batch, found)
+    return found
+
+
+def _find(directory: str, batch: PostprocessingBatch, found: list) -> None:
+    try:
+        entries = sorted(os.scandir(directory), key=lambda x: x.name)
+    except (FileNotFoundError, NotADirectoryError):
+        return
+    for entry in entries:
+        if not entry.is_dir() or entry.name.startswith("."):
+            continue
+        if entry.name != batch.folder:
+            _find(entry.path, batch, found)
+            continue
+        found.extend(
+            x.path
+            for x in sorted(os.scandir(entry.path), key=lambda x: x.name)
+            if x.is_file()
+            and x.name.startswith(batch.prefix)
+            and x.name.endswith(batch.suffixes)
+        )
+
+
+def split_files(files: list, n_shards: int) -> list[list]:
+    """Split files in contiguous shards of about the same size.
+
+    :rtype: list[list]
+    """
+    n_shards = max(min(n_shards, len(files)), 1)
+    size, extra = divmod(len(files), n_shards)
+    shards = []
+    start = 0
+    for index in range(n_shards):
+        end = start + size + (index < extra)
+        shards.append(files[start:end])
+        start = end
+    return shards
+
+
+def batch_command(
+    standalone: Path,
+    name: str,
+    files: list[str],
+    output: Path | None = None,
+    arguments: tuple[str, ...] = (),
+) -> list[str]:
+    """Return the command running a batch on some files.
+
+    :param output: Passed as first argument of the batch.
+    :type output: Path, optional
+    """
+    cmd = [
+        str(standalone / "cat_standalone.sh"),
+        *files,
+        "-b",
+        str(standalone / f"cat_standalone_{name}.m"),
+    ]
+    values = [str(output)] if output is not None else []
+    values.extend(arguments)
+    for index, value in enumerate(values, start=1):
+        cmd.extend([f"-a{index}", value])
+    return cmd
+
+
+def merge_shards(
+    shard_dirs: list[Path],
+    group_dir: Path,
+    replace: dict[str, str] | None = None,
+) -> list[Path]:
+    """Concatenate the tables written by each shard.
+
+    Tables are concatenated in the order of the shards.
+    Only the header of the first shard is kept for CSV files.
+
+    :param replace: Strings to replace in the tables,
+        like the paths of staged images.
+    :type replace: dict[str, str], optional
+
+    :return: The tables written in ``group_dir``.
+    :rtype: list[Path]
+    """
+    replace = {
+        old.encode(): new.encode() for old, new in (replace or {}).items()
+    }
+    names = sorted(
+        {x.name for shard_dir in shard_dirs for x in shard_dir.iterdir()}
+    )
+    outputs = []
+    for name in names:
+        tables = [x / name for x in shard_dirs if (x / name).is_file()]
+        output = group_dir / name
+        tmp = output.with_name(f".tmp_{os.getpid()}_{name}")
+        with tmp.open("wb") as f_out:
+            for index, table in enumerate(tables):
+                with table.open("rb") as f_in:
+                    if index > 0 and name.endswith(".csv"):
+                        f_in.readline()
+                    for line in f_in:
+                        for old, new in replace.items():
+                            line = line.replace(old, new)
+                        f_out.write(line)
+        tmp.replace(output)
+        outputs.append(output)
+    return outputs
@@ -0,0 +1,280 @@
+"""Check the input images before starting any CAT12 process.
+
+A corrupt or unusual image otherwise only fails
+once the MATLAB runtime has started, minutes later.
+Only the header of each image is read,
+images are checked in parallel with a pool of threads
+and the problems found are written to a JSON report.
+
+Problems are either:
+
+- ``error``: CAT12 cannot process the image
+  (unreadable header, truncated file, corrupt gzip stream,
+  not a single 3D volume, invalid voxel sizes or orientation),
+- ``warning``: CAT12 can process the image
+  but its results should be checked
+  (no qform or sform, qform and sform disagreeing, unusual voxel sizes).
+
+The size of the uncompressed data of a compressed image
+is read from the end of its gzip stream
+and compared to the size given by the header,
+which finds most truncated files without decompressing them.
+The whole stream is only decompressed (and its checksum checked)
+when those sizes differ or when asked to.
+"""
+
+from __future__ import annotations
+
+import gzip
+import json
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import NamedTuple
+
+import nibabel as nib
+import numpy as np
+
+from cat12.cat_logging import cat12_log
+
+logger = cat12_log(name="cat12")
+
+CHUNK_SIZE = 1024 * 1024
+
+# voxel sizes in mm outside this range are unusual for a T1w image
+VOXEL_SIZE_RANGE = (0.2, 3.0)
+
+# largest ratio between the voxel sizes of an image
+MAX_ANISOTROPY = 4.0
+
+# largest difference between the qform and the sform (mm)
+AFFINE_TOLERANCE = 1e-2
+
+
+class ImageReport(NamedTuple):
+    """Problems found in an image."""
+
+    path: str
+    subject: str
+    shape: list[int]
+    zooms: list[float]
+    errors: list[str]
+    warnings: list[str]
+
+    @property
+    def status(self) -> str:
+        """``error``, ``warning`` or ``ok``."""
+        if self.errors:
+            return "error"
+        return "warning" if self.warnings else "ok"
+
+
+def check_image(
+    path: str | Path, subject: str = "n/a", verify_gzip: bool = False
+) -> ImageReport:
+    """Check an image by reading its header.
+
+    :param path: Image to check.
+    :type path: str | Path
+
+    :param subject: Label of the participant of the image.
+    :type subject: str
+
+    :param verify_gzip: Decompress compressed images
+        to check their gzip stream.
+    :type verify_gzip: bool
+
+    :rtype: ImageReport
+    """
+    path = Path(path)
+    report = ImageReport(
+        path=str(path),
+        subject=subject,
+        shape=[],
+        zooms=[],
+        errors=[],
+        warnings=[],
+    )
+    try:
+        header = nib.load(path).header
+    except Exception as exc:
+        report.errors.append(f"cannot read the header: {exc}")
+        return report
+
+    report.shape.extend(int(x) for x in header.get_data_shape())
+    report.zooms.extend(round(float(x), 4) for x in header.get_zooms()[:3])
+    _check_shape(report)
+    _check_zooms(report)
+    _check_orientation(report, header)
+
+    offset = int(header.get_data_offset())
+    expected = int(np.prod(report.shape)) * header.get_data_dtype().itemsize
+    try:
+        _check_size(report, path, offset, expected)
+        if verify_gzip and path.name.endswith(".gz") and not report.errors:
+            _check_gzip(report, path, offset, expected)
+    except OSError as exc:
+        report.errors.append(f"cannot read the file: {exc}")
+    return report
+
+
+def _check_shape(report: ImageReport) -> None:
+    shape = report.shape
+    # a 4D image with a single volume is a 3D image
+    if len(shape) == 4 and shape[3] == 1:
+        shape = shape[:3]
+    if len(shape) != 3:
+        report.errors.append(
+            f"{len(shape)}D image of shape {shape}: "
+            "a single 3D volume is expected"
+        )
+    elif min(shape) < 2:
+        report.errors.append(f"image of shape {shape} is not a volume")
+
+
+def _check_zooms(report: ImageReport) -> None:
+    zooms = report.zooms
+    if len(zooms) < 3:
+        return
+    if not all(np.isfinite(zooms)) or min(zooms) <= 0:
+        report.errors.append(f"invalid voxel sizes {zooms}")
+        return
+    low, high = VOXEL_SIZE_RANGE
+    if min(zooms) < low or max(zooms) > high:
+        report.warnings.append(
+            f"unusual voxel sizes {zooms} "
+            f"(expected between {low} and {high} mm)"
+        )
+    if max(zooms) / min(zooms) > MAX_ANISOTROPY:
+        report.warnings.append(f"very anisotropic voxels {zooms}")
+
+
+def _check_orientation(report: ImageReport, header) -> None:
+    if not hasattr(header, "get_qform"):
+        # ANALYZE images have no orientation
+        report.warnings.append("no orientation in the header")
+        return
+    qform, qform_code = header.get_qform(coded=True)
+    sform, sform_code = header.get_sform(coded=True)
+    if not qform_code and not sform_code:
+        report.warnings.append(
+            "no qform or sform: "
+            "the orientation is guessed from the voxel sizes"
+        )
+    for name, affine in (("qform", qform), ("sform", sform)):
+        if affine is None:
+            continue
+        if not np.all(np.isfinite(affine)):
+            report.errors.append(f"the {name} is not finite")
+        elif abs(np.linalg.det(affine[:3, :3])) < 1e-12:
+            report.errors.append(f"the {name} is singular")
+    if (
+        qform is not None
+        and sform is not None
+        and not report.errors
+        and not np.allclose(qform, sform, atol=AFFINE_TOLERANCE)
+    ):
+        # SPM uses the sform, other tools may use the qform
+        report.warnings.append("the qform and the sform disagree")
+
+
+def _check_size(
+    report: ImageReport, path: Path, offset: int, expected: int
+) -> None:
+    size = path.stat().st_size
+    if not path.name.endswith(".gz"):
+        if size < offset + expected:
+            report.errors.append(
+                f"truncated: {size} bytes instead of {offset + expected}"
+            )
+        return
+
+    # the gzip trailer ends with the size of the data modulo 2**32
+    if size < 18:
+        report.errors.append(f"truncated: {size} bytes")
+        return
+    with path.open("rb") as f:
+        f.seek(-4, os.SEEK_END)
+        (isize,) = struct.unpack("<I", f.read(4))
+    if isize != (offset + expected) % 2**32:
+        # also the case of valid files made of several gzip members
+        _check_gzip(report, path, offset, expected)
+
+
+def _check_gzip(
+    report: ImageReport, path: Path, offset: int, expected: int
+) -> None:
+    """Decompress a whole gzip stream, which also checks its checksum."""
+    size = 0
+    try:
+        with gzip.open(path, "rb") as f:
+            while chunk := f.read(CHUNK_SIZE):
+                size += len(chunk)
+    except (EOFError, gzip.BadGzipFile, zlib.error) as exc:
+        report.errors.append(f"corrupt gzip stream: {exc}")
+        return
+    if size < offset + expected:
+        report.errors.append(
+            f"truncated: {size} bytes of data instead of {offset + expected}"
+        )
+
+
+def check_images(
+    inputs: dict[str, list], n_jobs: int = 1, verify_gzip: bool = False
+) -> list[ImageReport]:
+    """Check the images of several participants in parallel.
+
+    :param inputs: Map of participant labels to their images.
+    :type inputs: dict[str, list]
+
+    :param n_jobs: Number of images to check in parallel.
+    :type n_jobs: int
+
+    :param verify_gzip: Decompress compressed images
+        to check their gzip stream.
+    :type verify_gzip: bool
+
+    :rtype: list[ImageReport]
+    """
+    images = [
+        (subject_label, file.path)
+        for subject_label, bf in inputs.items()
+        for file in bf
+    ]
+    with ThreadPoolExecutor(max_workers=max(n_jobs, 1)) as executor:
+        return list(
+            executor.map(
+                lambda x: check_image(x[1], x[0], verify_gzip=verify_gzip),
+                images,
+            )
+        )
+
+
+def write_report(path: Path, reports: list[ImageReport], **info) -> None:
+    """Write the problems found in the images to a JSON file.
+
+    The report lists the images with problems
+    and counts the images of each status.
+    """
+    counts = {"ok": 0, "warning": 0, "error": 0}
+    for report in reports:
+        counts[report.status] += 1
+    content = {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        **info,
+        "n_images": len(reports),
+        "counts": counts,
+        "images": [
+            {"status": report.status, **report._asdict()}
+            for report in reports
+            if report.status != "ok"
+        ],
+    }
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".tmp_{os.getpid()}_{path.name}")
+    with tmp.open("w") as f:
+        json.dump(content, f, indent=4)
+    tmp.replace(path)
@@ -0,0 +1,262 @@
+"""Reuse the segmentation of an image processed before, in any dataset.
+
+The same scans are often processed several times:
+new releases of a dataset, subsets of it, participants of several studies.
+The outputs of each image are stored in a cache folder
+shared between datasets, under a key made of the hashes
+of the content of the image and of the batch,
+and of the versions of CAT12 and of the MATLAB runtime.
+Before an image is segmented, its outputs are restored from the cache
+if they are there.
+
+Each entry is a folder ``entries/<key>`` with the outputs of an image
+(named after the image, see :func:`cat12.manifest.list_outputs`)
+and an ``entry.json`` file listing their size and hash:
+
+- outputs are renamed after the image they are restored for,
+  but text outputs (reports, logs) still mention the image they were made for,
+- outputs are checked against their hash before being restored
+  and a corrupt entry is removed,
+- outputs are reflinked or copied, never hardlinked,
+  so that overwriting an output does not change the cache,
+- entries are written in a temporary folder and renamed once complete,
+- the least recently used entries are removed
+  once the cache grows over its maximum size:
+  the size of the cache is only scanned when the cache is opened
+  and when the entries stored since then may have made it too big.
+
+Only cross-sectional segmentations are cached:
+the outputs of a longitudinal segmentation depend on all the time points.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+from cat12.bids_utils import _hash
+from cat12.cat_logging import cat12_log
+from cat12.defaults import CAT_VERSION, MCR_VERSION
+from cat12.manifest import file_hash, list_outputs
+from cat12.staging import link_or_copy
+
+logger = cat12_log(name="cat12")
+
+# replaces the name of the image in the names of its outputs
+STEM = "{stem}"
+
+ENTRY_FILE = "entry.json"
+
+# share of the maximum size the cache is brought down to by an eviction,
+# so that the next ones only happen after many images are stored
+EVICT_TO = 0.9
+
+
+class ResultCache:
+    """Store and restore the outputs of images.
+
+    :param cache_dir: Folder of the cache, can be shared between datasets.
+    :type cache_dir: Path
+
+    :param batch: Path to the batch used to process the images.
+    :type batch: Path
+
+    :param max_size: Size of the cache in MB
+        over which the least recently used entries are removed.
+    :type max_size: float
+
+    :param compressed: Whether the outputs are compressed.
+    :type compressed: bool
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path,
+        batch: Path,
+        max_size: float = float("inf"),
+        compressed: bool = True,
+    ):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.entries = cache_dir / "entries"
+        self.tmp = cache_dir / "tmp"
+        self.entries.mkdir(parents=True, exist_ok=True)
+        self.tmp.mkdir(exist_ok=True)
+        self._batch_hash = file_hash(batch)
+        self._compressed = compressed
+        # size in MB at the last scan plus the entries stored since then
+        self._size: float | None = None
+        if max_size != float("inf"):
+            # the maximum size may have been lowered since the last run
+            self.evict()
+
+    def key(self, image_hash: str) -> str:
+        """Return the key of the outputs of an image."""
+        return _hash(
+            image_hash,
+            self._batch_hash,
+            CAT_VERSION,
+            MCR_VERSION,
+            # the outputs of a run with --no_compress have other names
+            "nii.gz" if self._compressed else "nii",
+        )
+
+    def restore(self, image_hash: str, staged: Path) -> bool:
+        """Restore the outputs of an image if they are in the cache.
+
+        :param image_hash: Hash of the content of the image.
+        :type image_hash: str
+
+        :param staged: Where the image would be staged to be processed:
+            the outputs are restored in its folder.
+        :type staged: Path
+
+        :return: True if the outputs were restored.
+        :rtype: bool
+        """
+        entry = self.entries / self.key(image_hash)
+        try:
+            with (entry / ENTRY_FILE).open() as f:
+                files = json.load(f)["files"]
+        except (OSError, ValueError, KeyError):
+            return False
+
+        stem = staged.name.split(".")[0]
+        restored = []
+        try:
+            for name, info in files.items():
+                src = entry / name
+                if file_hash(src) != info["hash"]:
+                    raise ValueError(f"{src} does not match its hash")
+                dst = staged.parent / name.replace(STEM, stem)
+                dst.parent.mkdir(parents=True, exist_ok=True)
+                tmp = dst.with_name(f".tmp_{os.getpid()}_{dst.name}")
+                link_or_copy(src, tmp)
+                tmp.replace(dst)
+                restored.append(dst)
+        except ValueError as exc:
+            logger.warning(f"Removing corrupt cache entry {entry}: {exc}")
+            self._remove(entry)
+            _unlink(restored)
+            return False
+        except OSError as exc:
+            # removed by another process
+            logger.debug(f"Cannot restore {entry}: {exc}")
+            _unlink(restored)
+            return False
+
+        # least recently used entries are evicted first
+        (entry / ENTRY_FILE).touch()
+        logger.info(f"{staged.name}: outputs restored from {entry}")
+        return True
+
+    def store(self, image_hash: str, staged: Path, output_dir: Path) -> None:
+        """Store the outputs of a processed image.
+
+        :param image_hash: Hash of the content of the image.
+        :type image_hash: str
+
+        :param staged: Path to the image that was processed.
+        :type staged: Path
+
+        :param output_dir: Output dataset.
+        :type output_dir: Path
+        """
+        key = self.key(image_hash)
+        entry = self.entries / key
+        if (entry / ENTRY_FILE).exists():
+            return
+
+        stem = staged.name.split(".")[0]
+        tmp = self.tmp / f"{key}.{uuid.uuid4().hex[:8]}"
+        files = {}
+        try:
+            for output in list_outputs(staged, output_dir):
+                src = output_dir / output
+                name = str(src.relative_to(staged.parent)).replace(stem, STEM)
+                dst = tmp / name
+                dst.parent.mkdir(parents=True, exist_ok=True)
+                link_or_copy(src, dst)
+                files[name] = {
+                    "size": dst.stat().st_size,
+                    "hash": file_hash(dst),
+                }
+            with (tmp / ENTRY_FILE).open("w") as f:
+                json.dump(
+                    {
+                        "files": files,
+                        "image": staged.name,
+                        "cat_version": CAT_VERSION,
+                        "mcr_version": MCR_VERSION,
+                        "time": datetime.now().isoformat(timespec="seconds"),
+                    },
+                    f,
+                    indent=4,
+                )
+            tmp.rename(entry)
+        except OSError as exc:
+            # stored by another process in the meantime, or out of space
+            logger.debug(f"Cannot store {entry}: {exc}")
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        logger.debug(f"{staged.name}: outputs stored in {entry}")
+        if self._size is not None:
+            self._size += sum(x["size"] for x in files.values()) / 1024**2
+            if self._size > self.max_size:
+                self.evict()
+
+    def size(self) -> tuple[float, list[tuple[float, float, Path]]]:
+        """Return the size of the cache in MB and of each entry.
+
+        :return: Total size and (last use, size in MB, path) of each entry.
+        :rtype: tuple[float, list[tuple[float, float, Path]]]
+        """
+        entries = []
+        for entry in os.scandir(self.entries):
+            try:
+                with Path(entry.path, ENTRY_FILE).open() as f:
+                    files = json.load(f)["files"]
+                last_use = Path(entry.path, ENTRY_FILE).stat().st_mtime
+            except (OSError, ValueError, KeyError):
+                continue
+            size = sum(x["size"] for x in files.values()) / 1024**2
+            entries.append((last_use, size, Path(entry.path)))
+        return sum(x[1] for x in entries), entries
+
+    def evict(self) -> None:
+        """Remove the least recently used entries over the maximum size.
+
+        Scans all the entries, so that entries stored by other processes
+        sharing the cache are counted.
+        Once over the maximum size,
+        the cache is brought down to ``EVICT_TO`` of it.
+        """
+        total, entries = self.size()
+        if total <= self.max_size:
+            self._size = total
+            return
+        for _, size, entry in sorted(entries):
+            if total <= self.max_size * EVICT_TO:
+                break
+            logger.debug(f"Evicting {entry} ({size:.0f} MB)")
+            self._remove(entry)
+            total -= size
+        self._size = total
+
+    def _remove(self, entry: Path) -> None:
+        # moved out first so that no process restores a partial entry
+        trash = self.tmp / f"{entry.name}.{uuid.uuid4().hex[:8]}.removed"
+        try:
+            entry.rename(trash)
+        except OSError:
+            return
+        shutil.rmtree(trash, ignore_errors=True)
+
+
+def _unlink(paths: list[Path]) -> None:
+    for path in paths:
+        path.unlink(missing_ok=True)
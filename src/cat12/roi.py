@@ -0,0 +1,442 @@
+"""Compute the TIV and the volumes of the regions of atlases without CAT12.
+
+This engine is experimental and only used with ``--engine native``.
+
+The ``get_TIV`` and ``get_ROI_values`` batches start the MATLAB runtime
+only to add up the voxels of the tissue maps written by the segmentation.
+This engine does the same with NumPy:
+
+- the modulated gray and white matter maps (``mri/mwp1*``, ``mri/mwp2*``)
+  and the atlases are memory-mapped when they are not compressed,
+- the sum of each map in each region of an atlas is a single
+  ``np.bincount`` of the map weighted by the labels of the atlas,
+- the images are processed in parallel by a pool of processes.
+
+Volumes are in cm3 like in the CAT12 reports:
+the sum of the modulated map in a region times the volume of a voxel.
+Means are the mean of the modulated map in a region.
+
+The values are not those of CAT12, only estimates of them:
+CAT12 computes the ``catROI`` values in the native space of each image,
+from its tissue maps and the atlas warped to it,
+while this engine works in template space on the modulated maps.
+Modulation preserves the volume of each tissue,
+so volumes agree up to interpolation and to the voxels
+at the borders of the regions,
+but the means of the modulated maps in each region
+(``mean_mwp1`` and ``mean_mwp2``) have no equivalent in CAT12.
+``benchmarks/bench_roi.py --output_dir`` compares the volumes
+to those of CAT12 on a segmented dataset.
+
+An atlas is a ``<atlas>.nii`` label image in the template space of CAT12
+(``templates_MNI152NLin2009cAsym`` in the CAT12 toolbox)
+with an optional ``<atlas>.csv`` table of the names of the regions.
+An atlas that is not on the grid of the maps is resampled
+to it with nearest neighbor interpolation.
+
+Tables are written in ``group/native``
+with the same columns as the tables of :mod:`cat12.group`
+so that both can be compared.
+"""
+
+from __future__ import annotations
+
+import csv
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from typing import NamedTuple
+
+import nibabel as nib
+import numpy as np
+
+from cat12.cat_logging import cat12_log
+from cat12.group import (
+    ENTITY_COLUMNS,
+    SESSION_PATTERN,
+    SUBJECT_PATTERN,
+    parse_report,
+    write_table,
+)
+from cat12.postprocessing import PostprocessingBatch
+
+logger = cat12_log(name="cat12")
+
+# inputs of the engine, found like the inputs of the batches
+GM_MAPS = PostprocessingBatch(
+    folder="mri",
+    prefix="mwp1",
+    suffixes=(".nii", ".nii.gz"),
+    output=None,
+    description="Modulated gray matter maps.",
+)
+
+# prefixes of the modulated maps of each tissue
+TISSUE_MAPS = {"GM": "mwp1", "WM": "mwp2", "CSF": "mwp3"}
+
+# measures of each region: volumes and means of the maps
+# (named after the maps as CAT12 has no such measure)
+ROI_MEASURES = ("Vgm", "Vwm", "mean_mwp1", "mean_mwp2")
+
+
+class Atlas(NamedTuple):
+    """Label image of an atlas and the names of its regions."""
+
+    name: str
+    path: str
+    ids: tuple[int, ...]
+    names: tuple[str, ...]
+
+
+class _Map(NamedTuple):
+    """Memory-mapped tissue map."""
+
+    data: np.ndarray
+    """Unscaled data."""
+    scale: tuple[float, float]
+    """Slope and intercept of the data."""
+    voxel_volume: float
+    """Volume of a voxel in mm3."""
+    affine: bytes
+
+
+def find_atlases(
+    atlas_dir: Path, names: list[str] | None = None
+) -> list[Atlas]:
+    """List the atlases of a folder.
+
+    :param atlas_dir: Folder with ``<atlas>.nii`` label images
+        and their ``<atlas>.csv`` region names.
+    :type atlas_dir: Path
+
+    :param names: Only include those atlases.
+        Defaults to all the atlases with region names.
+    :type names: list[str], optional
+
+    :raises FileNotFoundError: If an atlas in ``names`` is not found.
+
+    :rtype: list[Atlas]
+    """
+    if names:
+        paths = []
+        for name in names:
+            path = _atlas_image(atlas_dir, name)
+            if path is None:
+                raise FileNotFoundError(
+                    f"atlas {name} not found in {atlas_dir}"
+                )
+            paths.append(path)
+    else:
+        paths = sorted(
+            x
+            for x in atlas_dir.glob("*.nii*")
+            if x.with_name(f"{_stem(x)}.csv").is_file()
+        )
+    return [_atlas(path) for path in paths]
+
+
+def _atlas_image(atlas_dir: Path, name: str) -> Path | None:
+    for ext in (".nii", ".nii.gz"):
+        if (atlas_dir / f"{name}{ext}").is_file():
+            return atlas_dir / f"{name}{ext}"
+    return None
+
+
+def _stem(path: Path) -> str:
+    return path.name.split(".")[0]
+
+
+def _atlas(path: Path) -> Atlas:
+    """Read the regions of an atlas from its CSV file.
+
+    The CSV files of CAT12 are separated by ``;``
+    with the label in ``ROIid`` and the name in ``ROIname``.
+    Without a CSV file the regions are the labels found in the image.
+    """
+    table = path.with_name(f"{_stem(path)}.csv")
+    if table.is_file():
+        with table.open(newline="") as f:
+            rows = list(csv.DictReader(f, delimiter=";"))
+        regions = {
+            int(row["ROIid"]): row.get("ROIname") or row["ROIid"]
+            for row in rows
+            if row.get("ROIid", "").strip().isdigit()
+        }
+    else:
+        labels = np.unique(np.asanyarray(nib.load(path).dataobj))
+        regions = {int(x): f"label-{int(x)}" for x in labels if x > 0}
+    regions.pop(0, None)
+    return Atlas(
+        name=_stem(path),
+        path=str(path),
+        ids=tuple(regions),
+        names=tuple(regions.values()),
+    )
+
+
+def tissue_volumes(gm_map: str) -> dict[str, float]:
+    """Return the volumes in cm3 of the tissues of an image.
+
+    The volumes are the sums of the modulated maps of the image
+    found next to its gray matter map.
+    The TIV is the sum of the volumes of the tissues
+    when the CSF map was written, otherwise it is read from the report.
+
+    :param gm_map: Path to the modulated gray matter map (``mwp1*``).
+    :type gm_map: str
+    """
+    values = {}
+    for tissue, prefix in TISSUE_MAPS.items():
+        path = _tissue_map(gm_map, prefix)
+        if path is None:
+            continue
+        tissue_map = _load(path)
+        data = tissue_map.data
+        total = _scaled_sum(
+            data.sum(dtype=np.float64), data.size, tissue_map.scale
+        )
+        values[tissue] = total * tissue_map.voxel_volume / 1000
+    if "CSF" in values:
+        values["TIV"] = values["GM"] + values.get("WM", np.nan) + values["CSF"]
+    else:
+        values["TIV"] = _report_tiv(gm_map)
+    return {name: values.get(name, np.nan) for name in ("TIV", *TISSUE_MAPS)}
+
+
+def roi_values(gm_map: str, atlases: list[Atlas]) -> dict[str, dict]:
+    """Return the volumes and means of the maps of an image in each region.
+
+    :param gm_map: Path to the modulated gray matter map (``mwp1*``).
+    :type gm_map: str
+
+    :param atlases: Atlases to compute the values of.
+    :type atlases: list[Atlas]
+
+    :return: Map of atlas names to a map of measure names
+        to the value of each region of the atlas.
+    :rtype: dict[str, dict[str, numpy.ndarray]]
+    """
+    maps = {}
+    prefixes = {}
+    for tissue in ("gm", "wm"):
+        prefixes[tissue] = TISSUE_MAPS[tissue.upper()]
+        path = _tissue_map(gm_map, prefixes[tissue])
+        if path is not None:
+            maps[tissue] = _load(path)
+
+    values = {}
+    for atlas in atlases:
+        measures = {}
+        for tissue, tissue_map in maps.items():
+            labels, counts = _labels(
+                atlas.path, tissue_map.data.shape, tissue_map.affine
+            )
+            sums = np.bincount(
+                labels,
+                weights=tissue_map.data.ravel(order="F"),
+                minlength=counts.size,
+            )
+            sums = _scaled_sum(sums, counts, tissue_map.scale)
+            ids = np.asarray(atlas.ids)
+            in_range = ids < counts.size
+            region_sums = np.full(ids.size, np.nan)
+            region_counts = np.zeros(ids.size)
+            region_sums[in_range] = sums[ids[in_range]]
+            region_counts[in_range] = counts[ids[in_range]]
+            measures[f"V{tissue}"] = (
+                region_sums * tissue_map.voxel_volume / 1000
+            )
+            with np.errstate(invalid="ignore", divide="ignore"):
+                measures[f"mean_{prefixes[tissue]}"] = (
+                    region_sums / region_counts
+                )
+        values[atlas.name] = measures
+    return values
+
+
+def _tissue_map(gm_map: str, prefix: str) -> str | None:
+    path = Path(gm_map)
+    path = path.with_name(prefix + path.name[len(TISSUE_MAPS["GM"]) :])
+    return str(path) if path.is_file() else None
+
+
+def _load(path: str) -> _Map:
+    """Memory-map the data of an image.
+
+    The scaling is applied to the sums rather than to each voxel
+    so the data is never copied.
+    """
+    img = nib.load(path, mmap=True)
+    data = np.asanyarray(img.dataobj.get_unscaled())
+    if data.ndim == 4 and data.shape[3] == 1:
+        data = data[..., 0]
+    return _Map(
+        data=data,
+        scale=(float(img.dataobj.slope), float(img.dataobj.inter)),
+        voxel_volume=float(np.prod(img.header.get_zooms()[:3])),
+        affine=img.affine.astype(np.float64).tobytes(),
+    )
+
+
+def _scaled_sum(sums, counts, scale: tuple[float, float]):
+    # sum(slope * x + inter) = slope * sum(x) + inter * n
+    slope, inter = scale
+    return slope * sums + inter * counts
+
+
+@lru_cache(maxsize=16)
+def _labels(
+    atlas: str, shape: tuple[int, ...], affine: bytes
+) -> tuple[np.ndarray, np.ndarray]:
+    """Return the labels of an atlas on the grid of the maps.
+
+    Cached as all the maps of a dataset usually share the same grid.
+
+    :return: The label of each voxel (flattened in Fortran order)
+        and the number of voxels of each label.
+    """
+    img = nib.load(atlas, mmap=True)
+    labels = np.asanyarray(img.dataobj)
+    if labels.ndim == 4:
+        labels = labels[..., 0]
+    target = np.frombuffer(affine).reshape(4, 4)
+    if labels.shape != shape or not np.allclose(img.affine, target, atol=1e-3):
+        labels = _resample(labels, img.affine, shape, target)
+    labels = np.rint(labels).astype(np.intp).ravel(order="F")
+    labels[labels < 0] = 0
+    return labels, np.bincount(labels)
+
+
+def _resample(
+    labels: np.ndarray,
+    affine: np.ndarray,
+    shape: tuple[int, ...],
+    target: np.ndarray,
+) -> np.ndarray:
+    """Resample labels on another grid with nearest neighbor interpolation."""
+    logger.debug(f"resampling atlas of shape {labels.shape} to {shape}")
+    voxels = np.indices(shape, dtype=np.float64).reshape(3, -1)
+    mapping = np.linalg.inv(affine) @ target
+    coords = np.rint(mapping[:3, :3] @ voxels + mapping[:3, 3:]).astype(
+        np.intp
+    )
+    inside = np.all(
+        (coords >= 0) & (coords < np.array(labels.shape)[:, None]), axis=0
+    )
+    resampled = np.zeros(voxels.shape[1], dtype=labels.dtype)
+    resampled[inside] = labels[tuple(coords[:, inside])]
+    return resampled.reshape(shape)
+
+
+def _report_tiv(gm_map: str) -> float:
+    """Read the TIV from the report of an image, NaN if there is none."""
+    path = Path(gm_map)
+    stem = path.name[len(TISSUE_MAPS["GM"]) :].split(".")[0]
+    report = path.parent.parent / "report" / f"cat_{stem}.xml"
+    if not report.is_file():
+        return np.nan
+    return parse_report(report).get("TIV", np.nan)
+
+
+def entities(path: str) -> list[str]:
+    """Return the participant, session and source image of a map."""
+    source = Path(path).name[len(TISSUE_MAPS["GM"]) :].split(".")[0]
+    subject = SUBJECT_PATTERN.search(source)
+    session = SESSION_PATTERN.search(source)
+    return [
+        f"sub-{subject['subject']}" if subject else "n/a",
+        f"ses-{session['session']}" if session else "n/a",
+        source,
+    ]
+
+
+def _format(value: float) -> str:
+    return "n/a" if np.isnan(value) else f"{value:.6g}"
+
+
+def _map(func, args: list, n_jobs: int) -> list:
+    if n_jobs > 1 and len(args) > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            return list(
+                executor.map(
+                    func,
+                    *zip(*args),
+                    chunksize=max(len(args) // (4 * n_jobs), 1),
+                )
+            )
+    return [func(*x) for x in args]
+
+
+def write_tiv(
+    gm_maps: list[str], group_dir: Path, n_jobs: int = 1
+) -> list[Path]:
+    """Write the TIV and tissue volumes of each image to ``volumes.tsv``.
+
+    :param gm_maps: Paths to the modulated gray matter maps.
+    :type gm_maps: list[str]
+
+    :param group_dir: Folder of the tables.
+    :type group_dir: Path
+
+    :param n_jobs: Number of processes.
+    :type n_jobs: int
+
+    :return: The tables written.
+    :rtype: list[Path]
+    """
+    volumes = _map(tissue_volumes, [(x,) for x in gm_maps], n_jobs)
+    columns = ["TIV", *TISSUE_MAPS]
+    rows = [
+        [*entities(path), *(_format(row[x]) for x in columns)]
+        for path, row in zip(gm_maps, volumes)
+    ]
+    group_dir.mkdir(parents=True, exist_ok=True)
+    return write_table(group_dir / "volumes", ENTITY_COLUMNS + columns, rows)
+
+
+def write_rois(
+    gm_maps: list[str],
+    atlases: list[Atlas],
+    group_dir: Path,
+    n_jobs: int = 1,
+) -> list[Path]:
+    """Write a table per atlas and measure with one row per image.
+
+    Tables are named ``roi_atlas-<atlas>_<measure>.tsv``
+    with the measures of :data:`ROI_MEASURES`.
+
+    :param gm_maps: Paths to the modulated gray matter maps.
+    :type gm_maps: list[str]
+
+    :param atlases: Atlases to compute the values of.
+    :type atlases: list[Atlas]
+
+    :param group_dir: Folder of the tables.
+    :type group_dir: Path
+
+    :param n_jobs: Number of processes.
+    :type n_jobs: int
+
+    :return: The tables written.
+    :rtype: list[Path]
+    """
+    values = _map(roi_values, [(x, atlases) for x in gm_maps], n_jobs)
+    group_dir.mkdir(parents=True, exist_ok=True)
+    outputs = []
+    for atlas in atlases:
+        for measure in ROI_MEASURES:
+            rows = [
+                [*entities(path), *map(_format, row[atlas.name][measure])]
+                for path, row in zip(gm_maps, values)
+                if measure in row[atlas.name]
+            ]
+            if not rows:
+                continue
+            outputs.extend(
+                write_table(
+                    group_dir / f"roi_atlas-{atlas.name}_{measure}",
+                    ENTITY_COLUMNS + list(atlas.names),
+                    rows,
+                )
+            )
+    return outputs
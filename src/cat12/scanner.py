@@ -0,0 +1,189 @@
+"""Find T1w images in a BIDS dataset without building a BIDSLayout.
+
+All the app needs from an input dataset is
+``sub-*/[ses-*/]anat/*_T1w.nii[.gz]``,
+so walking those folders is much cheaper than indexing every file
+of every modality with pybids.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import NamedTuple
+
+from cat12.cat_logging import cat12_log
+
+logger = cat12_log(name="cat12")
+
+T1W_PATTERN = re.compile(
+    r"^sub-(?P<subject>[a-zA-Z0-9]+)"
+    r"(?P<entities>(_[a-zA-Z0-9]+-[a-zA-Z0-9]+)*)"
+    r"_T1w(?P<extension>\.nii(\.gz)?)$"
+)
+
+ENTITY_NAMES = {
+    "ses": "session",
+    "acq": "acquisition",
+    "ce": "ceagent",
+    "rec": "reconstruction",
+    "run": "run",
+    "part": "part",
+    "chunk": "chunk",
+}
+
+
+class T1wImage(NamedTuple):
+    """A T1w image and its BIDS entities.
+
+    Exposes ``path`` and ``relpath`` like a pybids ``BIDSFile``.
+    """
+
+    path: str
+    relpath: str
+    subject: str
+    session: str | None
+    entities: dict[str, str]
+
+    @property
+    def extension(self) -> str:
+        """Return the extension of the file."""
+        return self.entities["extension"]
+
+
+def list_subject_dirs(bids_dir: str | Path) -> list[str]:
+    """List the labels of the ``sub-*`` folders of a dataset.
+
+    :param bids_dir: Path to the dataset.
+    :type bids_dir: Union[str, Path]
+
+    :return: Sorted subject labels.
+    :rtype: list[str]
+    """
+    return sorted(
+        entry.name[4:]
+        for entry in os.scandir(bids_dir)
+        if entry.name.startswith("sub-") and entry.is_dir()
+    )
+
+
+def find_t1w(
+    bids_dir: str | Path,
+    subjects: list[str] | None = None,
+    extensions: tuple[str, ...] = (".nii", ".nii.gz"),
+    n_jobs: int = 1,
+) -> dict[str, list[T1wImage]]:
+    """Find the T1w images of each subject.
+
+    Subject folders are scanned in parallel with a pool of threads
+    when ``n_jobs > 1``.
+
+    :param bids_dir: Path to the dataset.
+    :type bids_dir: Union[str, Path]
+
+    :param subjects: Labels of the subjects to scan.
+        Defaults to all the subjects of the dataset.
+    :type subjects: list[str], optional
+
+    :param extensions: Only return files with those extensions.
+    :type extensions: tuple[str, ...]
+
+    :param n_jobs: Number of subjects to scan in parallel.
+    :type n_jobs: int
+
+    :return: Map of subject labels to their sorted T1w images.
+        Subjects without any T1w image map to an empty list.
+    :rtype: dict[str, list[T1wImage]]
+    """
+    bids_dir = Path(bids_dir).absolute()
+
+    logger.info(f"looking for T1w images in {bids_dir}")
+
+    all_subjects = list_subject_dirs(bids_dir)
+    if subjects:
+        subjects = [x for x in subjects if x in all_subjects]
+    else:
+        subjects = all_subjects
+
+    def _scan(subject: str) -> list[T1wImage]:
+        return scan_subject(bids_dir, subject, extensions)
+
+    if n_jobs > 1 and len(subjects) > 1:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            images = list(executor.map(_scan, subjects))
+    else:
+        images = [_scan(subject) for subject in subjects]
+
+    return dict(zip(subjects, images))
+
+
+def scan_subject(
+    bids_dir: Path,
+    subject: str,
+    extensions: tuple[str, ...] = (".nii", ".nii.gz"),
+) -> list[T1wImage]:
+    """Find the T1w images of a single subject.
+
+    Only looks in ``sub-<label>/anat`` and ``sub-<label>/ses-*/anat``.
+
+    :param bids_dir: Path to the dataset.
+    :type bids_dir: Path
+
+    :param subject: Subject label.
+    :type subject: str
+
+    :param extensions: Only return files with those extensions.
+    :type extensions: tuple[str, ...]
+
+    :rtype: list[T1wImage]
+    """
+    subject_dir = bids_dir / f"sub-{subject}"
+
+    anat_dirs = []
+    for entry in os.scandir(subject_dir):
+        if not entry.is_dir():
+            continue
+        if entry.name == "anat":
+            anat_dirs.append(entry.path)
+        elif entry.name.startswith("ses-"):
+            anat = Path(entry.path) / "anat"
+            if anat.is_dir():
+                anat_dirs.append(str(anat))
+
+    images = []
+    for anat in anat_dirs:
+        for entry in os.scandir(anat):
+            image = _parse(entry, bids_dir)
+            if (
+                image is not None
+                and image.subject == subject
+                and image.extension in extensions
+                and entry.is_file()
+            ):
+                images.append(image)
+
+    return sorted(images, key=lambda x: x.relpath)
+
+
+def _parse(entry: os.DirEntry, bids_dir: Path) -> T1wImage | None:
+    match = T1W_PATTERN.match(entry.name)
+    if match is None:
+        return None
+
+    entities = {"subject": match["subject"]}
+    for pair in match["entities"].split("_")[1:]:
+        key, value = pair.split("-")
+        entities[ENTITY_NAMES.get(key, key)] = value
+    entities["suffix"] = "T1w"
+    entities["datatype"] = "anat"
+    entities["extension"] = match["extension"]
+
+    return T1wImage(
+        path=entry.path,
+        relpath=os.path.relpath(entry.path, bids_dir),
+        subject=entities["subject"],
+        session=entities.get("session"),
+        entities=entities,
+    )
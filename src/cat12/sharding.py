@@ -0,0 +1,156 @@
+"""Split participants in shards to process them with cluster array jobs.
+
+Each array task processes one shard.
+Shards are balanced by the estimated cost of their participants
+(see :mod:`cat12.costs`) with a greedy "longest processing time first"
+assignment, which only depends on the participants and their images,
+so every task of an array computes the same shards.
+"""
+
+from __future__ import annotations
+
+import heapq
+import os
+import shlex
+from pathlib import Path
+
+from cat12.cat_logging import cat12_log
+
+logger = cat12_log(name="cat12")
+
+SCHEDULERS = ("slurm", "pbs")
+
+
+def balance(costs: dict[str, float], shard_count: int) -> list[list[str]]:
+    """Split participants in shards of similar total cost.
+
+    The most expensive participants are assigned first,
+    each to the shard with the lowest total cost so far.
+    Ties are broken by participant label and shard index
+    so the result is deterministic.
+
+    :param costs: Map of participant labels to their estimated cost.
+    :type costs: dict[str, float]
+
+    :param shard_count: Number of shards.
+    :type shard_count: int
+
+    :return: Sorted participant labels of each shard.
+    :rtype: list[list[str]]
+    """
+    shards: list[list[str]] = [[] for _ in range(shard_count)]
+    loads = [(0.0, index) for index in range(shard_count)]
+    for label in sorted(costs, key=lambda x: (-costs[x], x)):
+        load, index = heapq.heappop(loads)
+        shards[index].append(label)
+        heapq.heappush(loads, (load + costs[label], index))
+    return [sorted(shard) for shard in shards]
+
+
+def shard_from_env() -> tuple[int, int] | None:
+    """Return the index and count of the current array task.
+
+    Reads the variables set by SLURM (``SLURM_ARRAY_TASK_ID``,
+    ``SLURM_ARRAY_TASK_MIN`` and ``SLURM_ARRAY_TASK_COUNT``).
+
+    :return: Index of the shard from 0 and number of shards,
+        or None when not running in a SLURM array job.
+    :rtype: tuple[int, int], optional
+    """
+    task_id = os.getenv("SLURM_ARRAY_TASK_ID")
+    task_count = os.getenv("SLURM_ARRAY_TASK_COUNT")
+    if task_id is None or task_count is None:
+        return None
+    task_min = int(os.getenv("SLURM_ARRAY_TASK_MIN", "0"))
+    return int(task_id) - task_min, int(task_count)
+
+
+def select_shard(
+    inputs: dict[str, list],
+    costs: dict[str, float],
+    shard_index: int,
+    shard_count: int,
+) -> dict[str, list]:
+    """Only keep the participants of a shard.
+
+    :raises ValueError: If the shard index is not in ``[0, shard_count)``.
+    """
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(
+            f"shard index {shard_index} "
+            f"must be between 0 and {shard_count - 1}"
+        )
+    shard = balance(costs, shard_count)[shard_index]
+    logger.info(
+        f"shard {shard_index + 1} / {shard_count}: {len(shard)} participants "
+        f"(estimated cost {sum(costs[x] for x in shard):.1f})"
+    )
+    return {label: inputs[label] for label in shard}
+
+
+def write_plan(
+    output_dir: Path,
+    shards: list[list[str]],
+    costs: dict[str, float],
+    scheduler: str,
+    command: list[str],
+    resources: dict[str, str | int | None],
+) -> Path:
+    """Write an array job script and the list of participants of each shard.
+
+    :param output_dir: Where to write the script and the shards.
+    :type output_dir: Path
+
+    :param shards: Participant labels of each shard.
+    :type shards: list[list[str]]
+
+    :param costs: Estimated cost of each participant.
+    :type costs: dict[str, float]
+
+    :param scheduler: ``slurm`` or ``pbs``.
+    :type scheduler: str
+
+    :param command: Command run by each task,
+        the shard index and count are added to it.
+    :type command: list[str]
+
+    :param resources: Resources requested for each task
+        (``time``, ``cpus``, ``mem``).
+    :type resources: dict
+
+    :return: Path to the script.
+    :rtype: Path
+    """
+    from jinja2 import Environment, FileSystemLoader
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    with (output_dir / "shards.tsv").open("w") as f:
+        f.write("shard_index\tparticipant_id\testimated_cost\n")
+        for index, shard in enumerate(shards):
+            for label in shard:
+                f.write(f"{index}\tsub-{label}\t{costs[label]:.3f}\n")
+
+    env = Environment(
+        loader=FileSystemLoader(Path(__file__).parent),
+        lstrip_blocks=True,
+        trim_blocks=True,
+        keep_trailing_newline=True,
+    )
+    template = env.get_template(f"data/plan/{scheduler}.jinja")
+
+    script = output_dir / f"cat12_{scheduler}.sh"
+    log_dir = output_dir / "logs"
+    log_dir.mkdir(exist_ok=True)
+    with script.open("w") as f:
+        f.write(
+            template.render(
+                command=shlex.join(str(x) for x in command),
+                shard_count=len(shards),
+                log_dir=log_dir.absolute(),
+                **resources,
+            )
+        )
+    script.chmod(0o755)
+
+    return script
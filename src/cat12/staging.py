@@ -0,0 +1,222 @@
+"""Stage input images in the output dataset without decoding them.
+
+SPM cannot read compressed images, so inputs are staged as ``.nii``:
+
+- uncompressed images are reflinked or copied in kernel space
+  (or hardlinked on request),
+- compressed images are gunzipped by streaming fixed size chunks.
+
+Only the header of the staged image is read to check it.
+"""
+
+from __future__ import annotations
+
+import errno
+import gzip
+import os
+import shutil
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+from cat12.cat_logging import cat12_log
+
+logger = cat12_log(name="cat12")
+
+CHUNK_SIZE = 1024 * 1024
+
+# from linux/fs.h
+FICLONE = 0x40049409
+
+
+def staged_path(output_dir: Path, relpath: str | Path) -> Path:
+    """Return where an input image is staged in the output dataset."""
+    output_filename = output_dir / relpath
+    if output_filename.name.endswith(".gz"):
+        output_filename = output_filename.with_suffix("")
+    return output_filename
+
+
+def stage_files(
+    files: list[tuple[Path, Path]],
+    n_jobs: int = 1,
+    callback=None,
+    hardlink: bool = False,
+) -> dict[Path, str]:
+    """Stage several images in parallel with a pool of threads.
+
+    :param files: Pairs of source and destination paths.
+    :type files: list[tuple[Path, Path]]
+
+    :param n_jobs: Number of images to stage in parallel.
+    :type n_jobs: int
+
+    :param callback: Called with the destination of each staged image.
+
+    :param hardlink: Hardlink the uncompressed images
+        that cannot be reflinked instead of copying them.
+    :type hardlink: bool
+
+    :return: Map of the destination that could not be staged
+        to the error message.
+    :rtype: dict[Path, str]
+    """
+    failures = {}
+    with ThreadPoolExecutor(max_workers=max(n_jobs, 1)) as executor:
+        futures = {
+            executor.submit(stage_file, src, dst, hardlink=hardlink): dst
+            for src, dst in files
+        }
+        for future in as_completed(futures):
+            dst = futures[future]
+            try:
+                method = future.result()
+                logger.debug(f"Staged {dst} ({method})")
+            # a truncated or corrupted gzip stream raises EOFError
+            # or zlib.error while it is decompressed
+            except (OSError, ValueError, EOFError, zlib.error) as exc:
+                logger.error(f"Could not stage {dst}: {exc}")
+                failures[dst] = repr(exc)
+            if callback is not None:
+                callback(dst)
+    return failures
+
+
+def stage_file(
+    src: str | Path, dst: str | Path, hardlink: bool = False
+) -> str:
+    """Stage a single image as an uncompressed nifti.
+
+    The image is first written to a temporary file
+    that is renamed once its header has been checked,
+    so an interrupted run never leaves a partial image behind.
+
+    :param src: Input image.
+    :type src: Union[str, Path]
+
+    :param dst: Where to stage the image, must end with ``.nii``.
+    :type dst: Union[str, Path]
+
+    :param hardlink: See :func:`link_or_copy`.
+    :type hardlink: bool
+
+    :return: How the image was staged:
+        ``gunzip``, ``reflink``, ``hardlink`` or ``copy``.
+    :rtype: str
+    """
+    src = Path(src)
+    dst = Path(dst)
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dst.with_name(f".tmp_{os.getpid()}_{dst.name}")
+    tmp.unlink(missing_ok=True)
+
+    try:
+        if src.name.endswith(".gz"):
+            method = "gunzip"
+            _gunzip(src, tmp)
+        else:
+            method = link_or_copy(src, tmp, hardlink=hardlink)
+        check_header(tmp)
+        tmp.replace(dst)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+    return method
+
+
+def check_header(path: str | Path) -> None:
+    """Check that a nifti image has a valid header and is not truncated.
+
+    Only the header is read.
+
+    :raises ValueError: If the header is invalid
+        or the file is smaller than the header says.
+    """
+    import nibabel as nib
+
+    path = Path(path)
+    try:
+        header = nib.load(path).header
+    except Exception as exc:
+        raise ValueError(f"Invalid nifti header in {path}: {exc}") from exc
+
+    n_voxels = 1
+    for dim in header.get_data_shape():
+        n_voxels *= dim
+    expected = int(header.get_data_offset()) + (
+        n_voxels * header.get_data_dtype().itemsize
+    )
+    size = path.stat().st_size
+    if size < expected:
+        raise ValueError(
+            f"{path} is truncated: {size} bytes instead of {expected}."
+        )
+
+
+def _gunzip(src: Path, dst: Path) -> None:
+    with gzip.open(src, "rb") as f_in, dst.open("wb") as f_out:
+        shutil.copyfileobj(f_in, f_out, length=CHUNK_SIZE)
+
+
+def link_or_copy(src: Path, dst: Path, hardlink: bool = False) -> str:
+    """Copy a file with the cheapest available method.
+
+    A reflink shares the data until one copy is modified,
+    otherwise the file is copied.
+    With ``hardlink=True``, a file that cannot be reflinked
+    is hardlinked instead of copied: both paths then share the same data,
+    so writing to one in place modifies the other.
+
+    :return: ``reflink``, ``hardlink`` or ``copy``.
+    :rtype: str
+    """
+    if _reflink(src, dst):
+        return "reflink"
+    if hardlink:
+        try:
+            os.link(src, dst)
+            return "hardlink"
+        except OSError as exc:
+            if exc.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+    _copy(src, dst)
+    return "copy"
+
+
+def _reflink(src: Path, dst: Path) -> bool:
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    with src.open("rb") as f_in, dst.open("wb") as f_out:
+        try:
+            fcntl.ioctl(f_out.fileno(), FICLONE, f_in.fileno())
+            return True
+        except OSError:
+            pass
+    dst.unlink()
+    return False
+
+
+def _copy(src: Path, dst: Path) -> None:
+    """Copy in kernel space with copy_file_range when available."""
+    if not hasattr(os, "copy_file_range"):
+        shutil.copyfile(src, dst)
+        return
+    with src.open("rb") as f_in, dst.open("wb") as f_out:
+        size = os.fstat(f_in.fileno()).st_size
+        copied = 0
+        while copied < size:
+            try:
+                n = os.copy_file_range(
+                    f_in.fileno(), f_out.fileno(), size - copied
+                )
+            except OSError:
+                # not supported by this file system: copy in user space
+                f_in.seek(copied)
+                f_out.seek(copied)
+                shutil.copyfileobj(f_in, f_out, length=CHUNK_SIZE)
+                return
+            if n == 0:
+                break
+            copied += n
@@ -0,0 +1,257 @@
+"""Supervise child processes with asyncio.
+
+A single event loop streams the output of many children to their log files
+and collects their exit status and resource usage,
+so no Python thread or process is needed to babysit each child.
+The process tree of each child is also sampled while it runs
+(see :class:`cat12.accounting.ProcessTreeSampler`).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import signal
+import sys
+import time
+from datetime import datetime
+from subprocess import PIPE, STDOUT, Popen
+from typing import NamedTuple
+
+from cat12.accounting import ProcessTreeSampler
+from cat12.cat_logging import cat12_log
+from cat12.cpus import pin, pinned
+
+logger = cat12_log(name="cat12")
+
+# lines longer than this are split
+LINE_LIMIT = 1024 * 1024
+
+# how often the logs are flushed to disk (in seconds)
+FLUSH_INTERVAL = 1.0
+
+# how often the process tree of a child is sampled (in seconds)
+SAMPLE_INTERVAL = 1.0
+
+# unit of ru_inblock and ru_oublock
+BLOCK_SIZE = 512
+
+# how long a child has to exit after SIGTERM before it is killed (in seconds)
+KILL_TIMEOUT = 10.0
+
+
+class CommandResult(NamedTuple):
+    """Exit status and resource usage of a command."""
+
+    cmd: list[str]
+    returncode: int
+    wall_time: float
+    user_time: float
+    system_time: float
+    max_rss: int
+    """Peak resident set size of the child and its descendants in kB."""
+    read_bytes: int = 0
+    """Bytes read from disk by the child and its descendants."""
+    write_bytes: int = 0
+    """Bytes written to disk by the child and its descendants."""
+
+    def summary(self) -> str:
+        """Return a one line summary of the result."""
+        return (
+            f"exit code: {self.returncode}"
+            f" - wall time: {self.wall_time:.1f} s"
+            f" - user time: {self.user_time:.1f} s"
+            f" - system time: {self.system_time:.1f} s"
+            f" - max RSS: {self.max_rss / 1024:.0f} MB"
+            f" - read: {self.read_bytes / 1024**2:.0f} MB"
+            f" - written: {self.write_bytes / 1024**2:.0f} MB"
+        )
+
+
+async def supervise(
+    cmd: list[str],
+    log,
+    env: dict[str, str] | None = None,
+    echo: bool = False,
+    cpus: list[int] | None = None,
+) -> CommandResult:
+    """Run a command and stream its output to a log.
+
+    Each line is prefixed with a timestamp.
+    Writes to the log are buffered and flushed every ``FLUSH_INTERVAL``.
+    All the output is read before the exit status is collected,
+    so nothing written just before the child exits is lost.
+
+    The child runs in its own process group.
+    If streaming its output fails or the task is cancelled,
+    the whole group is terminated and the child is reaped,
+    so no MATLAB process is left running.
+
+    The memory of the whole process tree is sampled
+    every ``SAMPLE_INTERVAL`` because ``ru_maxrss``
+    only reports the biggest process, not the sum of all of them.
+
+    :param cmd: Command to run.
+    :type cmd: list[str]
+
+    :param log: Opened file (or any object with a ``write`` method).
+
+    :param env: Environment of the child. Defaults to the current one.
+    :type env: dict[str, str], optional
+
+    :param echo: Also write the output to STDOUT.
+    :type echo: bool
+
+    :param cpus: CPUs the child and its descendants are restricted to.
+        The command is run with ``taskset`` (see :func:`cat12.cpus.pinned`)
+        so the affinity is set before it starts,
+        or the child is pinned right after it starts
+        if ``taskset`` is not installed.
+    :type cpus: list[int], optional
+
+    :rtype: CommandResult
+    """
+    cmd = [str(x) for x in cmd]
+    loop = asyncio.get_running_loop()
+
+    start = time.perf_counter()
+    argv = pinned(cmd, cpus)
+    proc = Popen(
+        argv, stdout=PIPE, stderr=STDOUT, env=env, start_new_session=True
+    )
+    if argv is cmd:
+        pin(proc.pid, cpus)
+
+    sampler = ProcessTreeSampler(proc.pid, interval=SAMPLE_INTERVAL)
+    sampling = asyncio.ensure_future(sampler.run())
+
+    reader = asyncio.StreamReader(limit=LINE_LIMIT)
+    transport, _ = await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), proc.stdout
+    )
+    streamed = False
+    try:
+        await _stream(reader, log, echo)
+        streamed = True
+    finally:
+        transport.close()
+        sampling.cancel()
+        if not streamed:
+            await _terminate(proc)
+
+    status, rusage = await _wait(proc.pid)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+
+    return CommandResult(
+        cmd=cmd,
+        returncode=proc.returncode,
+        wall_time=time.perf_counter() - start,
+        user_time=rusage.ru_utime,
+        system_time=rusage.ru_stime,
+        max_rss=max(rusage.ru_maxrss, sampler.peak_rss // 1024),
+        # /proc/<pid>/io may not be readable: fall back on the block counts
+        read_bytes=max(sampler.read_bytes, rusage.ru_inblock * BLOCK_SIZE),
+        write_bytes=max(sampler.write_bytes, rusage.ru_oublock * BLOCK_SIZE),
+    )
+
+
+def run_supervised(
+    cmd: list[str],
+    log,
+    env: dict[str, str] | None = None,
+    echo: bool = True,
+    cpus: list[int] | None = None,
+) -> CommandResult:
+    """Run a single command with :func:`supervise` and wait for it."""
+    return asyncio.run(supervise(cmd, log, env=env, echo=echo, cpus=cpus))
+
+
+async def _stream(reader: asyncio.StreamReader, log, echo: bool) -> None:
+    last_flush = time.monotonic()
+    while True:
+        try:
+            line = await reader.readuntil(b"\n")
+        except asyncio.IncompleteReadError as exc:
+            # end of the output, possibly without a last newline
+            line = exc.partial
+        except asyncio.LimitOverrunError as exc:
+            # line longer than the limit: split it
+            line = await reader.read(exc.consumed)
+        if not line:
+            break
+
+        text = line.decode("utf-8", errors="replace")
+        if not text.endswith("\n"):
+            text += "\n"
+        if echo:
+            sys.stdout.write(text)
+        log.write(f"[{datetime.now().isoformat(timespec='seconds')}] {text}")
+
+        if time.monotonic() - last_flush > FLUSH_INTERVAL:
+            _flush(log)
+            last_flush = time.monotonic()
+
+    _flush(log)
+
+
+async def _terminate(proc: Popen) -> None:
+    """Terminate the process group of a child and reap the child.
+
+    The group is sent SIGTERM, then SIGKILL
+    if the child did not exit after ``KILL_TIMEOUT``.
+    The exit is awaited so the other children keep being supervised.
+    """
+    waiting = asyncio.ensure_future(_wait(proc.pid))
+    try:
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            _killpg(proc.pid, sig)
+            try:
+                status, _ = await asyncio.wait_for(
+                    asyncio.shield(waiting), KILL_TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                logger.warning(f"{proc.pid} did not exit after {sig.name}")
+            else:
+                proc.returncode = os.waitstatus_to_exitcode(status)
+                break
+    finally:
+        # other processes of the group may still be exiting
+        _killpg(proc.pid, signal.SIGKILL)
+
+
+def _killpg(pid: int, sig: signal.Signals) -> None:
+    try:
+        os.killpg(pid, sig)
+    except ProcessLookupError:
+        # the whole group already exited
+        pass
+
+
+def _flush(log) -> None:
+    if hasattr(log, "flush"):
+        log.flush()
+
+
+async def _wait(pid: int):
+    """Wait for a child to exit and return its status and resource usage.
+
+    Uses a pidfd (Linux >= 5.3) so that waiting does not need a thread.
+    """
+    loop = asyncio.get_running_loop()
+
+    try:
+        pidfd = os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        _, status, rusage = await loop.run_in_executor(None, os.wait4, pid, 0)
+        return status, rusage
+
+    exited = loop.create_future()
+    loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+    try:
+        await exited
+    finally:
+        loop.remove_reader(pidfd)
+        os.close(pidfd)
+
+    _, status, rusage = os.wait4(pid, 0)
+    return status, rusage
@@ -3,25 +3,29 @@
 from __future__ import annotations
 
 from pathlib import Path
-
-from rich.progress import (
-    BarColumn,
-    MofNCompleteColumn,
-    Progress,
-    SpinnerColumn,
-    TaskProgressColumn,
-    TextColumn,
-    TimeElapsedColumn,
-    TimeRemainingColumn,
-)
+from typing import TYPE_CHECKING
 
 from cat12.cat_logging import cat12_log
 
+if TYPE_CHECKING:
+    from rich.progress import Progress
+
 logger = cat12_log(name="cat12")
 
 
 def progress_bar(text: str, color: str = "green") -> Progress:
     """Return a rich progress bar instance."""
+    from rich.progress import (
+        BarColumn,
+        MofNCompleteColumn,
+        Progress,
+        SpinnerColumn,
+        TaskProgressColumn,
+        TextColumn,
+        TimeElapsedColumn,
+        TimeRemainingColumn,
+    )
+
     return Progress(
         TextColumn(f"[{color}]{text}"),
         SpinnerColumn("dots"),
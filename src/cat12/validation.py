@@ -0,0 +1,182 @@
+"""Validate the input dataset with the BIDS validator, once.
+
+Validating a big dataset can take longer than processing a participant,
+and every task of an array job would validate the same dataset.
+
+- Results are cached in the output dataset,
+  keyed by a fingerprint of the files
+  (see :func:`cat12.bids_utils.dataset_fingerprint`)
+  and by the version of the validator.
+- With the ``participants`` scope, only the top level files
+  and the folders of the selected participants are validated:
+  they are linked in a temporary dataset
+  and the validation of each participant is cached separately,
+  so participants validated by a previous run or another task are skipped.
+"""
+
+from __future__ import annotations
+
+import csv
+import json
+import os
+import subprocess
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+from cat12.bids_utils import _hash, dataset_fingerprint
+from cat12.cat_logging import cat12_log
+from cat12.scanner import list_subject_dirs
+
+logger = cat12_log(name="cat12")
+
+VALIDATOR = "bids-validator"
+
+# not validated, not needed by the app
+_SKIPPED = ("derivatives", "sourcedata", "code")
+
+
+def validator_version() -> str | None:
+    """Return the version of the validator or None if it cannot run."""
+    try:
+        result = subprocess.run(
+            [VALIDATOR, "--version"],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip() or None
+
+
+def validate(
+    bids_dir: Path,
+    cache_dir: Path,
+    subjects: list[str] | None = None,
+    scope: str = "participants",
+) -> bool:
+    """Validate a dataset unless a previous validation still holds.
+
+    :param bids_dir: Input dataset.
+    :type bids_dir: Path
+
+    :param cache_dir: Where validation results are cached.
+    :type cache_dir: Path
+
+    :param subjects: Participants to validate. Defaults to all of them.
+    :type subjects: list[str], optional
+
+    :param scope: ``participants`` to only validate the top level files
+        and the folders of ``subjects``,
+        ``dataset`` to validate the whole dataset.
+    :type scope: str
+
+    :return: True if the dataset is valid.
+    :rtype: bool
+    """
+    bids_dir = bids_dir.absolute()
+    if subjects:
+        subjects = [x for x in subjects if (bids_dir / f"sub-{x}").is_dir()]
+    if scope == "dataset" or not subjects:
+        subjects = list_subject_dirs(bids_dir)
+
+    version = validator_version()
+    if version is None:
+        logger.warning(f"Cannot get the version of {VALIDATOR}: not caching.")
+
+    fingerprint = dataset_fingerprint(bids_dir, subjects)
+    if scope == "dataset":
+        keys = {"dataset": _hash(str(version), *sorted(fingerprint.values()))}
+    else:
+        keys = {
+            subject: _hash(
+                str(version),
+                fingerprint["top_level"],
+                fingerprint[f"sub-{subject}"],
+            )
+            for subject in subjects
+        }
+
+    todo = [
+        x
+        for x, key in keys.items()
+        if version is None or not (cache_dir / f"{key}.json").exists()
+    ]
+    if not todo:
+        logger.info("dataset already validated: skipping validation")
+        return True
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    if scope == "dataset":
+        valid = _run(bids_dir)
+    else:
+        logger.info(f"validating {len(todo)} / {len(subjects)} participants")
+        with tempfile.TemporaryDirectory(dir=cache_dir) as tmp:
+            subset = Path(tmp) / bids_dir.name
+            link_subset(bids_dir, subset, todo)
+            valid = _run(subset)
+
+    if valid and version is not None:
+        for x in todo:
+            _write(
+                cache_dir / f"{keys[x]}.json",
+                {
+                    "validator": version,
+                    "scope": x if scope == "dataset" else f"sub-{x}",
+                    "time": datetime.now().isoformat(timespec="seconds"),
+                },
+            )
+    return valid
+
+
+def link_subset(bids_dir: Path, subset: Path, subjects: list[str]) -> None:
+    """Make a dataset with the top level files and some participants.
+
+    Files and folders are symbolic links to the original ones,
+    except ``participants.tsv`` that only lists ``subjects``.
+    """
+    subset.mkdir(parents=True)
+    selected = {f"sub-{x}" for x in subjects}
+    for entry in os.scandir(bids_dir):
+        if entry.name.startswith("sub-") and entry.name not in selected:
+            continue
+        if entry.name.startswith(".") or entry.name in _SKIPPED:
+            continue
+        if entry.name == "participants.tsv":
+            _filter_participants(
+                Path(entry.path), subset / entry.name, selected
+            )
+            continue
+        (subset / entry.name).symlink_to(entry.path)
+
+
+def _filter_participants(src: Path, dst: Path, selected: set[str]) -> None:
+    with src.open(newline="") as f_in, dst.open("w", newline="") as f_out:
+        reader = csv.reader(f_in, delimiter="\t")
+        writer = csv.writer(f_out, delimiter="\t", lineterminator="\n")
+        header = next(reader, None)
+        if header is None:
+            return
+        writer.writerow(header)
+        column = (
+            header.index("participant_id") if "participant_id" in header else 0
+        )
+        for row in reader:
+            if row and row[column] in selected:
+                writer.writerow(row)
+
+
+def _run(dataset: Path) -> bool:
+    try:
+        subprocess.run([VALIDATOR, str(dataset)], check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    return True
+
+
+def _write(path: Path, content: dict) -> None:
+    tmp = path.with_name(f".tmp_{os.getpid()}_{path.name}")
+    with tmp.open("w") as f:
+        json.dump(content, f, indent=4)
+    tmp.replace(path)
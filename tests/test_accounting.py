@@ -0,0 +1,31 @@
+"""Tests of the resource accounting."""
+
+from __future__ import annotations
+
+from concurrent.futures import ProcessPoolExecutor
+
+from cat12.accounting import ResourceLog
+
+
+def _add(output_dir, step):
+    ResourceLog(output_dir).add(step=step, wall_time=1.0)
+
+
+def test_header_is_written_once(tmp_path):
+    with ProcessPoolExecutor(max_workers=8) as executor:
+        list(executor.map(_add, [tmp_path] * 32, range(32)))
+
+    lines = (tmp_path / "logs" / "resources.tsv").read_text().splitlines()
+    assert len(lines) == 33
+    assert sum(line.startswith("participant_id\t") for line in lines) == 1
+
+
+def test_header_is_written_to_an_empty_file(tmp_path):
+    (tmp_path / "logs").mkdir()
+    (tmp_path / "logs" / "resources.tsv").touch()
+
+    _add(tmp_path, "segment")
+
+    lines = (tmp_path / "logs" / "resources.tsv").read_text().splitlines()
+    assert lines[0].startswith("participant_id\t")
+    assert len(lines) == 2
@@ -0,0 +1,33 @@
+"""Tests of the group tables."""
+
+from __future__ import annotations
+
+import pytest
+
+from cat12.group import ENTITY_COLUMNS, write_table
+
+ROW = ["sub-01", "n/a", "sub-01_T1w", float("nan"), 1500.0]
+COLUMNS = [*ENTITY_COLUMNS, "IQR", "TIV"]
+
+
+def test_missing_values_are_na_in_tsv(tmp_path):
+    write_table(tmp_path / "volumes", COLUMNS, [ROW])
+
+    lines = (tmp_path / "volumes.tsv").read_text().splitlines()
+    assert lines[1].split("\t") == [
+        "sub-01",
+        "n/a",
+        "sub-01_T1w",
+        "n/a",
+        "1500.0",
+    ]
+
+
+def test_missing_values_are_null_in_parquet(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+
+    write_table(tmp_path / "volumes", COLUMNS, [ROW])
+
+    table = pq.read_table(tmp_path / "volumes.parquet").to_pydict()
+    assert table["IQR"] == [None]
+    assert table["TIV"] == [1500.0]
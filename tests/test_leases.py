@@ -0,0 +1,59 @@
+"""Tests of the participant leases."""
+
+from __future__ import annotations
+
+import os
+import socket
+
+from cat12.leases import LeaseQueue, is_dead
+
+
+def test_check_after_release_keeps_lease_free(tmp_path):
+    queue = LeaseQueue(tmp_path)
+    assert queue.claim("01")
+    queue.release("01")
+
+    # a heartbeat that started before the release
+    assert not queue._check("01")
+    assert not queue.path("01").exists()
+
+
+def test_check_takes_back_a_missing_lease(tmp_path):
+    lost = []
+    queue = LeaseQueue(tmp_path, on_lost=lost.append)
+    assert queue.claim("01")
+    queue.path("01").unlink()
+
+    assert queue.holds("01")
+    assert queue.path("01").exists()
+    assert lost == []
+
+
+def test_check_forgets_a_reclaimed_lease(tmp_path):
+    lost = []
+    queue = LeaseQueue(tmp_path, on_lost=lost.append)
+    other = LeaseQueue(tmp_path)
+    assert queue.claim("01")
+    queue.path("01").unlink()
+    assert other.claim("01")
+
+    assert not queue.holds("01")
+    assert lost == ["01"]
+    assert "01" not in queue.held
+
+
+def test_claim_records_the_holder_of_a_skipped_lease(tmp_path):
+    queue = LeaseQueue(tmp_path)
+    other = LeaseQueue(tmp_path)
+    assert other.claim("01")
+
+    assert not queue.claim("01")
+    assert queue.skipped == {"01": other.owner}
+
+
+def test_is_dead():
+    host = socket.gethostname()
+    assert is_dead(f"{host}:{os.getpid()}:abcd")
+    assert not is_dead(f"{host}:{os.getppid()}:abcd")
+    assert not is_dead("elsewhere:1:abcd")
+    assert not is_dead(None)
@@ -0,0 +1,40 @@
+"""Tests of the post-processing commands."""
+
+from __future__ import annotations
+
+import pytest
+
+from cat12 import main
+from cat12._parsers import common_parser
+from cat12._version import __version__
+
+
+class _Called(Exception):
+    """Raised instead of running CAT12."""
+
+
+@pytest.mark.parametrize(
+    ("options", "expected"),
+    [([], ("12", "1")), (["--fwhm", "8"], ("8", "1"))],
+)
+def test_resample_arguments(tmp_path, monkeypatch, options, expected):
+    surf = tmp_path / f"CAT12_{__version__}" / "sub-01" / "anat" / "surf"
+    surf.mkdir(parents=True)
+    (surf / "lh.thickness.sub-01_T1w").write_text("")
+    monkeypatch.setenv("CAT12_MCR_CACHE_DIR", str(tmp_path / "mcr"))
+
+    called = []
+
+    def batch_command(standalone, name, files, output, arguments):
+        called.append(arguments)
+        raise _Called
+
+    monkeypatch.setattr(main, "batch_command", batch_command)
+    args = common_parser().parse_args(
+        [str(tmp_path), str(tmp_path), "participant", "resample", *options]
+    )
+
+    with pytest.raises(_Called):
+        main.postprocess("resample", tmp_path, args)
+
+    assert called == [expected]
@@ -0,0 +1,57 @@
+"""Tests of the supervision of child processes."""
+
+from __future__ import annotations
+
+import asyncio
+import io
+import sys
+import time
+
+from cat12 import supervisor
+from cat12.supervisor import LINE_LIMIT, run_supervised, supervise
+
+
+def _output(log: io.StringIO) -> list[str]:
+    """Return the lines of a log without their timestamp."""
+    return [line.split("] ", 1)[1] for line in log.getvalue().splitlines()]
+
+
+def test_long_lines_are_split_without_loss():
+    n = 2 * LINE_LIMIT + 10
+    code = f"print('a'); print('x' * {n}); print('b', end='')"
+    log = io.StringIO()
+
+    result = run_supervised([sys.executable, "-c", code], log, echo=False)
+
+    assert result.returncode == 0
+    lines = _output(log)
+    assert lines[0] == "a"
+    assert lines[-1] == "b"
+    assert len(lines) > 3
+    assert "".join(lines[1:-1]) == "x" * n
+
+
+def test_cancel_does_not_block_other_children(monkeypatch):
+    monkeypatch.setattr(supervisor, "KILL_TIMEOUT", 0.5)
+    # ignores SIGTERM, so it is only stopped by SIGKILL
+    stubborn = "trap '' TERM; echo started; while :; do sleep 0.1; done"
+
+    async def main():
+        task = asyncio.ensure_future(
+            supervise(["sh", "-c", stubborn], io.StringIO())
+        )
+        await asyncio.sleep(0.5)
+        task.cancel()
+        start = time.perf_counter()
+        other = await supervise(["sh", "-c", "echo done"], io.StringIO())
+        elapsed = time.perf_counter() - start
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        return other, elapsed
+
+    other, elapsed = asyncio.run(main())
+
+    assert other.returncode == 0
+    assert elapsed < supervisor.KILL_TIMEOUT